@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,13 +42,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'midi.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'midi.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'midi.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'SweetBoxSYNTHAGE.urls'
@@ -70,16 +74,93 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'SweetBoxSYNTHAGE.wsgi.application'
 
+# wsgi.py and asgi.py load URLs, templates and firmware before serving (see
+# SweetBoxSYNTHAGE/warmup.py); WARMUP=0 leaves them to the first request.
+
+WARMUP = os.environ.get('WARMUP', '1') != '0'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_ENGINE selects the backend:
+#   'sqlite'     - SQLITE_PATH (default db.sqlite3). midi/db.py sets
+#                  synchronous=NORMAL, a busy timeout of OPTIONS['timeout']
+#                  seconds and mmap'd reads on every new connection;
+#                  SQLITE_TUNING=0 turns that off (bench_concurrency compares
+#                  both). SQLITE_WAL=1 also switches the file to WAL mode,
+#                  which deployments with several workers should set; it is
+#                  off by default because it rewrites the file's header.
+#   'postgresql' - POSTGRES_DB/USER/PASSWORD/HOST/PORT; needs psycopg
+#                  (pip install "psycopg[binary]").
+# Either way connections persist for CONN_MAX_AGE seconds and are checked
+# before reuse, so each worker thread keeps one open connection instead of
+# connecting per request. Put PgBouncer in front of PostgreSQL when the number
+# of workers outgrows max_connections.
+#
+# The 'replica' alias serves the read-only views listed below (see
+# midi/routers.py). For PostgreSQL it is POSTGRES_REPLICA_HOST, when set; for
+# SQLite it is a second connection to SQLITE_REPLICA_PATH, by default the
+# primary file itself, which keeps the routing exercised locally.
+
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+CONN_MAX_AGE = int(os.environ.get('CONN_MAX_AGE', 600))
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'sweetbox'),
+            'USER': os.environ.get('POSTGRES_USER', 'sweetbox'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
+    }
+    if os.environ.get('POSTGRES_REPLICA_HOST'):
+        DATABASES['replica'] = dict(
+            DATABASES['default'],
+            HOST=os.environ['POSTGRES_REPLICA_HOST'],
+            PORT=os.environ.get('POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+            TEST={'MIRROR': 'default'},
+        )
+else:
+    SQLITE_PATH = os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_PATH,
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': 20,
+            },
+        }
     }
-}
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        NAME=os.environ.get('SQLITE_REPLICA_PATH', SQLITE_PATH),
+        TEST={'MIRROR': 'default'},
+    )
+
+DATABASE_ROUTERS = ['midi.routers.PrimaryReplicaRouter']
+
+# URL names whose GET requests read from the replica, and how long a client
+# stays on the primary after a write so it sees its own changes.
+
+DATABASE_REPLICA_VIEWS = ['dashboard', 'preset_list', 'portal', 'download_firmware', 'download_preset_binary', 'api_presets', 'api_preset']
+
+DATABASE_REPLICA_PIN_SECONDS = 10
+
+SQLITE_TUNING = os.environ.get('SQLITE_TUNING', '1') != '0'
+
+SQLITE_WAL = SQLITE_TUNING and os.environ.get('SQLITE_WAL', '0') == '1'
 
 
 # Password validation
@@ -122,3 +203,127 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Firmware build cache
+# Rendered firmware is stored content-addressed and shared between identical
+# presets; the least recently used artifacts are evicted past the size limit.
+
+FIRMWARE_CACHE_DIR = BASE_DIR / 'generated_firmware' / 'cache'
+
+FIRMWARE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Firmware downloads can be offloaded to the front-end server. Set the header
+# to 'X-Accel-Redirect' (nginx, with an internal location serving
+# FIRMWARE_CACHE_DIR under FIRMWARE_SENDFILE_PREFIX) or 'X-Sendfile'
+# (Apache/lighttpd, given the absolute path). None streams from Django.
+
+FIRMWARE_SENDFILE_HEADER = None
+
+FIRMWARE_SENDFILE_PREFIX = '/protected/firmware/'
+
+# Render threads used by the zip export of all of a user's firmware.
+
+FIRMWARE_EXPORT_WORKERS = 4
+
+# Firmware builds run off the request thread, see midi/jobs.py. Backends:
+# 'thread' (in-process worker), 'worker' (manage.py run_firmware_worker) or
+# 'immediate' (inline). download_firmware waits this many seconds for a
+# queued build before answering 202 with the job's status URL.
+
+FIRMWARE_BUILD_BACKEND = os.environ.get('FIRMWARE_BUILD_BACKEND', 'thread')
+
+FIRMWARE_BUILD_WAIT = 2.0
+
+# Seconds after which a pending or running build is presumed lost (its
+# process died) and failed, so the next request queues it afresh.
+
+FIRMWARE_BUILD_STALE_AFTER = 60
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# DJANGO_CACHE_BACKEND selects the shared tier behind midi.cache.TieredCache:
+#   'file' - FileBasedCache under DJANGO_CACHE_LOCATION
+#   'db'   - DatabaseCache; run manage.py createcachetable first
+# Either is shared by every worker on the host, with a small per-process LRU
+# in front. The default, 'locmem', is a plain per-process cache for
+# development and tests.
+
+CACHE_BACKEND = os.environ.get('DJANGO_CACHE_BACKEND', 'locmem')
+
+if CACHE_BACKEND == 'locmem':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'sweetbox',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'midi.cache.TieredCache',
+            'LOCATION': 'default',
+            'OPTIONS': {
+                'SHARED': {
+                    'file': {
+                        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', str(BASE_DIR / 'cache')),
+                        'OPTIONS': {'MAX_ENTRIES': 10000},
+                    },
+                    'db': {
+                        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                        'LOCATION': 'django_cache',
+                        'OPTIONS': {'MAX_ENTRIES': 10000},
+                    },
+                }[CACHE_BACKEND],
+                'LOCAL_MAX_ENTRIES': 1000,
+                'LOCAL_TIMEOUT': 5,
+            },
+        }
+    }
+
+# Seconds a user's dashboard summaries stay cached. Writes refresh the entry,
+# so this only bounds how long an entry for an idle user is kept.
+
+DASHBOARD_CACHE_TIMEOUT = 60 * 60
+
+# Seconds a rendered dashboard card or knob table stays cached, see
+# midi/templatetags/fragments.py. Keys carry Preset.updated, so edits never serve stale HTML;
+# this only bounds how long fragments of untouched presets are kept.
+
+FRAGMENT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Most presets accepted by one bulk request of the JSON API (midi/api.py).
+
+API_BULK_MAX = 500
+
+# Prometheus metrics (midi/metrics.py). Each process adds its counters to the
+# SQLite file at METRICS_PATH every METRICS_FLUSH_INTERVAL seconds; GET
+# /metrics renders the totals of every worker on the host. With METRICS_TOKEN
+# set the scraper sends "Authorization: Bearer <token>", otherwise only staff
+# users may read it.
+
+METRICS_PATH = os.environ.get('METRICS_PATH', BASE_DIR / 'metrics.sqlite3')
+
+METRICS_FLUSH_INTERVAL = 5
+
+# The test runner points METRICS_PATH at a temporary file for the run.
+
+TEST_RUNNER = 'midi.test_runner.TestRunner'
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Request profiling (midi/profiling.py). Staff add "X-Profile: 1" or
+# ?_profile=1 to profile one request; any request still running after
+# PROFILE_SLOW_REQUEST_MS (0 disables) has its stack sampled every
+# PROFILE_SAMPLE_INTERVAL seconds. Both are stored with their SQL as
+# RequestProfile rows in the admin, the newest PROFILE_KEEP of them.
+
+PROFILE_SLOW_REQUEST_MS = int(os.environ.get('PROFILE_SLOW_REQUEST_MS', 1000))
+
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+PROFILE_KEEP = 200
+
+PROFILE_MAX_QUERIES = 1000
@@ -0,0 +1,109 @@
+# Eager loading for wsgi.py and asgi.py, so a worker's first request costs
+# what its hundredth does.
+#
+# Django loads most things on first use: view modules and the URL resolver on
+# the first request, each template when it is first rendered. warmup() does
+# all of that up front. Under gunicorn --preload it runs once in the master
+# before the workers are forked, and they share the loaded objects
+# copy-on-write. It then closes the connections it opened, since a socket
+# must not be shared with the children, and freezes the garbage collector's
+# view of the heap so collections in the workers do not write to (and so
+# copy) those pages.
+
+import gc
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+from django.urls import get_resolver
+
+
+def load_urls():
+    resolver = get_resolver()
+    # Reversing populates the resolver's lookup tables; walking the patterns
+    # compiles every route's regex.
+    resolver.reverse_dict
+    patterns = [(resolver, resolver.url_patterns)]
+    count = 0
+    while patterns:
+        parent, children = patterns.pop()
+        for pattern in children:
+            pattern.pattern.regex
+            count += 1
+            if hasattr(pattern, 'url_patterns'):
+                pattern.reverse_dict
+                patterns.append((pattern, pattern.url_patterns))
+    return count
+
+
+def template_names(engine):
+    for loader in engine.engine.template_loaders:
+        for source_loader in getattr(loader, 'loaders', [loader]):
+            for directory in source_loader.get_dirs():
+                directory = Path(directory)
+                for path in sorted(directory.rglob('*.html')):
+                    yield path.relative_to(directory).as_posix()
+
+
+def load_templates():
+    # The cached loader keeps each compiled template for the process's life.
+    count = 0
+    for engine in engines.all():
+        for name in dict.fromkeys(template_names(engine)):
+            try:
+                engine.get_template(name)
+            except (TemplateDoesNotExist, TemplateSyntaxError):
+                # Fragments meant to be included from elsewhere.
+                continue
+            count += 1
+    return count
+
+
+def load_firmware():
+    # Parsed at import; one render per board warms the rest of the path.
+    from midi.generator import BOARDS, render_preset
+
+    preset = SimpleNamespace(name='Warmup', keys_channel=1)
+    knobs = [SimpleNamespace(pin=0, CC=24)]
+    for board in BOARDS:
+        render_preset(preset, knobs, board)
+    return len(BOARDS)
+
+
+def release():
+    connections.close_all()
+    caches.close_all()
+    gc.collect()
+    gc.freeze()
+
+
+STEPS = (
+    ('URL patterns', load_urls),
+    ('templates', load_templates),
+    ('firmware boards', load_firmware),
+    ('connections closed, heap frozen', release),
+)
+
+
+def warmup(get_application, stream=sys.stderr):
+    # application = warmup(get_wsgi_application): sets Django up, loads the
+    # rest unless WARMUP is off, and reports how long each step took.
+    started = time.perf_counter()
+    application = get_application()
+    report = [f'app registry and middleware in {(time.perf_counter() - started) * 1000:.0f} ms']
+    if not settings.WARMUP:
+        return application
+    for label, step in STEPS:
+        step_started = time.perf_counter()
+        count = step()
+        elapsed = (time.perf_counter() - step_started) * 1000
+        report.append(f'{label}: {count} in {elapsed:.0f} ms' if count is not None else f'{label} in {elapsed:.0f} ms')
+    total = (time.perf_counter() - started) * 1000
+    stream.write(f"warmup: {'; '.join(report)}; {total:.0f} ms in all\n")
+    stream.flush()
+    return application
@@ -11,6 +11,10 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
+from SweetBoxSYNTHAGE.warmup import warmup
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SweetBoxSYNTHAGE.settings')
 
-application = get_wsgi_application()
+# Loads URLs, templates and firmware before gunicorn forks (with --preload)
+# or before the worker's first request; see warmup.py.
+application = warmup(get_wsgi_application)
@@ -1,9 +1,26 @@
 from django.contrib import admin
-from .models import Preset, Knob, Joystick, ModWheel, PitchWheel
+from .models import Preset, Knob, FirmwareBuild, Joystick, ModWheel, PitchWheel, RequestProfile
 
 # Register your models here.
 admin.site.register(Preset)
 admin.site.register(Knob)
+admin.site.register(FirmwareBuild)
 admin.site.register(Joystick)
 admin.site.register(ModWheel)
-admin.site.register(PitchWheel)
\ No newline at end of file
+admin.site.register(PitchWheel)
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    # Written by midi/profiling.py only.
+    list_display = ('created', 'method', 'path', 'status', 'trigger', 'duration_ms', 'query_count', 'user')
+    list_filter = ('trigger', 'view')
+    search_fields = ('path',)
+    ordering = ('-id',)
+    readonly_fields = [field.name for field in RequestProfile._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
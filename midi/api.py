@@ -0,0 +1,380 @@
+# JSON API for presets with their knobs.
+#
+#   GET    api/presets/             every preset of the user
+#   POST   api/presets/             create one
+#   GET    api/presets/<id>/        one preset (ETag, If-None-Match)
+#   PUT    api/presets/<id>/        replace name, keys_channel and knobs (If-Match)
+#   DELETE api/presets/<id>/        delete (If-Match)
+#   PATCH  api/presets/<id>/knobs/  change some fields of some knobs (If-Match)
+#   POST   api/presets/bulk/        create many: {"presets": [...]}
+#   PUT    api/presets/bulk/        replace many: {"presets": [{"id", "etag"?, ...}]}
+#   DELETE api/presets/bulk/        delete many: {"ids": [...]}
+#
+# A preset is {"id", "name", "keys_channel", "number_of_knobs", "created",
+# "updated", "etag", "knobs": [{"id", "channel", "CC", "min", "max", "pin"}]}.
+# Knobs without an id are created, stored knobs missing from a PUT are
+# deleted. Payloads are validated with the same forms as the portal.
+#
+# A knob PATCH is {"knobs": [{"id": 12, "CC": 30}, ...]}: only the fields
+# given change, only the knobs named are validated, and only the columns
+# that differ are written. CC and pin uniqueness is left to the database
+# constraints (409 on a clash). The answer holds just the patched knobs and
+# the new ETag.
+#
+# The ETag is derived from Preset.updated. A write with If-Match (or, in
+# bulk, an "etag" per item) only goes through if the preset has not changed
+# since: the check is a compare-and-set on updated inside the write
+# transaction, so two clients racing on the same ETag cannot both win.
+#
+# Session authentication with the usual CSRF header (X-CSRFToken).
+# Responses are built from .values(), two queries for any number of presets.
+
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.views.decorators.http import require_http_methods
+
+from .decorators import api_login_required
+from .forms import KnobForm, KnobFormSet, PresetForm
+from .models import KNOB_FIELDS, Knob, Preset
+from .services import SUMMARY_FIELDS, create_presets, knob_values, save_knobs
+
+
+class PayloadError(Exception):
+
+    def __init__(self, errors, status=400):
+        super().__init__(errors)
+        self.errors = errors
+        self.status = status
+
+
+def preset_etag(updated):
+    return f'"{int(updated.timestamp() * 1_000_000)}"'
+
+
+def serialize_presets(presets):
+    # presets: a Preset queryset. One query for the presets and one for all of
+    # their knobs, both as plain dicts.
+    rows = list(presets.values(*SUMMARY_FIELDS))
+    knobs = defaultdict(list)
+    knob_rows = (
+        Knob.objects.filter(preset_id__in=[row['id'] for row in rows])
+        .order_by('id')
+        .values('id', 'preset_id', *KNOB_FIELDS)
+    )
+    for knob in knob_rows:
+        knobs[knob.pop('preset_id')].append(knob)
+    for row in rows:
+        row['etag'] = preset_etag(row['updated'])
+        row['knobs'] = knobs[row['id']]
+    return rows
+
+
+def is_id(value):
+    # JSON true and false are ints to Python, but not ids.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def read_json(request):
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        raise PayloadError({'body': 'Request body must be valid JSON.'})
+
+
+def clean_preset(data, stored=None):
+    # Validates one preset payload with PresetForm and KnobFormSet. Returns
+    # (preset fields, knob rows) with rows in the shape save_knobs expects.
+    # stored: knob_values() of the preset being replaced, or None on create.
+    if not isinstance(data, dict):
+        raise PayloadError({'preset': 'Each preset must be an object.'})
+    knobs = data.get('knobs')
+    if not isinstance(knobs, list) or not all(isinstance(knob, dict) for knob in knobs):
+        raise PayloadError({'knobs': 'A list of knob objects is required.'})
+
+    preset_form = PresetForm({
+        'name': data.get('name'),
+        'keys_channel': data.get('keys_channel'),
+        'number_of_knobs': len(knobs),
+    })
+    formset_data = {
+        'form-TOTAL_FORMS': len(knobs),
+        'form-INITIAL_FORMS': 0,
+        'form-MIN_NUM_FORMS': 1,
+        'form-MAX_NUM_FORMS': 16,
+    }
+    for i, knob in enumerate(knobs):
+        for field in KNOB_FIELDS:
+            value = knob.get(field)
+            formset_data[f'form-{i}-{field}'] = '' if value is None else value
+    # Ids are matched against the stored knobs below, so the formset only
+    # validates values and never queries.
+    knob_formset = KnobFormSet(formset_data, queryset=Knob.objects.none())
+
+    errors = {}
+    if not preset_form.is_valid():
+        errors.update(preset_form.errors.get_json_data())
+    if not knob_formset.is_valid():
+        knob_errors = [form.errors.get_json_data() for form in knob_formset.forms]
+        if any(knob_errors):
+            errors['knobs'] = knob_errors
+        if knob_formset.non_form_errors():
+            errors['__all__'] = knob_formset.non_form_errors().get_json_data()
+
+    if stored is not None:
+        ids = [knob['id'] for knob in knobs if knob.get('id') is not None]
+        unknown = [pk for pk in ids if not is_id(pk) or pk not in stored]
+        if unknown:
+            errors['ids'] = f'Unknown knob ids: {unknown}'
+        elif len(set(ids)) != len(ids):
+            errors['ids'] = 'Each knob id may appear only once.'
+    if errors:
+        raise PayloadError(errors)
+
+    # Ids are ignored on create, so an exported preset can be posted as a
+    # copy. Stored knobs left out of the payload are deleted.
+    rows = [
+        dict(form.cleaned_data, id=knob.get('id') if stored is not None else None)
+        for knob, form in zip(knobs, knob_formset.forms)
+    ]
+    submitted = {row['id'] for row in rows}
+    rows.extend({'id': pk, 'DELETE': True} for pk in (stored or ()) if pk not in submitted)
+    fields = {
+        'name': preset_form.cleaned_data['name'],
+        'keys_channel': preset_form.cleaned_data['keys_channel'],
+    }
+    return fields, rows
+
+
+def clean_knob_patch(data, stored):
+    # Returns (rows for save_knobs, patched knob ids). Each patched knob is
+    # checked whole (its stored values with the changes applied) by KnobForm;
+    # the rest pass through as stored, so save_knobs leaves them alone.
+    if not isinstance(data, dict):
+        raise PayloadError({'body': 'A JSON object is required.'})
+    patches = data.get('knobs')
+    if not isinstance(patches, list) or not patches or not all(isinstance(patch, dict) for patch in patches):
+        raise PayloadError({'knobs': 'A non-empty list of knob objects is required.'})
+
+    errors = {}
+    patched = {}
+    for i, patch in enumerate(patches):
+        pk = patch.get('id')
+        unknown = sorted(set(patch) - {'id', *KNOB_FIELDS})
+        if not is_id(pk) or pk not in stored:
+            errors[i] = {'id': f'Unknown knob id: {pk}'}
+        elif pk in patched:
+            errors[i] = {'id': 'Each knob id may appear only once.'}
+        elif unknown:
+            errors[i] = {field: 'Unknown field.' for field in unknown}
+        else:
+            values = dict(stored[pk], **{field: patch[field] for field in KNOB_FIELDS if field in patch})
+            form = KnobForm({field: '' if value is None else value for field, value in values.items()})
+            if form.is_valid():
+                patched[pk] = {field: form.cleaned_data[field] for field in KNOB_FIELDS}
+            else:
+                errors[i] = form.errors.get_json_data()
+    if errors:
+        raise PayloadError({'knobs': errors})
+    rows = [dict(patched.get(pk, values), id=pk) for pk, values in stored.items()]
+    return rows, list(patched)
+
+
+def strip_ids(rows):
+    return [{field: row[field] for field in KNOB_FIELDS} for row in rows if not row.get('DELETE')]
+
+
+def claim(preset, etag):
+    # Compare-and-set on updated: takes the row (and on SQLite the write lock)
+    # only if it still carries the ETag the client saw.
+    if etag not in ('*', preset_etag(preset.updated)):
+        return False
+    now = timezone.now()
+    if not Preset.objects.filter(pk=preset.pk, updated=preset.updated).update(updated=now):
+        return False
+    preset.updated = now
+    return True
+
+
+def update_preset(preset, stored, data, etag=None):
+    fields, rows = clean_preset(data, stored)
+    if etag is not None and not claim(preset, etag):
+        raise PayloadError({'etag': f'Preset {preset.pk} was changed by someone else.'}, status=412)
+    save_knobs(preset, stored, rows, **fields)
+
+
+def error_response(e):
+    return JsonResponse({'errors': e.errors}, status=e.status)
+
+
+def check_ids(ids, key='ids'):
+    invalid = [pk for pk in ids if not is_id(pk)]
+    if invalid:
+        raise PayloadError({key: f'Ids must be integers, got {json.dumps(invalid)}.'})
+    return ids
+
+
+def bulk_items(payload, key, ids=False):
+    # ids: the items themselves are preset ids.
+    items = payload.get(key)
+    if not isinstance(items, list):
+        raise PayloadError({key: 'A list is required.'})
+    if len(items) > settings.API_BULK_MAX:
+        raise PayloadError({key: f'At most {settings.API_BULK_MAX} items per request.'}, status=413)
+    return check_ids(items, key) if ids else items
+
+
+@api_login_required
+@require_http_methods(['GET', 'POST'])
+def presets(request):
+    user_presets = Preset.objects.filter(owner=request.user)
+    if request.method == 'GET':
+        return JsonResponse({'presets': serialize_presets(user_presets.order_by('-updated'))})
+    try:
+        fields, rows = clean_preset(read_json(request))
+    except PayloadError as e:
+        return error_response(e)
+    [preset] = create_presets(request.user, [dict(fields, knobs=strip_ids(rows))])
+    [data] = serialize_presets(Preset.objects.filter(pk=preset.pk))
+    response = JsonResponse(data, status=201)
+    response['ETag'] = data['etag']
+    return response
+
+
+@api_login_required
+@require_http_methods(['GET', 'HEAD', 'PUT', 'DELETE'])
+def preset_detail(request, preset_id):
+    preset = Preset.objects.filter(id=preset_id, owner=request.user).first()
+    if preset is None:
+        return JsonResponse({'error': 'Not found.'}, status=404)
+    # Handles If-None-Match (304 on reads) and If-Match (412 on writes).
+    response = get_conditional_response(request, etag=preset_etag(preset.updated))
+    if response is not None:
+        return response
+
+    if request.method == 'DELETE':
+        with transaction.atomic():
+            if 'HTTP_IF_MATCH' in request.META and not claim(preset, request.META['HTTP_IF_MATCH']):
+                return JsonResponse({'errors': {'etag': 'Preset was changed by someone else.'}}, status=412)
+            preset.delete()
+        return HttpResponse(status=204)
+
+    if request.method == 'PUT':
+        stored = knob_values(preset.knob_set.order_by('id'))
+        try:
+            with transaction.atomic():
+                update_preset(preset, stored, read_json(request), request.META.get('HTTP_IF_MATCH'))
+        except PayloadError as e:
+            return error_response(e)
+        except IntegrityError:
+            return JsonResponse({'errors': {'__all__': 'Conflicting CC or pin numbers.'}}, status=409)
+
+    [data] = serialize_presets(Preset.objects.filter(pk=preset.pk))
+    response = JsonResponse(data)
+    response['ETag'] = data['etag']
+    return response
+
+
+@api_login_required
+@require_http_methods(['POST', 'PUT', 'DELETE'])
+def presets_bulk(request):
+    user_presets = Preset.objects.filter(owner=request.user)
+    try:
+        payload = read_json(request)
+        if not isinstance(payload, dict):
+            raise PayloadError({'body': 'A JSON object is required.'})
+
+        if request.method == 'DELETE':
+            ids = bulk_items(payload, 'ids', ids=True)
+            _, counts = user_presets.filter(id__in=ids).delete()
+            return JsonResponse({'deleted': counts.get(Preset._meta.label, 0)})
+
+        items = bulk_items(payload, 'presets')
+        if request.method == 'POST':
+            specs = []
+            errors = {}
+            for i, item in enumerate(items):
+                try:
+                    fields, rows = clean_preset(item)
+                except PayloadError as e:
+                    errors[i] = e.errors
+                else:
+                    specs.append(dict(fields, knobs=strip_ids(rows)))
+            if errors:
+                raise PayloadError(errors)
+            created = create_presets(request.user, specs)
+            ids = [preset.pk for preset in created]
+            status = 201
+        else:
+            ids = check_ids([item.get('id') if isinstance(item, dict) else None for item in items])
+            if len(set(ids)) != len(ids):
+                raise PayloadError({'ids': 'Each preset may appear only once.'})
+            found = user_presets.in_bulk(ids)
+            missing = [pk for pk in ids if pk not in found]
+            if missing:
+                raise PayloadError({'ids': f'Unknown presets: {missing}'}, status=404)
+            knobs = defaultdict(list)
+            for knob in Knob.objects.filter(preset_id__in=ids).order_by('id'):
+                knobs[knob.preset_id].append(knob)
+            # All or nothing: any invalid item or stale etag rolls back the
+            # whole batch.
+            with transaction.atomic():
+                for i, item in enumerate(items):
+                    try:
+                        update_preset(found[item['id']], knob_values(knobs[item['id']]), item, item.get('etag'))
+                    except PayloadError as e:
+                        raise PayloadError({i: e.errors}, status=e.status)
+            status = 200
+    except PayloadError as e:
+        return error_response(e)
+    except IntegrityError:
+        return JsonResponse({'errors': {'__all__': 'Conflicting CC or pin numbers.'}}, status=409)
+
+    order = {pk: i for i, pk in enumerate(ids)}
+    data = sorted(serialize_presets(Preset.objects.filter(pk__in=ids)), key=lambda row: order[row['id']])
+    return JsonResponse({'presets': data}, status=status)
+
+
+@api_login_required
+@require_http_methods(['PATCH'])
+def preset_knobs(request, preset_id):
+    preset = Preset.objects.filter(id=preset_id, owner=request.user).first()
+    if preset is None:
+        return JsonResponse({'error': 'Not found.'}, status=404)
+    response = get_conditional_response(request, etag=preset_etag(preset.updated))
+    if response is not None:
+        return response
+
+    stored = knob_values(preset.knob_set.order_by('id'))
+    try:
+        rows, patched = clean_knob_patch(read_json(request), stored)
+        if 'HTTP_IF_MATCH' in request.META:
+            # The claim and the write commit together.
+            with transaction.atomic():
+                if not claim(preset, request.META['HTTP_IF_MATCH']):
+                    raise PayloadError({'etag': 'Preset was changed by someone else.'}, status=412)
+                save_knobs(preset, stored, rows)
+        else:
+            # save_knobs is atomic on its own; an outer block would only add
+            # a savepoint to every edit.
+            save_knobs(preset, stored, rows)
+    except PayloadError as e:
+        return error_response(e)
+    except IntegrityError:
+        return JsonResponse({'errors': {'__all__': 'Conflicting CC or pin numbers.'}}, status=409)
+
+    by_id = {row['id']: row for row in rows}
+    etag = preset_etag(preset.updated)
+    response = JsonResponse({
+        'id': preset.pk,
+        'updated': preset.updated,
+        'etag': etag,
+        'knobs': [{'id': pk, **{field: by_id[pk][field] for field in KNOB_FIELDS}} for pk in patched],
+    })
+    response['ETag'] = etag
+    return response
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MidiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'midi'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,70 @@
+# Compact binary preset format, loaded by the device at runtime instead of
+# regenerating and reflashing the firmware.
+#
+#   offset  size  field
+#   0       3     magic 'SBX'
+#   3       1     format version
+#   4       1     keys channel (1-16)
+#   5       1     number of knobs N (1-16)
+#   6       5*N   per knob: channel, CC, min, max, pin (one byte each)
+#
+# Every field fits a byte, so a 16 knob preset is 86 bytes. The bytes are not
+# 7-bit clean; midi/sysex.py packs them for transport over SysEx.
+
+import struct
+
+from .models import KNOB_FIELDS
+
+MAGIC = b'SBX'
+VERSION = 1
+MAX_KNOBS = 16
+
+HEADER = struct.Struct('>3sBBB')
+KNOB = struct.Struct('>5B')
+
+
+def encoded_size(knob_count):
+    return HEADER.size + KNOB.size * knob_count
+
+
+def encode(keys_channel, knobs):
+    # knobs: sequence of (channel, CC, min, max, pin) tuples.
+    if not 1 <= len(knobs) <= MAX_KNOBS:
+        raise ValueError(f'A preset needs 1 to {MAX_KNOBS} knobs, got {len(knobs)}.')
+    buffer = bytearray(encoded_size(len(knobs)))
+    try:
+        HEADER.pack_into(buffer, 0, MAGIC, VERSION, keys_channel, len(knobs))
+        offset = HEADER.size
+        for knob in knobs:
+            KNOB.pack_into(buffer, offset, *knob)
+            offset += KNOB.size
+    except struct.error as e:
+        raise ValueError(f'Preset values must fit in a byte: {e}') from None
+    return bytes(buffer)
+
+
+def decode(data):
+    # Returns {'keys_channel': int, 'knobs': [{field: value}]}, the knob dicts
+    # in the shape build_preset() accepts.
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise ValueError('Preset data is shorter than its header.')
+    magic, version, keys_channel, count = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError('Not a SweetBox preset.')
+    if version != VERSION:
+        raise ValueError(f'Unsupported preset format version {version}.')
+    if len(view) != encoded_size(count):
+        raise ValueError(f'Expected {encoded_size(count)} bytes for {count} knobs, got {len(view)}.')
+    return {
+        'keys_channel': keys_channel,
+        'knobs': [dict(zip(KNOB_FIELDS, knob)) for knob in KNOB.iter_unpack(view[HEADER.size:])],
+    }
+
+
+def encode_preset(preset, knobs=None):
+    # knobs: the preset's knob rows as tuples in KNOB_FIELDS order; loaded in
+    # one query when not given.
+    if knobs is None:
+        knobs = list(preset.knob_set.order_by('id').values_list(*KNOB_FIELDS))
+    return encode(preset.keys_channel, knobs)
@@ -0,0 +1,292 @@
+# Two-tier cache backend and namespaced, versioned keys.
+#
+# TieredCache keeps a small per-process LRU in front of a shared backend
+# (FileBasedCache or DatabaseCache), so every gunicorn worker on the box sees
+# the same data without Redis, while hot keys are served from memory. Local
+# copies live for at most LOCAL_TIMEOUT seconds, which bounds how long a
+# plain set() in one worker can go unseen by the others.
+#
+# Namespaces give that bound a way out: their version is read from the shared
+# tier on every access and is part of every key, so invalidate() takes effect
+# in all workers at once and stale local copies are simply never asked for
+# again.
+#
+#   CACHES = {'default': {
+#       'BACKEND': 'midi.cache.TieredCache',
+#       'LOCATION': 'default',
+#       'OPTIONS': {
+#           'SHARED': {'BACKEND': '...FileBasedCache', 'LOCATION': '/var/tmp/sweetbox'},
+#           'LOCAL_MAX_ENTRIES': 1000,
+#           'LOCAL_TIMEOUT': 5,
+#       },
+#   }}
+
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.module_loading import import_string
+
+from .metrics import record_cache
+
+# Process-wide state, keyed by LOCATION: Django hands out one cache instance
+# per thread, but the local tier and its counters belong to the process.
+_local_stores = {}
+_local_locks = {}
+_stats = {}
+
+STAT_NAMES = ('local_hits', 'shared_hits', 'misses', 'sets', 'deletes')
+
+
+class TieredCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        shared = dict(options['SHARED'])
+        backend = import_string(shared.pop('BACKEND'))
+        self.shared = backend(shared.pop('LOCATION', ''), shared)
+        self.local_max_entries = int(options.get('LOCAL_MAX_ENTRIES', 1000))
+        self.local_timeout = float(options.get('LOCAL_TIMEOUT', 5))
+        self._local = _local_stores.setdefault(location, OrderedDict())
+        self._lock = _local_locks.setdefault(location, threading.Lock())
+        self._stats = _stats.setdefault(location, dict.fromkeys(STAT_NAMES, 0))
+
+    def _count(self, name, count=1):
+        with self._lock:
+            self._stats[name] += count
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires, pickled = entry
+            if expires <= time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            self._stats['local_hits'] += 1
+        return pickled
+
+    def _local_set(self, key, value, timeout):
+        local_timeout = self.local_timeout
+        if timeout is not None:
+            local_timeout = min(local_timeout, timeout)
+        if local_timeout <= 0:
+            return
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        with self._lock:
+            self._local[key] = (time.monotonic() + local_timeout, pickled)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_max_entries:
+                self._local.popitem(last=False)
+
+    def _local_delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+
+    def _timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = self._local_get(key)
+        if pickled is not None:
+            return pickle.loads(pickled)
+        value = self.shared.get(key, self._missing_key)
+        if value is self._missing_key:
+            self._count('misses')
+            return default
+        self._count('shared_hits')
+        self._local_set(key, value, self.local_timeout)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        timeout = self._timeout(timeout)
+        self.shared.set(key, value, timeout)
+        self._local_set(key, value, timeout)
+        self._count('sets')
+
+    def get_many(self, keys, version=None):
+        # Local hits first, then a single get_many on the shared tier (one
+        # query for DatabaseCache) for the rest.
+        found = {}
+        missing = {}
+        for key in keys:
+            made = self.make_and_validate_key(key, version=version)
+            pickled = self._local_get(made)
+            if pickled is not None:
+                found[key] = pickle.loads(pickled)
+            else:
+                missing[made] = key
+        if missing:
+            shared = self.shared.get_many(list(missing))
+            for made, value in shared.items():
+                found[missing[made]] = value
+                self._local_set(made, value, self.local_timeout)
+            self._count('shared_hits', len(shared))
+            self._count('misses', len(missing) - len(shared))
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self._timeout(timeout)
+        made = {self.make_and_validate_key(key, version=version): key for key in data}
+        failed = self.shared.set_many({key: data[original] for key, original in made.items()}, timeout)
+        for key, original in made.items():
+            self._local_set(key, data[original], timeout)
+        self._count('sets', len(made))
+        return [made[key] for key in failed]
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        timeout = self._timeout(timeout)
+        added = self.shared.add(key, value, timeout)
+        if added:
+            self._local_set(key, value, timeout)
+            self._count('sets')
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self.shared.touch(key, self._timeout(timeout))
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._local_delete(key)
+        self._count('deletes')
+        return self.shared.delete(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._local_get(key) is not None or self.shared.has_key(key)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+        self.shared.clear()
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, local_entries=len(self._local))
+
+
+def cache_stats():
+    # Hit/miss counters of this process for every tiered cache alias.
+    return {
+        alias: caches[alias].stats()
+        for alias in caches.settings
+        if isinstance(caches[alias], TieredCache)
+    }
+
+
+_missing = object()
+
+
+class Namespace:
+    # Keys are '<name>:<scope>:<version>:<key>'. invalidate() replaces the
+    # version with a fresh random token instead of incrementing it, so two
+    # workers invalidating at once can never end up agreeing on a version
+    # that one of them has already filled.
+
+    def __init__(self, name, alias='default'):
+        self.name = name
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def shared(self):
+        # Versions always come from the shared tier, never from a worker's
+        # local copy.
+        return getattr(self.cache, 'shared', self.cache)
+
+    def _version_key(self, scope):
+        return f'{self.name}:{scope}:version'
+
+    def version(self, scope=''):
+        key = self._version_key(scope)
+        version = self.shared.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not self.shared.add(key, version, None):
+                version = self.shared.get(key, version)
+        return version
+
+    def make_key(self, key, scope=''):
+        return f'{self.name}:{scope}:{self.version(scope)}:{key}'
+
+    def get_many(self, keys, scope=''):
+        # {key: value} for the keys found; one version lookup for all of them.
+        prefix = self.make_key('', scope)
+        found = self.cache.get_many([prefix + key for key in keys])
+        values = {key: found[prefix + key] for key in keys if prefix + key in found}
+        record_cache(self.name, True, len(values))
+        record_cache(self.name, False, len(keys) - len(values))
+        return values
+
+    def set_many(self, mapping, timeout=DEFAULT_TIMEOUT, scope=''):
+        prefix = self.make_key('', scope)
+        self.cache.set_many({prefix + key: value for key, value in mapping.items()}, timeout)
+
+    def get(self, key, default=None, scope=''):
+        value = self.cache.get(self.make_key(key, scope), _missing)
+        record_cache(self.name, value is not _missing)
+        return default if value is _missing else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, scope=''):
+        self.cache.set(self.make_key(key, scope), value, timeout)
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, scope=''):
+        missed = False
+
+        def compute():
+            nonlocal missed
+            missed = True
+            return default() if callable(default) else default
+
+        value = self.cache.get_or_set(self.make_key(key, scope), compute, timeout)
+        record_cache(self.name, not missed)
+        return value
+
+    # Async counterparts for async views. The backends' a* methods run the
+    # file or database access in a thread.
+
+    async def aversion(self, scope=''):
+        key = self._version_key(scope)
+        version = await self.shared.aget(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not await self.shared.aadd(key, version, None):
+                version = await self.shared.aget(key, version)
+        return version
+
+    async def amake_key(self, key, scope=''):
+        return f'{self.name}:{scope}:{await self.aversion(scope)}:{key}'
+
+    async def aget(self, key, default=None, scope=''):
+        value = await self.cache.aget(await self.amake_key(key, scope), _missing)
+        record_cache(self.name, value is not _missing)
+        return default if value is _missing else value
+
+    async def aset(self, key, value, timeout=DEFAULT_TIMEOUT, scope=''):
+        await self.cache.aset(await self.amake_key(key, scope), value, timeout)
+
+    def invalidate(self, scope=''):
+        self.shared.set(self._version_key(scope), uuid.uuid4().hex, None)
+
+
+PRESETS = Namespace('presets')
+FIRMWARE = Namespace('firmware')
+TEMPLATES = Namespace('templates')
@@ -0,0 +1,72 @@
+# SQLite tuning for several gunicorn workers sharing one database file.
+#
+# WAL lets readers run alongside the single writer, synchronous=NORMAL only
+# syncs at checkpoints (still safe against corruption, a power cut can lose
+# the last commits), busy_timeout makes a blocked writer wait for the lock
+# instead of failing at once and mmap_size serves reads from the page cache.
+#
+# Only the journal mode is stored in the database file itself (and brings
+# the -wal and -shm files along), so it is opt-in through SQLITE_WAL: a
+# checkout's db.sqlite3 stays as committed unless a deployment asks for WAL.
+#
+# busy_timeout does not cover a deferred transaction that reads and then
+# tries to write while another connection holds the lock: SQLite fails that
+# upgrade immediately. retry_on_lock reruns such write transactions.
+
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+
+SQLITE_PRAGMAS = (
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    # connection_created receiver; runs once per new connection, which with
+    # CONN_MAX_AGE is once per worker thread rather than once per request.
+    if connection.vendor != 'sqlite' or not settings.SQLITE_TUNING:
+        return
+    timeout = connection.settings_dict.get('OPTIONS', {}).get('timeout', 5)
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA busy_timeout = {int(timeout * 1000)}')
+        if settings.SQLITE_WAL:
+            cursor.execute('PRAGMA journal_mode = WAL')
+        for pragma, value in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+
+
+def is_lock_error(error):
+    message = str(error)
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def retry_on_lock(func=None, *, attempts=5, delay=0.05, using=None):
+    # Reruns func when SQLite reports the database as locked. func must be a
+    # whole write transaction; inside an outer atomic block a retry cannot
+    # help (the outer transaction is already broken), so the error is raised.
+    if func is None:
+        return functools.partial(retry_on_lock, attempts=attempts, delay=delay, using=using)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if (
+                    not is_lock_error(e)
+                    or attempt == attempts - 1
+                    or transaction.get_connection(using).in_atomic_block
+                ):
+                    raise
+            # Jittered exponential backoff so retrying workers do not collide
+            # again in lockstep.
+            time.sleep(delay * (2 ** attempt) * (0.5 + random.random()))
+
+    return wrapper
@@ -0,0 +1,96 @@
+# Zip export of every preset x board variant for one user.
+# The archive is produced entry by entry and handed out in chunks, so it is
+# never held in memory as a whole; builds fan out over a thread pool.
+
+import zipfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+
+from .firmware_cache import firmware_build, get_firmware_cache
+from .generator import BOARDS, preset_values
+from .models import Preset, Knob
+
+
+class ZipStream:
+    # Write-only, non-seekable file object for zipfile; written bytes are
+    # collected until drained. Without seek() zipfile streams entries with
+    # data descriptors instead of rewriting local headers.
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def buildable(preset, knobs):
+    # A build that fails halfway through the stream would leave the client a
+    # truncated archive, so presets that cannot be rendered (no knobs, or
+    # pins saved before they were limited to the sketches' inputs) are left
+    # out up front.
+    try:
+        preset_values(preset, knobs)
+    except ValueError:
+        return False
+    return True
+
+
+def firmware_jobs(user):
+    # Loads all of the user's presets and knobs in two queries, on the calling
+    # thread, so the pool workers never touch the database.
+    presets = list(Preset.objects.filter(owner=user).order_by('id'))
+    knobs = defaultdict(list)
+    for knob in Knob.objects.filter(preset__owner=user).order_by('id'):
+        knobs[knob.preset_id].append(knob)
+    return [
+        (preset, knobs[preset.id], board)
+        for preset in presets
+        if buildable(preset, knobs[preset.id])
+        for board in BOARDS
+    ]
+
+
+def _build(job):
+    preset, knobs, board = job
+    key, render = firmware_build(preset, board, knobs)
+    path = get_firmware_cache().get_or_build(key, render)
+    with open(path, 'rb') as f:
+        content = f.read()
+    # Arduino wants the sketch inside a folder of the same name.
+    name = f'firmware_preset_{preset.id}_{board}'
+    return f'{name}/{name}.ino', content
+
+
+def iter_firmware_zip(jobs, workers=None):
+    workers = workers or settings.FIRMWARE_EXPORT_WORKERS
+    stream = ZipStream()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            # Keep only a bounded window of builds in flight, in order.
+            jobs = iter(jobs)
+            pending = deque(pool.submit(_build, job) for job in islice(jobs, workers * 2))
+            while pending:
+                arcname, content = pending.popleft().result()
+                job = next(jobs, None)
+                if job is not None:
+                    pending.append(pool.submit(_build, job))
+                archive.writestr(arcname, content)
+                yield from stream.drain()
+        # Closing the archive writes the central directory.
+    yield from stream.drain()
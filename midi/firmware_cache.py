@@ -0,0 +1,140 @@
+# Content-addressed cache for rendered firmware.
+# Artifacts are stored as <sha256>.ino where the hash covers everything that
+# goes into the render (preset fields, ordered knob rows and the template), so
+# identical configurations share one file no matter who owns the preset.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+from .cache import FIRMWARE
+from .generator import DEFAULT_BOARD, get_board, render_preset
+from .metrics import timed_render
+from .models import KNOB_FIELDS
+
+
+# Hits only refresh the file's mtime (our LRU clock) when it is older than this,
+# so hot artifacts do not cost a metadata write on every download.
+TOUCH_INTERVAL = 60
+
+
+def firmware_key(preset, knobs, template_digest):
+    payload = json.dumps({
+        'preset': [preset.name, preset.keys_channel, preset.number_of_knobs],
+        'knobs': [[getattr(knob, field) for field in KNOB_FIELDS] for knob in knobs],
+        'template': template_digest,
+    }, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class FirmwareCache:
+
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.ino')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if now - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except FileNotFoundError:
+                # Evicted by another worker between stat and utime.
+                return None
+        return path
+
+    def put(self, key, content):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        # Write to a temp file and rename so concurrent readers never see a
+        # partially written artifact.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def get_or_build(self, key, build):
+        path = self.get(key)
+        if path is None:
+            path = self.put(key, build())
+        return path
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.ino'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_firmware_cache():
+    return FirmwareCache(settings.FIRMWARE_CACHE_DIR, settings.FIRMWARE_CACHE_MAX_BYTES)
+
+
+def firmware_build(preset, board=DEFAULT_BOARD, knobs=None):
+    # Returns the build key for the preset's current state together with a
+    # callable that renders it, so callers can check the key before rendering.
+    template = get_board(board)
+    if knobs is None:
+        knobs = list(preset.knob_set.order_by('id'))
+    key = firmware_key(preset, knobs, template.digest)
+
+    def render():
+        with timed_render(board):
+            return render_preset(preset, knobs, board)
+
+    return key, render
+
+
+def build_firmware(preset, board=DEFAULT_BOARD):
+    # Returns the path of the cached artifact for the preset's current state,
+    # rendering it only when no identical configuration has been built before.
+    key, render = firmware_build(preset, board)
+    return get_firmware_cache().get_or_build(key, render)
+
+
+def cached_firmware_key(preset, board=DEFAULT_BOARD):
+    # The build key without loading the knobs, memoized per preset state in
+    # the 'firmware' namespace. Knob writes that do not touch preset.updated
+    # invalidate the preset's scope through signals.
+    template = get_board(board)
+    memo_key = f'key:{board}:{template.digest}:{preset.updated.timestamp()}'
+    return FIRMWARE.get_or_set(memo_key, lambda: firmware_build(preset, board)[0], scope=preset.pk)
@@ -3,6 +3,8 @@ from django.forms import ModelForm, BaseModelFormSet, ValidationError
 from .models import Preset, Knob, Joystick, ModWheel, PitchWheel
 from django.contrib.auth.models import User
 from django.forms import modelformset_factory
+from django.utils.functional import cached_property
+from .generator import POT_PINS
 
 
 class UserForm(ModelForm):
@@ -55,13 +57,14 @@ class KnobForm(ModelForm):
             'placeholder': '0-127'
         })
     )
+    # Only the pins the firmware sketches can read (generator.POT_PINS).
     pin = forms.IntegerField(
         label='Pin Number', 
-        min_value=0, 
-        max_value=99,
+        min_value=POT_PINS.start, 
+        max_value=POT_PINS.stop - 1,
         widget=forms.NumberInput(attrs={
             'class': 'form-control',
-            'placeholder': '0-99'
+            'placeholder': f'{POT_PINS.start}-{POT_PINS.stop - 1}'
         })
     )
     
@@ -112,8 +115,8 @@ class KnobForm(ModelForm):
         pin = self.cleaned_data.get('pin')
         if pin is None:
             raise forms.ValidationError('Pin number is required.')
-        if not (0 <= pin <= 99):
-            raise forms.ValidationError('Pin number must be between 0 and 99.')
+        if pin not in POT_PINS:
+            raise forms.ValidationError(f'Pin number must be between {POT_PINS.start} and {POT_PINS.stop - 1}.')
         return pin
 
     def clean(self):
@@ -123,7 +126,39 @@ class KnobForm(ModelForm):
         return cleaned_data
 
 
+class KnobChoiceField(forms.ModelChoiceField):
+    # Resolves the hidden knob id from the formset's already loaded knobs
+    # instead of issuing one SELECT per form.
+    def __init__(self, knobs, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.knobs = knobs
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.knobs[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+
+
 class BaseKnobFormSet(BaseModelFormSet):
+    def add_fields(self, form, index):
+        super().add_fields(form, index)
+        pk_name = self._pk_field.name
+        field = form.fields[pk_name]
+        form.fields[pk_name] = KnobChoiceField(
+            self.knobs_by_pk, field.queryset, initial=field.initial, required=False, widget=field.widget
+        )
+
+    @cached_property
+    def knobs_by_pk(self):
+        return {knob.pk: knob for knob in self.get_queryset()}
+
     def clean(self):
         super().clean()
         seen_cc = set()
@@ -0,0 +1,113 @@
+# Firmware generator for the boards under midi/firmware/.
+# Every <BOARD>/completebuild.ino is parsed once, at import, into a list of
+# literal segments with named injection points in between. Rendering a preset
+# only fills those points in and joins the list, so no regex or str.format
+# ever runs over the full sketch on the request path.
+
+import hashlib
+import re
+from pathlib import Path
+
+
+FIRMWARE_DIR = Path(__file__).resolve().parent / 'firmware'
+TEMPLATE_NAME = 'completebuild.ino'
+DEFAULT_BOARD = 'ATMEGA32U4'
+
+# The analog inputs the sketches can read a pot from.
+POT_PINS = range(16)
+
+# Injection point name -> pattern whose "value" group is replaced on render.
+# The value found in the template is kept as that point's default.
+INJECTION_POINTS = {
+    'N_POTS': r'^const int N_POTS = (?P<value>\d+);',
+    'potPin': r'^int potPin\[N_POTS\] = \{ (?P<value>[^}]*?) \};',
+    'potCC': r'^int potCC\[N_POTS\] = \{ (?P<value>[^}]*?) \};',
+    'channel': r'^const int channel = (?P<value>\d+);',
+    'vel_min': r'^int vel_min = (?P<value>\d+);',
+    'vel_max': r'^int vel_max = (?P<value>\d+);',
+    'potThreshold': r'^byte potThreshold = (?P<value>\d+);',
+    'POT_TIMEOUT': r'^const int POT_TIMEOUT = (?P<value>\d+);',
+}
+
+
+class BoardTemplate:
+
+    def __init__(self, board, source):
+        self.board = board
+        self.digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        self.newline = '\r\n' if '\r\n' in source else '\n'
+        self.defaults = {'header': ''}
+        self.segments = []
+        self.slots = []
+
+        spans = []
+        for name, pattern in INJECTION_POINTS.items():
+            matches = list(re.finditer(pattern, source, re.MULTILINE))
+            if len(matches) != 1:
+                raise ValueError(f'{board}: expected one "{name}" declaration, found {len(matches)}.')
+            match = matches[0]
+            spans.append((match.start('value'), match.end('value'), name))
+            self.defaults[name] = match.group('value')
+        spans.sort()
+
+        # The header is an injection point in front of the whole sketch.
+        self._add_slot('header')
+        position = 0
+        for start, end, name in spans:
+            self.segments.append(source[position:start])
+            self._add_slot(name)
+            position = end
+        self.segments.append(source[position:])
+
+    def _add_slot(self, name):
+        self.slots.append((len(self.segments), name))
+        self.segments.append(self.defaults[name])
+
+    def render(self, values):
+        parts = self.segments.copy()
+        for index, name in self.slots:
+            if name in values:
+                parts[index] = values[name]
+        return ''.join(parts)
+
+
+def load_boards(directory=FIRMWARE_DIR):
+    boards = {}
+    for path in sorted(Path(directory).glob(f'*/{TEMPLATE_NAME}')):
+        # newline='' keeps the sketch's own line endings intact.
+        with open(path, encoding='utf-8', newline='') as f:
+            boards[path.parent.name] = BoardTemplate(path.parent.name, f.read())
+    return boards
+
+
+BOARDS = load_boards()
+
+
+def get_board(board):
+    try:
+        return BOARDS[board]
+    except KeyError:
+        raise ValueError(f'Unknown board "{board}".') from None
+
+
+def preset_values(preset, knobs, newline='\n'):
+    if not knobs:
+        raise ValueError('A preset needs at least one knob to generate firmware.')
+    bad_pins = sorted({knob.pin for knob in knobs if knob.pin not in POT_PINS})
+    if bad_pins:
+        raise ValueError(f"Knob pins must be {POT_PINS.start} to {POT_PINS.stop - 1}, got {', '.join(map(str, bad_pins))}.")
+    # The name ends up in a // comment, so it must stay on one line.
+    name = ' '.join(str(preset.name).split())
+    return {
+        'header': f'// SweetBox SYNTHAGE Firmware{newline}// Preset: {name}{newline}{newline}',
+        'N_POTS': str(len(knobs)),
+        'potPin': ', '.join([str(knob.pin) for knob in knobs]),
+        'potCC': ', '.join([str(knob.CC) for knob in knobs]),
+        # Presets store channels as 1-16, the sketches as 0-15.
+        'channel': str(preset.keys_channel - 1),
+    }
+
+
+def render_preset(preset, knobs, board=DEFAULT_BOARD):
+    template = get_board(board)
+    return template.render(preset_values(preset, knobs, template.newline))
@@ -0,0 +1,166 @@
+# Firmware build queue.
+# Build requests are rows in FirmwareBuild, so their state survives restarts
+# and can be polled from any worker. Identical requests (same build key)
+# coalesce onto one active job. FIRMWARE_BUILD_BACKEND picks who runs them:
+#   'thread'    - a daemon thread inside each web process (default)
+#   'worker'    - a separate local process: manage.py run_firmware_worker
+#   'immediate' - inline on the calling thread, for tests and scripts
+#
+# A job whose process dies (a recycled gunicorn worker, a crash mid-build)
+# would stay active forever and every later request would coalesce onto it.
+# Active jobs untouched for FIRMWARE_BUILD_STALE_AFTER seconds are therefore
+# failed: by enqueue_build when it finds one, and by run_firmware_worker on
+# every poll. Claiming a job stamps updated, so the clock of a running job
+# starts when it starts running.
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .firmware_cache import build_firmware, firmware_build, get_firmware_cache
+from .generator import DEFAULT_BOARD
+from .models import FirmwareBuild
+
+logger = logging.getLogger(__name__)
+
+STALE_ERROR = 'The build was abandoned; request the firmware again.'
+
+
+def stale_before():
+    return timezone.now() - timedelta(seconds=settings.FIRMWARE_BUILD_STALE_AFTER)
+
+
+def expire_stale_jobs(jobs):
+    # Fails the active jobs of the queryset that have not been touched for
+    # FIRMWARE_BUILD_STALE_AFTER seconds. Returns how many there were.
+    return jobs.filter(status__in=FirmwareBuild.ACTIVE, updated__lt=stale_before()).update(
+        status=FirmwareBuild.FAILED, error=STALE_ERROR, updated=timezone.now(),
+    )
+
+
+def enqueue_build(preset, board=DEFAULT_BOARD):
+    # Returns (key, job). job is None when the artifact is already cached.
+    key, _ = firmware_build(preset, board)
+    if get_firmware_cache().get(key):
+        return key, None
+    job = FirmwareBuild.objects.filter(key=key, status__in=FirmwareBuild.ACTIVE).first()
+    if job is not None and job.updated < stale_before():
+        # Lost by a process that died; free the key and queue a new one.
+        expire_stale_jobs(FirmwareBuild.objects.filter(pk=job.pk))
+        job = None
+    if job is None:
+        try:
+            with transaction.atomic():
+                job = FirmwareBuild.objects.create(preset=preset, board=board, key=key)
+        except IntegrityError:
+            # Another request queued the same build in the meantime.
+            job = FirmwareBuild.objects.filter(key=key, status__in=FirmwareBuild.ACTIVE).first()
+            if job is None:
+                return enqueue_build(preset, board)
+        else:
+            get_backend().submit(job.pk)
+    return key, job
+
+
+def run_build(job_id):
+    # Claims the job with a conditional UPDATE, so a job only runs once even
+    # with several workers polling the table.
+    claimed = FirmwareBuild.objects.filter(pk=job_id, status=FirmwareBuild.PENDING).update(
+        status=FirmwareBuild.RUNNING, updated=timezone.now(),
+    )
+    if not claimed:
+        return
+    job = FirmwareBuild.objects.select_related('preset').get(pk=job_id)
+    try:
+        build_firmware(job.preset, job.board)
+    except Exception as e:
+        # ValueError is a preset that cannot be built (e.g. no knobs); the
+        # message is for the user, not a crash worth a traceback.
+        if not isinstance(e, ValueError):
+            logger.exception('Firmware build %s failed', job_id)
+        job.status = FirmwareBuild.FAILED
+        job.error = str(e)
+        job.save(update_fields=['status', 'error', 'updated'])
+    else:
+        job.status = FirmwareBuild.DONE
+        job.save(update_fields=['status', 'updated'])
+
+
+async def await_build(key, job, timeout):
+    # Polls for the artifact; returns its path, or None if it is not ready
+    # within the timeout or the job failed. Sleeps on the event loop, so a
+    # waiting download holds no thread; the cache lookup is a single stat.
+    cache = get_firmware_cache()
+    deadline = time.monotonic() + timeout
+    while True:
+        path = cache.get(key)
+        if path is not None:
+            return path
+        await job.arefresh_from_db(fields=['status', 'error'])
+        if job.status == FirmwareBuild.FAILED or time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(0.05)
+
+
+class ImmediateBackend:
+
+    def submit(self, job_id):
+        run_build(job_id)
+
+
+class ThreadBackend:
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, job_id):
+        self._ensure_thread()
+        # The worker thread has its own connection and must see the row.
+        transaction.on_commit(lambda: self.queue.put(job_id))
+
+    def _ensure_thread(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='firmware-builds', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            job_id = self.queue.get()
+            close_old_connections()
+            try:
+                run_build(job_id)
+            except Exception:
+                logger.exception('Firmware build %s crashed', job_id)
+
+
+class WorkerBackend:
+    # Jobs stay pending in the table until run_firmware_worker picks them up.
+
+    def submit(self, job_id):
+        pass
+
+
+BACKENDS = {
+    'immediate': ImmediateBackend,
+    'thread': ThreadBackend,
+    'worker': WorkerBackend,
+}
+
+_backends = {}
+
+
+def get_backend():
+    name = settings.FIRMWARE_BUILD_BACKEND
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
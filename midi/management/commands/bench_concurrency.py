@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import SUPPRESS
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from midi.services import build_preset
+
+MODES = {
+    # The settings this project shipped with: rollback journal, a new
+    # connection per request.
+    'off': {'SQLITE_TUNING': '0', 'CONN_MAX_AGE': '0'},
+    'on': {'SQLITE_TUNING': '1', 'SQLITE_WAL': '1', 'CONN_MAX_AGE': '600'},
+}
+
+OPERATIONS = ('portal_save', 'create_preset')
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammers portal saves and create_preset from several worker processes "
+        "against a temporary copy of the schema, with and without the SQLite tuning."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes (default: 4).')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds each worker runs (default: 10).')
+        parser.add_argument('--mode', choices=['on', 'off', 'both'], default='both')
+        # Internal: set when the command runs as one of the workers.
+        parser.add_argument('--worker', type=int, help=SUPPRESS)
+        parser.add_argument('--start-at', type=float, help=SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker'] is not None:
+            return self.run_worker(options['worker'], options['start_at'], options['duration'])
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        modes = ['off', 'on'] if options['mode'] == 'both' else [options['mode']]
+        for mode in modes:
+            results = self.run_mode(mode, options['workers'], options['duration'])
+            self.report(mode, results, options['duration'])
+
+    def run_mode(self, mode, workers, duration):
+        directory = tempfile.mkdtemp(prefix='sweetbox-bench-')
+        # Database and metrics store both live in the temporary directory.
+        env = dict(
+            os.environ,
+            SQLITE_PATH=os.path.join(directory, 'bench.sqlite3'),
+            METRICS_PATH=os.path.join(directory, 'metrics.sqlite3'),
+            DJANGO_CACHE_BACKEND='locmem',
+            **MODES[mode],
+        )
+        manage = [sys.executable, str(settings.BASE_DIR / 'manage.py')]
+        try:
+            subprocess.run(manage + ['migrate', '--noinput', '-v', '0'], env=env, check=True)
+            # Workers set themselves up first and then start together.
+            start_at = time.time() + 3
+            procs = [
+                subprocess.Popen(
+                    manage + ['bench_concurrency', '--worker', str(i), '--start-at', str(start_at), '--duration', str(duration)],
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                )
+                for i in range(workers)
+            ]
+            results = []
+            for proc in procs:
+                out, _ = proc.communicate()
+                if proc.returncode:
+                    raise CommandError(f'A {mode} worker exited with status {proc.returncode}.')
+                results.append(json.loads(out))
+            return results
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def report(self, mode, results, duration):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'SQLite tuning {mode}, {len(results)} workers, {duration:g}s'))
+        for op in OPERATIONS:
+            latencies = sorted(l for r in results for l in r[op]['latencies'])
+            errors = sum(r[op]['errors'] for r in results)
+            if not latencies:
+                self.stdout.write(f'  {op:<14} no requests')
+                continue
+            p50 = latencies[len(latencies) // 2] * 1000
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000
+            self.stdout.write(
+                f'  {op:<14} {len(latencies) / duration:8.1f} req/s   '
+                f'p50 {p50:7.1f} ms   p95 {p95:7.1f} ms   errors {errors}'
+            )
+
+    def run_worker(self, index, start_at, duration):
+        # Failed requests are counted, not logged.
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        user = User.objects.create_user(f'bench{index}', password='bench')
+        preset = build_preset(owner=user, name='Bench', number_of_knobs=16)
+        rows = list(preset.knob_set.order_by('id').values('id', 'channel', 'CC', 'min', 'max', 'pin'))
+        client = Client(raise_request_exception=False)
+        client.force_login(user)
+        portal_url = f"{reverse('portal')}?preset={preset.id}"
+        create_url = reverse('create_preset')
+        results = {op: {'latencies': [], 'errors': 0} for op in OPERATIONS}
+
+        time.sleep(max(0, start_at - time.time()))
+        deadline = time.monotonic() + duration
+        n = 0
+        while time.monotonic() < deadline:
+            op = OPERATIONS[n % 2]
+            if op == 'portal_save':
+                rows[n % len(rows)]['max'] = 100 + n % 27
+                data = portal_data(rows, preset.keys_channel, preset.name)
+                started = time.perf_counter()
+                response = client.post(portal_url, data)
+            else:
+                data = {'name': f'Bench {index}-{n}', 'keys_channel': 1, 'number_of_knobs': 4}
+                started = time.perf_counter()
+                response = client.post(create_url, data)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                results[op]['errors'] += 1
+            else:
+                results[op]['latencies'].append(elapsed)
+            n += 1
+        self.stdout.write(json.dumps(results))
+
+
+def portal_data(rows, keys_channel, name):
+    data = {
+        'form-TOTAL_FORMS': len(rows),
+        'form-INITIAL_FORMS': len(rows),
+        'form-MIN_NUM_FORMS': 1,
+        'form-MAX_NUM_FORMS': 16,
+        'midi_channel': keys_channel,
+        'preset_name': name,
+    }
+    for i, row in enumerate(rows):
+        for field, value in row.items():
+            data[f'form-{i}-{field}'] = value
+    return data
@@ -0,0 +1,61 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from midi import sysex
+
+
+class Command(BaseCommand):
+    help = (
+        "Encodes synthetic presets to SysEx in batches and decodes the stream "
+        "back, reporting presets per second against a target rate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--presets', type=int, default=100_000, help='Presets to encode (default: 100000).')
+        parser.add_argument('--batch', type=int, default=10_000, help='Presets per encode_batch call (default: 10000).')
+        parser.add_argument('--knobs', type=int, default=16, help='Knobs per preset, 0 for a random mix (default: 16).')
+        parser.add_argument('--chunk', type=int, default=4096, help='Bytes per decoder feed (default: 4096).')
+        parser.add_argument('--target', type=float, default=100_000, help='Encode rate to meet in presets/s (default: 100000).')
+
+    def handle(self, *args, **options):
+        total, batch, knobs = options['presets'], options['batch'], options['knobs']
+        if total < 1 or batch < 1:
+            raise CommandError('--presets and --batch must be at least 1.')
+        if not 0 <= knobs <= 16:
+            raise CommandError('--knobs must be between 0 and 16.')
+        rng = random.Random(0)
+        presets = [
+            (
+                rng.randint(1, 16),
+                [tuple(rng.randrange(128) for _ in range(5)) for _ in range(knobs or rng.randint(1, 16))],
+            )
+            for _ in range(total)
+        ]
+
+        # Slots are 14 bits, so batches restart at slot 0 like a fresh device.
+        started = time.perf_counter()
+        stream = b''.join(sysex.encode_batch(presets[i:i + batch]) for i in range(0, total, batch))
+        encode_time = time.perf_counter() - started
+
+        decoder = sysex.SysExDecoder()
+        chunk = options['chunk']
+        started = time.perf_counter()
+        decoded = 0
+        for i in range(0, len(stream), chunk):
+            decoded += len(decoder.feed(stream[i:i + chunk]))
+        decode_time = time.perf_counter() - started
+        if decoded != total or decoder.dropped:
+            raise CommandError(f'Decoded {decoded} of {total} presets, {decoder.dropped} dropped.')
+
+        encode_rate = total / encode_time
+        self.stdout.write(
+            f'encode {encode_rate:10.0f} presets/s   {len(stream) / encode_time / 1e6:6.1f} MB/s   '
+            f'({total} presets, {len(stream)} bytes, batches of {batch})'
+        )
+        self.stdout.write(f'decode {total / decode_time:10.0f} presets/s')
+        if encode_rate >= options['target']:
+            self.stdout.write(self.style.SUCCESS(f"Encoding meets the {options['target']:g} presets/s target."))
+        else:
+            self.stdout.write(self.style.WARNING(f"Encoding is below the {options['target']:g} presets/s target."))
@@ -0,0 +1,251 @@
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import SUPPRESS
+from statistics import mean, median
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from midi.forms import KnobFormSet
+from midi.generator import BOARDS, render_preset
+from midi.management.commands.bench_concurrency import portal_data
+from midi.models import KNOB_FIELDS
+from midi.services import build_preset, create_presets, default_knobs
+
+SIZES = (1, 100, 10_000)
+# A temporary database in the shipped configuration, with a per-process
+# cache so nothing outside the temporary directory is touched (run_worker
+# puts the database and the metrics store there).
+ENVIRONMENT = {
+    'DATABASE_ENGINE': 'sqlite',
+    'DJANGO_CACHE_BACKEND': 'locmem',
+    'FIRMWARE_BUILD_BACKEND': 'immediate',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Times firmware rendering, the portal, the dashboard, preset creation and "
+        "knob formset validation with 1, 100 and 10000 presets per user, against a "
+        "temporary SQLite database. Writes JSON and compares it with a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Presets per user (default: 1 100 10000).')
+        parser.add_argument('--repeat', type=int, default=10, help='Timed runs of each benchmark (default: 10).')
+        parser.add_argument('--only', nargs='+', metavar='NAME', help='Run only these benchmarks.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', metavar='BASELINE', help='JSON from an earlier --output to compare with.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Allowed slowdown of the median against the baseline, as a fraction (default: 0.25).',
+        )
+        # Internal: set when the command runs inside the temporary database.
+        parser.add_argument('--worker', action='store_true', help=SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1 or min(options['sizes']) < 1:
+            raise CommandError('--repeat and --sizes must be at least 1.')
+        if options['tolerance'] < 0:
+            raise CommandError('--tolerance cannot be negative.')
+        unknown = set(options['only'] or ()) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}. Choose from {', '.join(BENCHMARKS)}.")
+        if options['worker']:
+            results = run_benchmarks(options['sizes'], options['repeat'], options['only'] or list(BENCHMARKS))
+            self.stdout.write(json.dumps(results))
+            return
+
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read the baseline {options['compare']}: {e}")
+
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'machine': platform.machine(),
+                'created': timezone.now().isoformat(),
+                'repeat': options['repeat'],
+            },
+            'results': self.run_worker(options),
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+                f.write('\n')
+
+        rows = compare(report['results'], baseline['results'] if baseline else {}, options['tolerance'])
+        self.stdout.write(f"{'benchmark':<32} {'median ms':>10} {'p95 ms':>10} {'ops/s':>10} {'baseline':>10} {'change':>8}")
+        regressions = []
+        for row in rows:
+            line = (
+                f"{row['key']:<32} {row['median_ms']:10.3f} {row['p95_ms']:10.3f} {row['ops_per_sec']:10.1f} "
+                + (f"{row['baseline_ms']:10.3f} {row['change']:+8.0%}" if 'baseline_ms' in row else f"{'-':>10} {'-':>8}")
+            )
+            if row.get('regressed'):
+                regressions.append(row['key'])
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+        if regressions:
+            raise CommandError(
+                f"{len(regressions)} benchmark(s) are more than {options['tolerance']:.0%} slower than the baseline: "
+                + ', '.join(regressions)
+            )
+
+    def run_worker(self, options):
+        directory = tempfile.mkdtemp(prefix='sweetbox-benchmark-')
+        path = os.path.join(directory, 'benchmark.sqlite3')
+        env = dict(
+            os.environ,
+            SQLITE_PATH=path,
+            SQLITE_REPLICA_PATH=path,
+            METRICS_PATH=os.path.join(directory, 'metrics.sqlite3'),
+            **ENVIRONMENT,
+        )
+        manage = [sys.executable, str(settings.BASE_DIR / 'manage.py')]
+        command = manage + ['benchmark', '--worker', '--repeat', str(options['repeat']), '--sizes', *map(str, options['sizes'])]
+        if options['only']:
+            command += ['--only', *options['only']]
+        try:
+            subprocess.run(manage + ['migrate', '--noinput', '-v', '0'], env=env, check=True)
+            proc = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True)
+            if proc.returncode:
+                raise CommandError(f'The benchmark worker exited with status {proc.returncode}.')
+            return json.loads(proc.stdout)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    # results, baseline: {key: stats}. Returns one row per result with the
+    # baseline median and relative change where the baseline has the key.
+    rows = []
+    for key, stats in results.items():
+        row = dict(stats, key=key)
+        if key in baseline:
+            before = baseline[key]['median_ms']
+            row['baseline_ms'] = before
+            row['change'] = stats['median_ms'] / before - 1 if before else 0.0
+            row['regressed'] = row['change'] > tolerance
+        rows.append(row)
+    return rows
+
+
+def measure(func, repeat):
+    func()  # warm up caches and connections
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'median_ms': median(timings),
+        'mean_ms': mean(timings),
+        'min_ms': timings[0],
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'ops_per_sec': 1000 / mean(timings),
+    }
+
+
+def check(response, status):
+    if response.status_code != status:
+        raise CommandError(f'{response.request["PATH_INFO"]} answered {response.status_code}, expected {status}.')
+
+
+class Fixture:
+    # A user with `size` presets; the one the benchmarks work on has 16 knobs.
+
+    def __init__(self, size):
+        self.user = User.objects.create_user(f'benchmark{size}', password='benchmark')
+        create_presets(self.user, [
+            {'name': f'Preset {i}', 'keys_channel': 1 + i % 16, 'knobs': default_knobs(4)}
+            for i in range(size - 1)
+        ])
+        self.preset = build_preset(owner=self.user, name='Benchmark', keys_channel=1, number_of_knobs=16)
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.portal_url = f"{reverse('portal')}?preset={self.preset.id}"
+        self.rows = list(self.preset.knob_set.order_by('id').values('id', *KNOB_FIELDS))
+        self.saves = 0
+
+
+def render_firmware(board):
+    def bench(fixture):
+        knobs = list(fixture.preset.knob_set.order_by('id'))
+        return lambda: render_preset(fixture.preset, knobs, board)
+    return bench
+
+
+def portal_get(fixture):
+    return lambda: check(fixture.client.get(fixture.portal_url), 200)
+
+
+def portal_post(fixture):
+    def run():
+        # A different value every time, so every POST writes.
+        fixture.saves += 1
+        fixture.rows[0]['max'] = 100 + fixture.saves % 27
+        data = portal_data(fixture.rows, fixture.preset.keys_channel, fixture.preset.name)
+        check(fixture.client.post(fixture.portal_url, data), 302)
+    return run
+
+
+def dashboard(fixture):
+    url = reverse('dashboard')
+    return lambda: check(fixture.client.get(url), 200)
+
+
+def create_preset(fixture):
+    url = reverse('create_preset')
+    data = {'name': 'Created', 'keys_channel': 1, 'number_of_knobs': 4}
+    return lambda: check(fixture.client.post(url, data), 302)
+
+
+def formset_clean(fixture):
+    data = portal_data(fixture.rows, fixture.preset.keys_channel, fixture.preset.name)
+
+    def run():
+        formset = KnobFormSet(data, queryset=fixture.preset.knob_set.order_by('id'))
+        if not formset.is_valid():
+            raise CommandError(f'The benchmark formset is invalid: {formset.errors}')
+    return run
+
+
+BENCHMARKS = {
+    **{f'render_firmware[{board}]': render_firmware(board) for board in BOARDS},
+    'portal_get': portal_get,
+    'portal_post': portal_post,
+    'dashboard': dashboard,
+    'create_preset': create_preset,
+    'formset_clean': formset_clean,
+}
+
+
+def run_benchmarks(sizes, repeat, names):
+    results = {}
+    for size in sizes:
+        fixture = Fixture(size)
+        # create_preset adds presets, so it runs last for each size.
+        for name in sorted(names, key=lambda name: name == 'create_preset'):
+            stats = measure(BENCHMARKS[name](fixture), repeat)
+            results[f'{name}@{size}'] = dict(stats, name=name, size=size)
+    return results
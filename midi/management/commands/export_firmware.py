@@ -0,0 +1,25 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from midi.export import firmware_jobs, iter_firmware_zip
+
+
+class Command(BaseCommand):
+    help = "Writes a zip with every preset of a user built for every board."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('-o', '--output', help='Zip file to write (default: <username>_firmware.zip).')
+        parser.add_argument('--workers', type=int, help='Render threads (default: FIRMWARE_EXPORT_WORKERS).')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'User "{options["username"]}" does not exist.')
+        jobs = firmware_jobs(user)
+        output = options['output'] or f'{user.username}_firmware.zip'
+        with open(output, 'wb') as f:
+            for chunk in iter_firmware_zip(jobs, options['workers']):
+                f.write(chunk)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {len(jobs)} firmware files to {output}'))
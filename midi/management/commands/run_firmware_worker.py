@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from midi.jobs import expire_stale_jobs, run_build
+from midi.models import FirmwareBuild
+
+
+class Command(BaseCommand):
+    help = "Runs queued firmware builds (FIRMWARE_BUILD_BACKEND = 'worker')."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit.')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            # Builds left running by a worker that died.
+            expire_stale_jobs(FirmwareBuild.objects.filter(status=FirmwareBuild.RUNNING))
+            job_ids = list(
+                FirmwareBuild.objects.filter(status=FirmwareBuild.PENDING)
+                .order_by('created')
+                .values_list('pk', flat=True)[:50]
+            )
+            for job_id in job_ids:
+                run_build(job_id)
+            if options['once'] and not job_ids:
+                return
+            if not job_ids:
+                time.sleep(options['interval'])
@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from midi import simulator
+from midi.generator import BOARDS, DEFAULT_BOARD
+from midi.models import Preset
+
+
+class Command(BaseCommand):
+    help = (
+        "Plays synthetic scan frames through the firmware's key matrix and pot "
+        "loop for a preset (or the sketch defaults) and summarises the MIDI it sends."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--preset', type=int, help='Preset id; the sketch defaults when omitted.')
+        parser.add_argument('--board', choices=sorted(BOARDS), default=DEFAULT_BOARD)
+        parser.add_argument('--seconds', type=float, default=600, help='Virtual seconds per recording (default: 600).')
+        parser.add_argument('--recordings', type=int, default=1, help='Recordings run together (default: 1).')
+        parser.add_argument('--scan-ms', type=int, default=2, help='Milliseconds per pass of loop() (default: 2).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if simulator.np is None:
+            raise CommandError('The firmware simulator needs NumPy: pip install numpy')
+        if options['preset'] is None:
+            config = simulator.FirmwareConfig.for_board(options['board'])
+        else:
+            preset = Preset.objects.filter(id=options['preset']).first()
+            if preset is None:
+                raise CommandError(f"Preset {options['preset']} does not exist.")
+            knobs = list(preset.knob_set.order_by('id'))
+            try:
+                config = simulator.FirmwareConfig.for_preset(preset, knobs, options['board'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        recordings = [
+            simulator.synthetic_recording(options['seconds'], scan_ms=options['scan_ms'], seed=options['seed'] + i)
+            for i in range(options['recordings'])
+        ]
+        started = time.perf_counter()
+        results = simulator.Simulator(config).run_many(recordings)
+        elapsed = time.perf_counter() - started
+
+        virtual = sum(recording.duration for recording in recordings) / 1000
+        kinds = (('note on', simulator.NOTE_ON), ('note off', simulator.NOTE_OFF), ('control change', simulator.CONTROL_CHANGE))
+        for kind, status in kinds:
+            count = sum(int((events['status'] & 0xF0 == status).sum()) for events in results)
+            self.stdout.write(f'  {kind:<15} {count:8d}')
+        frames = sum(len(recording) for recording in recordings)
+        self.stdout.write(
+            f'{virtual:.0f} virtual seconds ({frames} frames) in {elapsed:.2f}s: '
+            f'{virtual / elapsed:.0f} virtual seconds per second'
+        )
+
@@ -0,0 +1,274 @@
+# Request, database, cache and firmware render metrics in Prometheus format.
+#
+# Every process aggregates into REGISTRY in memory: counters and cumulative
+# histogram buckets, which add up across processes. Every
+# METRICS_FLUSH_INTERVAL seconds (checked as requests finish, and at exit)
+# a process adds what it gathered to the SQLite file at METRICS_PATH in one
+# transaction, so all gunicorn workers on the host share one set of totals
+# without Redis or a push gateway. GET /metrics flushes the serving process
+# and renders the file.
+#
+# The store is a plain sqlite3 file, not a Django database: metrics writes
+# never compete with the application's own write lock, and migrations do not
+# apply to it.
+
+import atexit
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+RENDER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# name -> (type, help, histogram buckets)
+FAMILIES = {
+    'sweetbox_http_requests_total': ('counter', 'Requests by view, method and status code.', None),
+    'sweetbox_http_request_duration_seconds': (
+        'histogram', 'Time until the view returned its response, by view.', LATENCY_BUCKETS,
+    ),
+    'sweetbox_db_queries_per_request': ('histogram', 'Database queries per request, by view.', QUERY_BUCKETS),
+    'sweetbox_db_query_duration_seconds_total': ('counter', 'Time spent in database queries, by view.', None),
+    'sweetbox_cache_requests_total': ('counter', 'Cache namespace lookups by namespace and result.', None),
+    'sweetbox_firmware_render_duration_seconds': (
+        'histogram', 'Time to render one firmware sketch, by board.', RENDER_BUCKETS,
+    ),
+}
+
+UNMATCHED = '<unmatched>'
+
+
+def label_string(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Registry:
+    # Samples are keyed (family, suffix, labels, le); le is '' except for
+    # histogram buckets.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(float)
+        self.pid = os.getpid()
+        self.flushed_at = time.monotonic()
+
+    def _take(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked after recording: those samples belong to the parent.
+                self.samples.clear()
+                self.pid = os.getpid()
+            samples, self.samples = self.samples, defaultdict(float)
+            self.flushed_at = time.monotonic()
+        return samples
+
+    def inc(self, family, labels, value=1):
+        with self.lock:
+            self.samples[family, '', label_string(labels), ''] += value
+
+    def observe(self, family, labels, value):
+        buckets = FAMILIES[family][2]
+        labels = label_string(labels)
+        with self.lock:
+            # Every bucket, even an empty one: Prometheus expects all of them.
+            for bound in buckets:
+                self.samples[family, '_bucket', labels, format_bound(bound)] += value <= bound
+            self.samples[family, '_bucket', labels, '+Inf'] += 1
+            self.samples[family, '_sum', labels, ''] += value
+            self.samples[family, '_count', labels, ''] += 1
+
+    def flush_due(self):
+        return time.monotonic() - self.flushed_at >= settings.METRICS_FLUSH_INTERVAL
+
+    def maybe_flush(self):
+        if self.flush_due():
+            self.flush()
+
+    def flush(self):
+        samples = self._take()
+        if not samples:
+            return
+        try:
+            MetricsStore(settings.METRICS_PATH).add(samples)
+        except sqlite3.Error:
+            # Keep them for the next attempt rather than lose them.
+            with self.lock:
+                for key, value in samples.items():
+                    self.samples[key] += value
+
+    def reset(self):
+        self._take()
+
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.flush)
+
+
+class MetricsStore:
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS samples ('
+            ' family TEXT, suffix TEXT, labels TEXT, le TEXT, value REAL,'
+            ' PRIMARY KEY (family, suffix, labels, le))'
+        )
+        return connection
+
+    def add(self, samples):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO samples VALUES (?, ?, ?, ?, ?)'
+                    ' ON CONFLICT (family, suffix, labels, le) DO UPDATE SET value = value + excluded.value',
+                    [(*key, value) for key, value in samples.items()],
+                )
+        finally:
+            connection.close()
+
+    def rows(self):
+        connection = self.connect()
+        try:
+            return connection.execute('SELECT family, suffix, labels, le, value FROM samples').fetchall()
+        finally:
+            connection.close()
+
+
+def sample_order(row):
+    family, suffix, labels, le, value = row
+    # Buckets in ascending order, then _sum and _count, per label set.
+    return (family, labels, ('_bucket', '_sum', '_count', '').index(suffix), float(le or 0))
+
+
+def render(rows):
+    lines = []
+    current = None
+    for family, suffix, labels, le, value in sorted(rows, key=sample_order):
+        if family not in FAMILIES:
+            continue
+        if family != current:
+            kind, help_text, _ = FAMILIES[family]
+            lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {kind}']
+            current = family
+        if le:
+            labels = f'{labels},le="{le}"' if labels else f'le="{le}"'
+        value = int(value) if value == int(value) else value
+        lines.append(f'{family}{suffix}{{{labels}}} {value}' if labels else f'{family}{suffix} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+# Database time of the current request. A context variable, so queries run
+# by async views in sync_to_async threads are counted too.
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'query_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+
+
+def time_query(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_time += time.perf_counter() - started
+
+
+def install_query_timer(sender, connection, **kwargs):
+    # connection_created receiver: every connection carries the wrapper for
+    # its whole life, it only measures while a request is being recorded.
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def record_cache(namespace, hit, count=1):
+    if count:
+        REGISTRY.inc('sweetbox_cache_requests_total', {'namespace': namespace, 'result': 'hit' if hit else 'miss'}, count)
+
+
+class timed_render:
+    # with timed_render(board): render...
+
+    def __init__(self, board):
+        self.board = board
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        REGISTRY.observe('sweetbox_firmware_render_duration_seconds', {'board': self.board}, time.perf_counter() - self.started)
+        REGISTRY.maybe_flush()
+
+
+class MetricsMiddleware:
+    # Goes first in MIDDLEWARE, so the latency covers the whole stack. For
+    # streamed responses it ends when the view returns, not when the last
+    # chunk is sent.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        REGISTRY.maybe_flush()
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        if REGISTRY.flush_due():
+            # The SQLite write stays off the event loop.
+            await sync_to_async(REGISTRY.flush, thread_sensitive=False)()
+        return response
+
+    def record(self, request, response, stats, duration):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else UNMATCHED
+        REGISTRY.inc('sweetbox_http_requests_total', {'view': view, 'method': request.method, 'status': response.status_code})
+        REGISTRY.observe('sweetbox_http_request_duration_seconds', {'view': view}, duration)
+        REGISTRY.observe('sweetbox_db_queries_per_request', {'view': view}, stats.queries)
+        REGISTRY.inc('sweetbox_db_query_duration_seconds_total', {'view': view}, stats.query_time)
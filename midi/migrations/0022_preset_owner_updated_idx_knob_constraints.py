@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('midi', '0021_alter_knob_pin_alter_preset_updated'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='preset',
+            index=models.Index(fields=['owner', '-updated'], name='preset_owner_updated_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='knob',
+            constraint=models.UniqueConstraint(fields=('preset', 'CC'), name='unique_knob_cc_per_preset'),
+        ),
+        migrations.AddConstraint(
+            model_name='knob',
+            constraint=models.UniqueConstraint(fields=('preset', 'pin'), name='unique_knob_pin_per_preset'),
+        ),
+    ]
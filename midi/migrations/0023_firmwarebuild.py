@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('midi', '0022_preset_owner_updated_idx_knob_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirmwareBuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(max_length=32)),
+                ('key', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('preset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='midi.preset')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created'], name='firmwarebuild_status_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='firmwarebuild',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running'])), fields=('key',), name='unique_active_firmware_build'),
+        ),
+    ]
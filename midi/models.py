@@ -12,6 +12,12 @@ class Preset(models.Model):
 
     objects = models.Manager()
 
+    class Meta:
+        indexes = [
+            # portal and dashboard list a user's presets newest first.
+            models.Index(fields=['owner', '-updated'], name='preset_owner_updated_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -29,10 +35,92 @@ class Knob(models.Model):
 
     objects = models.Manager()
 
+    class Meta:
+        # Mirrors BaseKnobFormSet.clean. The (preset, pin) constraint's unique
+        # index also serves every Knob.objects.filter(preset=...) lookup.
+        constraints = [
+            models.UniqueConstraint(fields=['preset', 'CC'], name='unique_knob_cc_per_preset'),
+            models.UniqueConstraint(fields=['preset', 'pin'], name='unique_knob_pin_per_preset'),
+        ]
+
     # def __init__(self, *args, **kwargs):
     #     super().__init__(*args, **kwargs)
 
 
+# The per-knob settings a user edits, in form/firmware order.
+KNOB_FIELDS = ('channel', 'CC', 'min', 'max', 'pin')
+
+
+
+# Queued firmware builds, see midi/jobs.py
+class FirmwareBuild(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    ACTIVE = (PENDING, RUNNING)
+
+    preset = models.ForeignKey(Preset, on_delete=models.CASCADE)
+    board = models.CharField(max_length=32)
+    key = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created'], name='firmwarebuild_status_idx'),
+        ]
+        constraints = [
+            # Identical build requests coalesce onto one active job.
+            models.UniqueConstraint(
+                fields=['key'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_firmware_build',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.preset} ({self.board}): {self.status}'
+
+
+# Request profiles, see midi/profiling.py. A ring buffer of the newest
+# PROFILE_KEEP, read in the admin.
+class RequestProfile(models.Model):
+    MANUAL = 'manual'
+    SLOW = 'slow'
+    TRIGGER_CHOICES = [
+        (MANUAL, 'Requested by staff'),
+        (SLOW, 'Slow request'),
+    ]
+
+    created = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    method = models.CharField(max_length=8)
+    path = models.CharField(max_length=255)
+    view = models.CharField(max_length=100, blank=True)
+    status = models.PositiveSmallIntegerField()
+    trigger = models.CharField(max_length=8, choices=TRIGGER_CHOICES)
+    duration_ms = models.FloatField()
+    query_count = models.PositiveIntegerField()
+    query_time_ms = models.FloatField()
+    profile = models.TextField()
+    sql = models.TextField()
+
+    objects = models.Manager()
+
+    def __str__(self):
+        return f'{self.method} {self.path} ({self.duration_ms:.0f} ms)'
+
 
 class Joystick(models.Model):
     preset = models.ForeignKey(Preset, on_delete=models.CASCADE, null=True)
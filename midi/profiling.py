@@ -0,0 +1,258 @@
+# Per-request profiles for staff, and automatic capture of slow requests.
+#
+# A staff user adds "X-Profile: 1" (or ?_profile=1) to a request and it runs
+# under cProfile. Independently, every request is watched by one sampler
+# thread per process: once a request has run for PROFILE_SLOW_REQUEST_MS, the
+# sampler reads its thread's stack every PROFILE_SAMPLE_INTERVAL seconds until
+# it finishes. Either way the request's SQL is logged and the result is
+# stored as a RequestProfile, the newest PROFILE_KEEP of which are kept.
+#
+# The SQL log holds statements with their placeholders, never parameters:
+# those include session keys, password hashes and whatever users typed, and
+# every staff user can read the profiles.
+#
+# Requests that are neither flagged nor slow cost a dict insert and removal
+# and one list append per query; the sampler sleeps until the oldest request
+# in flight reaches the threshold.
+
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+
+from .decorators import aget_user
+from .models import RequestProfile
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = '_profile'
+MAX_STACK_DEPTH = 64
+REPORT_LINES = 60
+
+_capture = contextvars.ContextVar('profile_capture', default=None)
+
+
+class Capture:
+    # What is recorded about one request: its SQL always, stack samples once
+    # sample_from (a time.monotonic() value) has passed.
+
+    def __init__(self, thread_id, sample_from):
+        self.thread_id = thread_id
+        self.sample_from = sample_from
+        self.started = time.perf_counter()
+        self.duration = None
+        self.sample_delay = max(0.0, sample_from - time.monotonic()) if sample_from is not None else 0.0
+        self.stacks = Counter()
+        self.queries = []
+        self.query_count = 0
+        self.query_time = 0.0
+
+    def add_query(self, sql, duration):
+        self.query_count += 1
+        self.query_time += duration
+        if len(self.queries) < settings.PROFILE_MAX_QUERIES:
+            self.queries.append((duration, sql))
+
+    def add_sample(self, frame):
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{code.co_qualname}')
+            frame = frame.f_back
+        # Root first, as flame graph tools read it.
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def sample_report(self):
+        total = sum(self.stacks.values())
+        lines = [
+            f'{total} samples every {settings.PROFILE_SAMPLE_INTERVAL * 1000:g} ms, '
+            f'starting {self.sample_delay * 1000:.0f} ms into the request.',
+            'Collapsed stacks, most frequent first:',
+        ]
+        lines += [f'{stack} {count}' for stack, count in self.stacks.most_common(REPORT_LINES)]
+        return '\n'.join(lines)
+
+    def sql_report(self):
+        lines = [f'{self.query_count} queries, {self.query_time * 1000:.1f} ms']
+        if self.query_count > len(self.queries):
+            lines.append(f'(only the first {len(self.queries)} are listed)')
+        for duration, sql in self.queries:
+            lines.append(f'{duration * 1000:8.2f} ms  {sql}')
+        return '\n'.join(lines)
+
+
+def capture_query(execute, sql, params, many, context):
+    capture = _capture.get()
+    if capture is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        capture.add_query(sql, time.perf_counter() - started)
+
+
+def install_query_capture(sender, connection, **kwargs):
+    # connection_created receiver, like metrics.install_query_timer.
+    if capture_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(capture_query)
+
+
+class Sampler:
+    # One daemon thread per process, started by the first request it
+    # watches (after any fork, so gunicorn --preload is fine).
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.active = set()
+        self.wake_at = float('inf')
+        self.pid = None
+
+    def watch(self, capture):
+        with self.cond:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.active.clear()
+                threading.Thread(target=self.run, name='request-sampler', daemon=True).start()
+            self.active.add(capture)
+            if capture.sample_from < self.wake_at:
+                self.cond.notify()
+
+    def unwatch(self, capture):
+        # Holding the lock means no sample lands after this returns.
+        with self.cond:
+            self.active.discard(capture)
+
+    def run(self):
+        interval = settings.PROFILE_SAMPLE_INTERVAL
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                due = [capture for capture in self.active if capture.sample_from <= now]
+                if due:
+                    frames = sys._current_frames()
+                    for capture in due:
+                        capture.add_sample(frames.get(capture.thread_id))
+                    del frames
+                    self.wake_at = now + interval
+                else:
+                    self.wake_at = min((capture.sample_from for capture in self.active), default=float('inf'))
+                    self.cond.wait(None if self.wake_at == float('inf') else self.wake_at - now)
+                    continue
+            time.sleep(interval)
+
+
+SAMPLER = Sampler()
+
+
+def flagged(request):
+    return PROFILE_HEADER in request.headers or PROFILE_PARAM in request.GET
+
+
+def cprofile_report(profiler):
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats('cumulative').print_stats(REPORT_LINES)
+    return stream.getvalue().strip()
+
+
+def save_profile(request, response, capture, trigger, profile):
+    match = request.resolver_match
+    user = getattr(request, 'user', None)
+    try:
+        saved = RequestProfile.objects.create(
+            user=user if user is not None and user.is_authenticated else None,
+            method=request.method,
+            path=request.get_full_path()[:255],
+            view=(match.url_name or match.view_name or '') if match else '',
+            status=response.status_code,
+            trigger=trigger,
+            duration_ms=capture.duration * 1000,
+            query_count=capture.query_count,
+            query_time_ms=capture.query_time * 1000,
+            profile=profile,
+            sql=capture.sql_report(),
+        )
+        # Ring buffer: drop everything older than the newest PROFILE_KEEP.
+        RequestProfile.objects.filter(id__lte=saved.id - settings.PROFILE_KEEP).delete()
+    except DatabaseError:
+        logger.exception('Could not store the profile of %s', request.path)
+
+
+class ProfilingMiddleware:
+    # Goes after AuthenticationMiddleware, which the staff check needs.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def slow_after(self):
+        threshold = settings.PROFILE_SLOW_REQUEST_MS
+        return time.monotonic() + threshold / 1000 if threshold else None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        manual = flagged(request) and request.user.is_staff
+        sample_from = self.slow_after()
+        if not manual and sample_from is None:
+            return self.get_response(request)
+
+        capture = Capture(threading.get_ident(), sample_from)
+        token = _capture.set(capture)
+        try:
+            if manual:
+                profiler = cProfile.Profile()
+                response = profiler.runcall(self.get_response, request)
+            else:
+                SAMPLER.watch(capture)
+                try:
+                    response = self.get_response(request)
+                finally:
+                    SAMPLER.unwatch(capture)
+        finally:
+            _capture.reset(token)
+        capture.duration = time.perf_counter() - capture.started
+
+        if manual:
+            save_profile(request, response, capture, RequestProfile.MANUAL, cprofile_report(profiler))
+        elif capture.stacks:
+            save_profile(request, response, capture, RequestProfile.SLOW, capture.sample_report())
+        return response
+
+    async def __acall__(self, request):
+        # cProfile would also trace the other tasks on the event loop, so a
+        # flagged async request is sampled from its start instead. Only the
+        # loop thread is sampled, not sync_to_async threads.
+        manual = flagged(request) and (await aget_user(request)).is_staff
+        sample_from = time.monotonic() if manual else self.slow_after()
+        if sample_from is None:
+            return await self.get_response(request)
+
+        capture = Capture(threading.get_ident(), sample_from)
+        token = _capture.set(capture)
+        SAMPLER.watch(capture)
+        try:
+            response = await self.get_response(request)
+        finally:
+            SAMPLER.unwatch(capture)
+            _capture.reset(token)
+        capture.duration = time.perf_counter() - capture.started
+
+        if manual or capture.stacks:
+            trigger = RequestProfile.MANUAL if manual else RequestProfile.SLOW
+            await sync_to_async(save_profile)(request, response, capture, trigger, capture.sample_report())
+        return response
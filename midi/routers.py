@@ -0,0 +1,136 @@
+# Primary/replica routing.
+#
+# Writes always go to 'default'. Reads go to the 'replica' alias only while
+# ReplicaMiddleware has marked the current request as read-only: a GET or
+# HEAD of one of settings.DATABASE_REPLICA_VIEWS from a client that has not
+# written recently. The flag is a context variable, so it follows the request
+# through async code and never leaks into the firmware build threads.
+#
+# Sessions and the firmware job queue are read from the primary regardless:
+# a session written at login and a job queued a moment ago must be visible on
+# the very next read, replication lag or not.
+
+import contextvars
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+REPLICA = 'replica'
+
+PRIMARY_ONLY = {
+    ('sessions', 'session'),
+    ('midi', 'firmwarebuild'),
+}
+
+_read_replica = contextvars.ContextVar('read_replica', default=False)
+
+
+def replica_available():
+    return REPLICA in connections.settings
+
+
+class use_replica:
+    # Routes reads inside the block to the replica, e.g.
+    #   with use_replica():
+    #       presets = list(Preset.objects.filter(owner=user))
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        self.token = _read_replica.set(self.enabled)
+
+    def __exit__(self, *exc_info):
+        _read_replica.reset(self.token)
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if not _read_replica.get() or not replica_available():
+            return 'default'
+        if (model._meta.app_label, model._meta.model_name) in PRIMARY_ONLY:
+            return 'default'
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+PIN_COOKIE = 'db_primary_pin'
+
+
+class ReplicaMiddleware:
+    # After a successful write the client is pinned to the primary for
+    # DATABASE_REPLICA_PIN_SECONDS (a cookie), so the page it is redirected to
+    # shows its own change even if the replica is behind.
+    # Works in both sync and async chains, so async views under ASGI do not
+    # pay a thread hop for it.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.views = set(settings.DATABASE_REPLICA_VIEWS)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # The handler would otherwise run the sync hook in a thread.
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Every request starts on the primary; process_view flips the flag
+        # for the views that qualify.
+        token = _read_replica.set(False)
+        try:
+            response = self.get_response(request)
+        finally:
+            _read_replica.reset(token)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        token = _read_replica.set(False)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _read_replica.reset(token)
+        return self.process_response(request, response)
+
+    def process_response(self, request, response):
+        if (
+            request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and response.status_code < 400
+            and replica_available()
+        ):
+            response.set_cookie(
+                PIN_COOKIE,
+                '1',
+                max_age=settings.DATABASE_REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.reads_replica(request):
+            _read_replica.set(True)
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if self.reads_replica(request):
+            _read_replica.set(True)
+
+    def reads_replica(self, request):
+        return (
+            request.method in ('GET', 'HEAD')
+            and request.resolver_match.url_name in self.views
+            and PIN_COOKIE not in request.COOKIES
+        )
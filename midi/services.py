@@ -0,0 +1,265 @@
+# Preset construction and knob updates shared by every path that writes
+# presets (create_preset, the default preset, portal saves, cloning, imports).
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import FIRMWARE, PRESETS
+from .db import retry_on_lock
+from .models import KNOB_FIELDS, Preset, Knob
+
+
+def default_knobs(number_of_knobs):
+    return [
+        {'channel': 1, 'CC': i, 'min': 0, 'max': 127, 'pin': i}
+        for i in range(number_of_knobs)
+    ]
+
+
+@retry_on_lock
+def build_preset(owner, name, keys_channel=1, number_of_knobs=4, knobs=None):
+    # Creates the preset and all of its knobs in one transaction: a single
+    # INSERT for the preset and a single bulk INSERT for the knobs.
+    if knobs is None:
+        knobs = default_knobs(number_of_knobs)
+    with transaction.atomic():
+        preset = Preset.objects.create(
+            owner=owner,
+            name=name,
+            keys_channel=keys_channel,
+            number_of_knobs=len(knobs),
+        )
+        Knob.objects.bulk_create([Knob(preset=preset, **knob) for knob in knobs])
+    return preset
+
+
+@retry_on_lock
+def create_presets(owner, specs):
+    # Bulk variant of build_preset for imports and the API. specs are dicts
+    # with name, keys_channel and a list of knob dicts. Where the backend
+    # returns primary keys from bulk inserts (PostgreSQL, SQLite 3.35+) any
+    # number of presets costs two INSERTs.
+    presets = [
+        Preset(owner=owner, name=spec['name'], keys_channel=spec['keys_channel'], number_of_knobs=len(spec['knobs']))
+        for spec in specs
+    ]
+    with transaction.atomic():
+        if transaction.get_connection().features.can_return_rows_from_bulk_insert:
+            Preset.objects.bulk_create(presets)
+        else:
+            for preset in presets:
+                preset.save()
+        Knob.objects.bulk_create([
+            Knob(preset=preset, **knob)
+            for preset, spec in zip(presets, specs)
+            for knob in spec['knobs']
+        ])
+        # bulk_create sends no post_save.
+        schedule_dashboard_refresh(owner.pk)
+    return presets
+
+
+def clone_preset(preset, owner=None, name=None):
+    knobs = list(preset.knob_set.order_by('id').values('channel', 'CC', 'min', 'max', 'pin'))
+    return build_preset(
+        owner=owner or preset.owner,
+        name=name or preset.name,
+        keys_channel=preset.keys_channel,
+        knobs=knobs,
+    )
+
+
+def knob_values(knobs):
+    # Snapshot of the stored values, taken before a form or payload mutates
+    # the instances.
+    return {knob.pk: {field: getattr(knob, field) for field in KNOB_FIELDS} for knob in knobs}
+
+
+def save_knobs(preset, stored, rows, **preset_fields):
+    # Applies the submitted knob rows as a diff against the stored ones.
+    #   stored: {pk: {field: value}} as returned by knob_values().
+    #   rows:   dicts of KNOB_FIELDS with an optional 'id' and 'DELETE' flag.
+    # Unchanged knobs are not written. The rest is one batched DELETE, one
+    # bulk_update of just the changed columns, one bulk_create and one UPDATE
+    # of the preset, all in a single transaction. None of the knob writes
+    # send signals; the preset's save does the cache bookkeeping for all of
+    # them. Returns whether anything was written.
+    to_delete = []
+    to_create = []
+    to_update = []
+    changed_fields = set()
+    previous = {}
+    kept = 0
+
+    for row in rows:
+        pk = row.get('id')
+        if row.get('DELETE'):
+            if pk in stored:
+                to_delete.append(pk)
+            continue
+        kept += 1
+        values = {field: row[field] for field in KNOB_FIELDS}
+        if pk not in stored:
+            to_create.append(Knob(preset=preset, **values))
+            continue
+        changed = [field for field in KNOB_FIELDS if stored[pk][field] != values[field]]
+        if changed:
+            to_update.append(Knob(pk=pk, preset=preset, **values))
+            changed_fields.update(changed)
+            previous[pk] = stored[pk]
+
+    preset_fields['number_of_knobs'] = kept
+    preset_changed = [field for field, value in preset_fields.items() if getattr(preset, field) != value]
+    if not (to_delete or to_create or to_update or preset_changed):
+        return False
+
+    # Everything up to here is computed once; only the transaction itself is
+    # rerun if SQLite reports the database as locked.
+    _write_knob_diff(preset, to_delete, to_update, changed_fields, previous, to_create, preset_fields, preset_changed)
+    return True
+
+
+@retry_on_lock
+def _write_knob_diff(preset, to_delete, to_update, changed_fields, previous, to_create, preset_fields, preset_changed):
+    with transaction.atomic():
+        if to_delete:
+            # A plain DELETE: QuerySet.delete() would first SELECT the rows
+            # to send post_delete for each of them. Nothing references knobs.
+            knobs = Knob.objects.filter(preset=preset, pk__in=to_delete)
+            knobs._raw_delete(knobs.db)
+        if to_update:
+            if _needs_parking(to_update, previous, changed_fields):
+                _park(to_update, changed_fields)
+            Knob.objects.bulk_update(to_update, sorted(changed_fields))
+        if to_create:
+            Knob.objects.bulk_create(to_create)
+        for field in preset_changed:
+            setattr(preset, field, preset_fields[field])
+        preset.save(update_fields=preset_changed + ['updated'])
+
+
+def _needs_parking(to_update, previous, changed_fields):
+    # A single UPDATE is checked row by row, so moving a CC or pin onto a
+    # value another updated knob still holds (e.g. swapping two CCs) would
+    # trip the unique constraints.
+    for field in changed_fields & {'CC', 'pin'}:
+        old = {previous[knob.pk][field] for knob in to_update}
+        if any(getattr(knob, field) in old and getattr(knob, field) != previous[knob.pk][field] for knob in to_update):
+            return True
+    return False
+
+
+def _park(to_update, changed_fields):
+    # Moves the updated knobs to values outside every valid range first.
+    fields = sorted(changed_fields & {'CC', 'pin'})
+    final = [{field: getattr(knob, field) for field in fields} for knob in to_update]
+    for i, knob in enumerate(to_update):
+        if 'CC' in fields:
+            knob.CC = 1000 + i
+        if 'pin' in fields:
+            knob.pin = -1 - i
+    Knob.objects.bulk_update(to_update, fields)
+    for knob, values in zip(to_update, final):
+        for field, value in values.items():
+            setattr(knob, field, value)
+
+
+PROVISIONED_SESSION_KEY = 'default_preset_provisioned'
+
+
+def provision_default_preset(user, session=None):
+    # Gives a user the 'Default' preset if they have none. The outcome is
+    # remembered in the session so later requests skip the query entirely.
+    if session is not None and session.get(PROVISIONED_SESSION_KEY):
+        return
+    if not Preset.objects.filter(owner=user).exists():
+        build_preset(owner=user, name='Default', keys_channel=1, number_of_knobs=4)
+    if session is not None:
+        session[PROVISIONED_SESSION_KEY] = True
+
+
+# Dashboard summaries are cached per user in the 'presets' namespace. Writes
+# to a user's presets or knobs bump the user's namespace version and store
+# the new summaries once the transaction commits (see signals.py), so every
+# worker drops its copy and the dashboard visit that follows a save is
+# already a cache hit.
+
+SUMMARY_FIELDS = ('id', 'name', 'number_of_knobs', 'keys_channel', 'created', 'updated')
+
+
+def preset_summaries(owner_id):
+    return list(
+        Preset.objects.filter(owner_id=owner_id)
+        .order_by('-updated')
+        .values(*SUMMARY_FIELDS)
+    )
+
+
+async def adashboard_presets(user):
+    summaries = await PRESETS.aget('dashboard', scope=user.pk)
+    if summaries is None:
+        summaries = [
+            summary
+            async for summary in Preset.objects.filter(owner_id=user.pk)
+            .order_by('-updated')
+            .values(*SUMMARY_FIELDS)
+        ]
+        await PRESETS.aset('dashboard', summaries, settings.DASHBOARD_CACHE_TIMEOUT, scope=user.pk)
+    return summaries
+
+
+def refresh_dashboard(owner_id):
+    PRESETS.invalidate(scope=owner_id)
+    PRESETS.set('dashboard', preset_summaries(owner_id), settings.DASHBOARD_CACHE_TIMEOUT, scope=owner_id)
+
+
+def schedule_dashboard_refresh(owner_id):
+    # A save can touch many rows of the same user; only one refresh per user
+    # is queued per transaction. Pending callbacks are dropped on rollback,
+    # so nothing is left behind when the write does not go through.
+    if owner_id is None:
+        return
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        for _, func, *_ in connection.run_on_commit:
+            # Callbacks stay listed after captureOnCommitCallbacks runs them.
+            if getattr(func, 'dashboard_owner', None) == owner_id and not func.ran:
+                return
+
+    def refresh():
+        refresh.ran = True
+        refresh_dashboard(owner_id)
+
+    refresh.dashboard_owner = owner_id
+    refresh.ran = False
+    transaction.on_commit(refresh)
+
+
+def schedule_firmware_invalidation(preset_id):
+    # Drops the preset's memoized build keys in every worker once the write
+    # is visible to them.
+    transaction.on_commit(lambda: FIRMWARE.invalidate(scope=preset_id))
+
+
+def touch_preset(preset_id):
+    # For knobs written one at a time (the admin, a shell): moves
+    # Preset.updated, which cached fragments, ETags and build keys follow,
+    # and schedules what a save of the preset would. Deleting many knobs in
+    # one transaction costs one UPDATE and one SELECT per preset, not per row.
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        for _, func, *_ in connection.run_on_commit:
+            # Callbacks stay listed after captureOnCommitCallbacks runs them.
+            if getattr(func, 'touched_preset', None) == preset_id and not func.ran:
+                return
+    Preset.objects.filter(pk=preset_id).update(updated=timezone.now())
+    schedule_dashboard_refresh(Preset.objects.filter(pk=preset_id).values_list('owner_id', flat=True).first())
+
+    def invalidate():
+        invalidate.ran = True
+        FIRMWARE.invalidate(scope=preset_id)
+
+    invalidate.touched_preset = preset_id
+    invalidate.ran = False
+    transaction.on_commit(invalidate)
@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .db import configure_sqlite
+from .metrics import install_query_timer
+from .profiling import install_query_capture
+from .models import Knob, Preset
+from .services import provision_default_preset, schedule_dashboard_refresh, schedule_firmware_invalidation, touch_preset
+
+
+connection_created.connect(configure_sqlite, dispatch_uid='midi.configure_sqlite')
+connection_created.connect(install_query_timer, dispatch_uid='midi.install_query_timer')
+connection_created.connect(install_query_capture, dispatch_uid='midi.install_query_capture')
+
+
+@receiver(post_save, sender=User)
+def provision_new_user(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        provision_default_preset(instance)
+
+
+@receiver(user_logged_in)
+def provision_on_login(sender, request, user, **kwargs):
+    # Covers accounts that predate the post_save hook.
+    provision_default_preset(user, request.session)
+
+
+@receiver(post_save, sender=Preset)
+@receiver(post_delete, sender=Preset)
+def refresh_dashboard_for_preset(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_dashboard_refresh(instance.owner_id)
+        schedule_firmware_invalidation(instance.pk)
+
+
+@receiver(post_save, sender=Knob)
+@receiver(post_delete, sender=Knob)
+def refresh_dashboard_for_knob(sender, instance, raw=False, origin=None, **kwargs):
+    # Knobs removed by deleting their preset are covered by the preset's
+    # own signal; save_knobs writes knobs without sending signals.
+    if raw or isinstance(origin, Preset) or instance.preset_id is None:
+        return
+    touch_preset(instance.preset_id)
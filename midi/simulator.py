@@ -0,0 +1,479 @@
+# Offline simulator of the firmware scan loop (midi/firmware/*/completebuild.ino).
+#
+# Replays scan frames, the contact and ADC readings loop() would see on each
+# pass, through the sketch's key matrix and pot state machines and returns the
+# MIDI events the board would send. Velocity curves and knob configurations
+# can so be checked in CI without flashing anything.
+#
+# Every key and every pot is an independent state machine, and one only
+# changes state on a frame where its inputs changed or on the frame after
+# (a released key resynchronises its previous-state latches one pass later).
+# The simulator therefore gathers, per key, just those frames and advances
+# all keys together, one step per relevant frame, as NumPy arrays; quiet
+# stretches of a recording cost nothing. Pots, whose readings change on
+# every frame while they turn, are solved a movement at a time instead (see
+# _pot_sends). Several recordings run in the same pass with run_many().
+#
+# Modelled as in the sketch, quirks included:
+#   - velocity from the KPS/KPE closing times, constrain()ed to
+#     vel_min..vel_max and map()ed to 10..127 with integer arithmetic;
+#   - note offs carry the velocity of the last note on of any key;
+#   - a key re-pressed on the pass right after its release is ignored until
+#     its contacts open again;
+#   - pots send a CC only while moving: potThreshold and POT_TIMEOUT.
+# Not modelled: the commented-out pitch/mod wheel code and the delay(5) after
+# a sustain change (frame times come from the recording).
+#
+# NumPy is optional and only needed here (requirements-dev.txt).
+
+from .generator import DEFAULT_BOARD, get_board, preset_values
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ROWS = COLS = 8
+KEYS = ROWS * COLS
+MUX_CHANNELS = 16
+FIRST_NOTE = 24  # nums[0][0], C1
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+SUSTAIN_CC = 64
+
+# Differences between the sketches that are not injection points.
+BOARD_QUIRKS = {
+    # noteOn(0, ...) and noteOff(0, ...) ignore the channel setting.
+    'ATMEGA32U4': {'note_channel': 0},
+    # nums[x][y] + transpose, map(potState, 0, 1023, 127, 0), and the pots
+    # and pedal are read after every column of keys, not after the matrix.
+    'RP2040': {'transpose': 12, 'invert_pots': True, 'pots_each_column': True},
+    'ESP32_USB': {},
+}
+
+EVENT_FIELDS = [('time', 'i8'), ('frame', 'i8'), ('status', 'u1'), ('data1', 'u1'), ('data2', 'u1')]
+# While simulating: which recording an event belongs to and its position
+# within the pass of loop() that sent it.
+LANE_EVENT_FIELDS = EVENT_FIELDS + [('run', 'i8'), ('order', 'i8')]
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('The firmware simulator needs NumPy: pip install numpy')
+
+
+def arduino_map(x, in_min, in_max, out_min, out_max):
+    # Arduino's map(): long arithmetic, division truncating towards zero.
+    numerator = (np.asarray(x, dtype=np.int64) - in_min) * (out_max - out_min)
+    denominator = in_max - in_min
+    quotient = np.abs(numerator) // abs(denominator)
+    return np.where((numerator < 0) != (denominator < 0), -quotient, quotient) + out_min
+
+
+class FirmwareConfig:
+
+    def __init__(self, pot_pins, pot_ccs, channel=0, vel_min=0, vel_max=50, pot_threshold=15,
+                 pot_timeout=300, note_channel=None, transpose=0, invert_pots=False, pots_each_column=False):
+        if len(pot_pins) != len(pot_ccs):
+            raise ValueError('Every pot needs both a pin and a CC number.')
+        if not all(0 <= pin < MUX_CHANNELS for pin in pot_pins):
+            raise ValueError(f'Pot pins are mux channels 0 to {MUX_CHANNELS - 1}.')
+        if pot_timeout <= 0:
+            raise ValueError('POT_TIMEOUT must be positive.')
+        if vel_min >= vel_max:
+            # map(vel, vel_max, vel_min, ...) would divide by zero on the board.
+            raise ValueError('vel_min must be below vel_max.')
+        self.pot_pins = list(pot_pins)
+        self.pot_ccs = list(pot_ccs)
+        self.channel = channel
+        self.vel_min = vel_min
+        self.vel_max = vel_max
+        self.pot_threshold = pot_threshold
+        self.pot_timeout = pot_timeout
+        self.note_channel = channel if note_channel is None else note_channel
+        self.transpose = transpose
+        self.invert_pots = invert_pots
+        self.pots_each_column = pots_each_column
+
+    @classmethod
+    def for_board(cls, board=DEFAULT_BOARD, values=None):
+        # values: injection point overrides as rendered into the sketch,
+        # e.g. preset_values(); the rest are the template's own settings.
+        template = get_board(board)
+        settings = dict(template.defaults, **(values or {}))
+
+        def numbers(name):
+            return [int(value) for value in settings[name].split(',') if value.strip()]
+
+        return cls(
+            pot_pins=numbers('potPin'),
+            pot_ccs=numbers('potCC'),
+            channel=int(settings['channel']),
+            vel_min=int(settings['vel_min']),
+            vel_max=int(settings['vel_max']),
+            pot_threshold=int(settings['potThreshold']),
+            pot_timeout=int(settings['POT_TIMEOUT']),
+            **BOARD_QUIRKS.get(board, {}),
+        )
+
+    @classmethod
+    def for_preset(cls, preset, knobs, board=DEFAULT_BOARD):
+        return cls.for_board(board, preset_values(preset, knobs))
+
+
+class Recording:
+    # times: (T,) millis() of each pass of loop(), non-decreasing.
+    # kps, kpe: (T, 8, 8) bool, contact closed, indexed [row x][column y] like
+    #   the sketch's kps[x][y].
+    # analog: (T, 16) ints 0-1023, what analogRead() returns on each mux 3
+    #   channel; only the channels in potPin are read.
+    # sustain: (T,) bool, pedal down.
+    # Missing inputs are all open / zero.
+
+    def __init__(self, times, kps=None, kpe=None, analog=None, sustain=None):
+        require_numpy()
+        self.times = np.asarray(times, dtype=np.int64)
+        frames = len(self.times)
+        if not frames:
+            raise ValueError('A recording needs at least one frame.')
+        if np.any(np.diff(self.times) < 0):
+            raise ValueError('Frame times must not decrease.')
+        self.kps = self._input(kps, (frames, ROWS, COLS), bool)
+        self.kpe = self._input(kpe, (frames, ROWS, COLS), bool)
+        self.analog = self._input(analog, (frames, MUX_CHANNELS), np.int64)
+        self.sustain = self._input(sustain, (frames,), bool)
+
+    @staticmethod
+    def _input(values, shape, dtype):
+        if values is None:
+            return np.zeros(shape, dtype=dtype)
+        values = np.asarray(values, dtype=dtype)
+        if values.shape != shape:
+            raise ValueError(f'Expected an input of shape {shape}, got {values.shape}.')
+        return values
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self):
+        return int(self.times[-1] - self.times[0])
+
+
+def _schedule(relevant):
+    # relevant: (T, lanes) bool. Returns (frames, valid), both (steps, lanes):
+    # the n-th relevant frame of every lane, shorter lanes padded.
+    lane, frame = np.nonzero(np.ascontiguousarray(relevant.T))
+    counts = np.bincount(lane, minlength=relevant.shape[1])
+    steps = counts.max(initial=0)
+    step = np.arange(len(lane)) - (np.cumsum(counts) - counts)[lane]
+    frames = np.zeros((steps, relevant.shape[1]), dtype=np.int64)
+    valid = np.zeros((steps, relevant.shape[1]), dtype=bool)
+    frames[step, lane] = frame
+    valid[step, lane] = True
+    return frames, valid
+
+
+def _changed(values):
+    # values: (T, lanes). True where a lane differs from the previous frame,
+    # the first frame compared with the power-on zeros.
+    changed = np.empty(values.shape, dtype=bool)
+    changed[0] = values[0] != 0
+    np.not_equal(values[1:], values[:-1], out=changed[1:])
+    return changed
+
+
+def _first_beyond(values, start, center, threshold):
+    # First index from start on whose value differs from center by more than
+    # threshold, or None. Searches in growing chunks, so a long quiet stretch
+    # costs a few array operations rather than one per frame.
+    size = 256
+    while start < len(values):
+        hits = np.flatnonzero(np.abs(values[start:start + size] - center) > threshold)
+        if len(hits):
+            return start + hits[0]
+        start += size
+        size *= 2
+    return None
+
+
+def _pot_sends(reading, midi, times, threshold, timeout):
+    # Frames on which one pot sends its CC. While the pot is moving, i.e.
+    # within POT_TIMEOUT of the last jump above potThreshold, the sketch
+    # takes every reading, so a CC goes out whenever the mapped value
+    # changes. Once it times out it holds the last reading until one differs
+    # from that by more than potThreshold. Each phase ends at a point found
+    # with a search over the arrays, so the cost follows the number of
+    # movements, not the number of frames.
+    # Index 0 is the power-on state: reading 0, nothing sent, moved at 0 ms.
+    reading = np.concatenate(([0], reading))
+    midi = np.concatenate(([0], midi))
+    times = np.concatenate(([0], times))
+    size = len(reading)
+    jump = np.empty(size, dtype=bool)
+    jump[0] = True
+    np.greater(np.abs(np.diff(reading)), threshold, out=jump[1:])
+    # While moving, a jump is measured against the previous frame.
+    last_jump = np.maximum.accumulate(np.where(jump, times, 0))
+    quiet = np.flatnonzero(times - last_jump >= timeout)
+
+    moving = np.zeros(size + 1, dtype=np.int64)
+    entered = []
+    entry = held = 0
+    while True:
+        # The entry frame jumped, so it is in the window; the last value sent
+        # is that of the last frame taken before.
+        if entry and midi[entry] != midi[held]:
+            entered.append(entry)
+        start = max(entry + 1, np.searchsorted(times, times[entry] + timeout))
+        position = np.searchsorted(quiet, start)
+        leave = quiet[position] if position < len(quiet) else size
+        moving[entry + 1] += 1
+        moving[leave] -= 1
+        if leave == size:
+            break
+        held = leave - 1
+        entry = _first_beyond(reading, leave, reading[held], threshold)
+        if entry is None:
+            break
+    sends = np.cumsum(moving[:size]) > 0
+    sends[1:] &= midi[1:] != midi[:-1]
+    sends[entered] = True
+    # Back to frame numbers of the recording.
+    return np.flatnonzero(sends) - 1
+
+
+def _merge(schedules):
+    # Lays the per-recording schedules side by side, with frame numbers
+    # offset into the concatenated recordings.
+    steps = max((frames.shape[0] for frames, _, _ in schedules), default=0)
+    frames = np.zeros((steps, sum(f.shape[1] for f, _, _ in schedules)), dtype=np.int64)
+    valid = np.zeros(frames.shape, dtype=bool)
+    column = 0
+    for lane_frames, lane_valid, offset in schedules:
+        width = lane_frames.shape[1]
+        frames[:len(lane_frames), column:column + width] = lane_frames + offset
+        valid[:len(lane_valid), column:column + width] = lane_valid
+        column += width
+    return frames, valid
+
+
+class Simulator:
+
+    def __init__(self, config):
+        require_numpy()
+        self.config = config
+
+    def run(self, recording):
+        return self.run_many([recording])[0]
+
+    def run_many(self, recordings):
+        # Returns one structured array of events per recording (EVENT_FIELDS),
+        # in the order the board sends them.
+        if not recordings:
+            return []
+        offsets = np.cumsum([0] + [len(r) for r in recordings])
+        times = np.concatenate([r.times for r in recordings])
+        keys = self._keys(recordings, offsets, times)
+        pots = self._pots(recordings, offsets, times)
+        sustain = self._sustain(recordings, offsets, times)
+        events = []
+        for index in range(len(recordings)):
+            parts = [part[part['run'] == index] for part in (keys, pots, sustain)]
+            events.append(self._order(np.concatenate(parts), offsets[index]))
+        return events
+
+    def _keys(self, recordings, offsets, times):
+        # Lanes are (recording, key) in scan order: key = y * 8 + x.
+        schedules = []
+        flat = []
+        for recording, offset in zip(recordings, offsets):
+            # Columns outer, rows inner, like the sketch's nested loops.
+            kps = recording.kps.transpose(0, 2, 1).reshape(-1, KEYS)
+            kpe = recording.kpe.transpose(0, 2, 1).reshape(-1, KEYS)
+            flat.append((kps, kpe))
+            changed = _changed(kps) | _changed(kpe)
+            changed[1:] |= changed[:-1].copy()
+            schedules.append((*_schedule(changed), offset))
+        frames, valid = _merge(schedules)
+        lanes = frames.shape[1]
+        key = np.tile(np.arange(KEYS), len(recordings))
+        kps_all = np.concatenate([kps for kps, _ in flat])
+        kpe_all = np.concatenate([kpe for _, kpe in flat])
+        s_in = kps_all[frames, key]
+        e_in = kpe_all[frames, key]
+        now_in = times[frames]
+
+        config = self.config
+        p_s = np.zeros(lanes, dtype=bool)
+        p_e = np.zeros(lanes, dtype=bool)
+        kps = np.zeros(lanes, dtype=bool)
+        kpe = np.zeros(lanes, dtype=bool)
+        timer_s = np.zeros(lanes, dtype=np.int64)
+        timer_e = np.zeros(lanes, dtype=np.int64)
+        not_ready = np.zeros(lanes, dtype=bool)
+        note_on = np.zeros(frames.shape, dtype=bool)
+        note_off = np.zeros(frames.shape, dtype=bool)
+        travel = np.zeros(frames.shape, dtype=np.int64)
+
+        for step in range(frames.shape[0]):
+            s, e, now, active = s_in[step], e_in[step], now_in[step], valid[step]
+            ready = active & ~not_ready
+            edge = ready & (s != p_s)
+            timer_s = np.where(edge, np.where(s, now, 0), timer_s)
+            kps = np.where(edge, s, kps)
+            p_s = np.where(edge, s, p_s)
+            edge = ready & (e != p_e)
+            timer_e = np.where(edge, np.where(e, now, 0), timer_e)
+            kpe = np.where(edge, e, kpe)
+            p_e = np.where(edge, e, p_e)
+            pressed = ready & kps & kpe
+            not_ready |= pressed
+            note_on[step] = pressed
+            travel[step] = np.abs(timer_e - timer_s)
+            # Held keys are re-read without touching the latches; both
+            # contacts open is the release.
+            held = active & not_ready
+            kps = np.where(held, s, kps)
+            kpe = np.where(held, e, kpe)
+            released = held & ~s & ~e
+            not_ready &= ~released
+            note_off[step] = released
+
+        vel = np.clip(travel, config.vel_min, config.vel_max)
+        velocity = arduino_map(vel, config.vel_max, config.vel_min, 10, 127)
+        note = FIRST_NOTE + ROWS * (key % ROWS) + key // ROWS + config.transpose
+        run = np.repeat(np.arange(len(recordings)), KEYS)
+        on_step, on_lane = np.nonzero(note_on)
+        off_step, off_lane = np.nonzero(note_off)
+        return np.concatenate([
+            self._events(
+                run[on_lane], frames[on_step, on_lane], times, self._key_order(key[on_lane]),
+                NOTE_ON | config.note_channel & 0x0F, note[on_lane], velocity[on_step, on_lane],
+            ),
+            # The release velocity is filled in by _order().
+            self._events(
+                run[off_lane], frames[off_step, off_lane], times, self._key_order(key[off_lane]),
+                NOTE_OFF | config.note_channel & 0x0F, note[off_lane], 0,
+            ),
+        ])
+
+    def _key_order(self, key):
+        return key // ROWS * 32 + key % ROWS
+
+    def _control_order(self, slot):
+        # slot: pot index, or 16 for the pedal. Read after the last column of
+        # keys, or on RP2040 already after the first one.
+        column = 0 if self.config.pots_each_column else COLS - 1
+        return column * 32 + ROWS + slot
+
+    def _pots(self, recordings, offsets, times):
+        config = self.config
+        parts = []
+        for index, (recording, offset) in enumerate(zip(recordings, offsets)):
+            frame_times = recording.times
+            for slot, (pin, cc) in enumerate(zip(config.pot_pins, config.pot_ccs)):
+                reading = recording.analog[:, pin]
+                if config.invert_pots:
+                    midi = arduino_map(reading, 0, 1023, 127, 0)
+                else:
+                    midi = arduino_map(reading, 0, 1023, 0, 127)
+                frame = _pot_sends(reading, midi, frame_times, config.pot_threshold, config.pot_timeout)
+                parts.append(self._events(
+                    index, frame + offset, times, self._control_order(slot),
+                    CONTROL_CHANGE | config.channel & 0x0F, cc, midi[frame],
+                ))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=LANE_EVENT_FIELDS)
+
+    def _sustain(self, recordings, offsets, times):
+        parts = []
+        for index, (recording, offset) in enumerate(zip(recordings, offsets)):
+            [frame] = np.nonzero(_changed(recording.sustain))
+            parts.append(self._events(
+                index, frame + offset, times, self._control_order(MUX_CHANNELS),
+                CONTROL_CHANGE | self.config.channel & 0x0F, SUSTAIN_CC, recording.sustain[frame] * 127,
+            ))
+        return np.concatenate(parts)
+
+    @staticmethod
+    def _events(run, frame, times, order, status, data1, data2):
+        frame = np.asarray(frame, dtype=np.int64)
+        events = np.zeros(len(frame), dtype=LANE_EVENT_FIELDS)
+        events['run'] = run
+        events['order'] = order
+        events['frame'] = frame
+        events['time'] = times[frame]
+        events['status'] = status
+        events['data1'] = data1
+        events['data2'] = data2
+        return events
+
+    @staticmethod
+    def _order(events, offset):
+        events = events[np.lexsort((events['order'], events['frame']))]
+        # noteOff(..., velocity) sends the global velocity: the last note on
+        # sent by any key, 0 before the first.
+        is_on = events['status'] & 0xF0 == NOTE_ON
+        last_on = np.maximum.accumulate(np.where(is_on, np.arange(len(events)), -1)) if len(events) else is_on
+        release = np.where(last_on >= 0, events['data2'][np.maximum(last_on, 0)], 0)
+        is_off = events['status'] & 0xF0 == NOTE_OFF
+        result = np.zeros(len(events), dtype=EVENT_FIELDS)
+        for name, _ in EVENT_FIELDS:
+            result[name] = events[name]
+        result['frame'] -= offset
+        result['data2'] = np.where(is_off, release, events['data2'])
+        return result
+
+
+def messages(events):
+    # Events as (time, bytes) pairs, the raw MIDI messages.
+    return [(int(event['time']), bytes((event['status'], event['data1'], event['data2']))) for event in events]
+
+
+def synthetic_recording(seconds, scan_ms=2, notes_per_second=8, pot_moves_per_second=1, pedal_per_second=0.1, seed=0):
+    # Random playing: keys pressed with 1-60 ms between the two contacts and
+    # held 30-600 ms, pots swept between random positions, the pedal toggled.
+    require_numpy()
+    rng = np.random.default_rng(seed)
+    frames = max(1, int(seconds * 1000 // scan_ms))
+    times = np.arange(frames, dtype=np.int64) * scan_ms
+    span = frames * scan_ms
+
+    def frame_of(ms):
+        return np.minimum(np.ceil(ms / scan_ms).astype(np.int64), frames)
+
+    def contact(key, closes, opens):
+        delta = np.zeros((frames + 1, KEYS), dtype=np.int16)
+        np.add.at(delta, (frame_of(closes), key), 1)
+        np.add.at(delta, (frame_of(opens), key), -1)
+        # Overlapping presses of one key just merge.
+        return np.cumsum(delta[:-1], axis=0) > 0
+
+    notes = rng.poisson(notes_per_second * seconds)
+    key = rng.integers(0, KEYS, notes)
+    start = rng.uniform(0, span, notes)
+    travel = rng.uniform(1, 60, notes)
+    hold = rng.uniform(30, 600, notes)
+    lift = rng.uniform(1, 20, notes)
+    kps = contact(key, start, start + travel + hold + lift)
+    kpe = contact(key, start + travel, start + travel + hold)
+    # [t, column, row] -> [t, row, column]
+    kps = kps.reshape(frames, COLS, ROWS).transpose(0, 2, 1)
+    kpe = kpe.reshape(frames, COLS, ROWS).transpose(0, 2, 1)
+
+    analog = np.zeros((frames, MUX_CHANNELS), dtype=np.int64)
+    for channel in range(MUX_CHANNELS):
+        moves = rng.poisson(pot_moves_per_second * seconds)
+        points_t, points_v = [0.0], [float(rng.integers(0, 1024))]
+        for begin in np.sort(rng.uniform(0, span, moves)):
+            begin = max(begin, points_t[-1])
+            points_t += [begin, begin + rng.uniform(50, 400)]
+            points_v += [points_v[-1], float(rng.integers(0, 1024))]
+        analog[:, channel] = np.interp(times, points_t, points_v).astype(np.int64)
+
+    toggles = np.zeros(frames + 1, dtype=np.int64)
+    np.add.at(toggles, frame_of(rng.uniform(0, span, rng.poisson(pedal_per_second * seconds))), 1)
+    sustain = np.cumsum(toggles[:-1]) % 2 == 1
+    return Recording(times, kps, kpe, analog, sustain)
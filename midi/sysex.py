@@ -0,0 +1,246 @@
+# SysEx transport for binary presets (midi/binary.py).
+#
+# One message per preset:
+#
+#   F0 7D <device> 01 <slot hi> <slot lo> <packed payload> <checksum> F7
+#
+# 7D is the manufacturer id reserved for non-commercial use, 01 the preset
+# dump command and slot the 14-bit preset index on the device. The payload is
+# the binary preset zero-padded to a multiple of 7 bytes and 7-bit packed:
+# each group of 7 bytes becomes 8, a byte carrying the high bits (bit k for
+# byte k) followed by the 7 low halves. The checksum makes the 7-bit sum of
+# slot, payload and checksum zero.
+#
+# The batch encoder never loops over bytes in Python. Presets of the same
+# size share a message layout, so a whole batch is written column by column
+# with strided slice assignment into one preallocated buffer; masks use
+# bytes.translate and the high-bit bytes and checksums are computed with
+# big-int arithmetic over whole columns, where lanes are wide enough that
+# no carry crosses into the neighbouring message.
+
+import re
+import struct
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from itertools import chain
+
+from . import binary
+from .models import KNOB_FIELDS, Knob
+
+SYSEX_START = 0xF0
+SYSEX_END = 0xF7
+MANUFACTURER_ID = 0x7D
+PRESET_DUMP = 0x01
+HEADER_SIZE = 6
+MAX_SLOT = 0x3FFF
+
+LOW7 = bytes(b & 0x7F for b in range(256))
+HIGH_BIT = bytes(b >> 7 for b in range(256))
+NEGATE7 = bytes(-b & 0x7F for b in range(256))
+BIT = [bytes(0x80 if b >> k & 1 else 0 for b in range(256)) for k in range(7)]
+
+# Any status byte except the realtime ones (F8-FF), which MIDI allows in the
+# middle of a SysEx message.
+STATUS = re.compile(rb'[\x80-\xf7]')
+REALTIME = bytes(range(0xF8, 0x100))
+
+PresetDump = namedtuple('PresetDump', 'device slot keys_channel knobs')
+
+
+class SysExError(ValueError):
+    pass
+
+
+def packed_size(size):
+    return -(-size // 7) * 8
+
+
+def message_size(payload_size):
+    return HEADER_SIZE + packed_size(payload_size) + 2
+
+
+def pack7(data):
+    # data: bytes-like whose length is a multiple of 7.
+    data = bytes(data)
+    groups = len(data) // 7
+    out = bytearray(groups * 8)
+    high = data.translate(HIGH_BIT)
+    # Each high-bit byte is at most 0x01 and shifted by at most 6, so the
+    # per-group sums (< 0x80) never carry into the next byte.
+    msb = 0
+    for k in range(7):
+        msb += int.from_bytes(high[k::7], 'big') << k
+        out[k + 1::8] = data[k::7].translate(LOW7)
+    out[0::8] = msb.to_bytes(groups, 'big')
+    return bytes(out)
+
+
+def unpack7(data):
+    data = bytes(data)
+    groups = len(data) // 8
+    if len(data) != groups * 8:
+        raise SysExError('Packed payload is not a whole number of groups.')
+    out = bytearray(groups * 7)
+    msb = data[0::8]
+    for k in range(7):
+        low = int.from_bytes(data[k + 1::8], 'big')
+        high = int.from_bytes(msb.translate(BIT[k]), 'big')
+        out[k::7] = (low | high).to_bytes(groups, 'big')
+    return bytes(out)
+
+
+def _lanes(column, width):
+    # column as an int with one byte per message widened to `width` bytes,
+    # so sums of up to 256**(width-1) columns cannot overflow a lane.
+    wide = bytearray(len(column) * width)
+    wide[width - 1::width] = column
+    return int.from_bytes(wide, 'big')
+
+
+@lru_cache(maxsize=None)
+def _preset_struct(knob_count, padded_size):
+    padding = padded_size - binary.encoded_size(knob_count)
+    return struct.Struct(f'>3sBBB{5 * knob_count}B{padding}x')
+
+
+def _encode_group(slots, presets, device):
+    # presets: (keys_channel, knobs) pairs that all have the same knob count.
+    count = len(presets[0][1])
+    raw_size = -(-binary.encoded_size(count) // 7) * 7
+    layout = _preset_struct(count, raw_size)
+    n = len(presets)
+
+    raw = bytearray(n * raw_size)
+    try:
+        for i, (keys_channel, knobs) in enumerate(presets):
+            layout.pack_into(raw, i * raw_size, binary.MAGIC, binary.VERSION, keys_channel, count, *chain.from_iterable(knobs))
+    except struct.error as e:
+        raise SysExError(f'Preset values must fit in a byte: {e}') from None
+    packed = pack7(raw)
+
+    packed_len = packed_size(raw_size)
+    size = HEADER_SIZE + packed_len + 2
+    out = bytearray(n * size)
+    out[0::size] = bytes([SYSEX_START]) * n
+    out[1::size] = bytes([MANUFACTURER_ID]) * n
+    out[2::size] = bytes([device]) * n
+    out[3::size] = bytes([PRESET_DUMP]) * n
+    slot_hi = bytes(slot >> 7 for slot in slots)
+    slot_lo = bytes(slot & 0x7F for slot in slots)
+    out[4::size] = slot_hi
+    out[5::size] = slot_lo
+
+    # Two byte lanes hold sums of up to 258 bytes below 0x80.
+    total = _lanes(slot_hi, 2) + _lanes(slot_lo, 2)
+    for j in range(packed_len):
+        column = packed[j::packed_len]
+        out[HEADER_SIZE + j::size] = column
+        total += _lanes(column, 2)
+    low_bytes = total.to_bytes(n * 2, 'big')[1::2]
+    out[size - 2::size] = low_bytes.translate(NEGATE7)
+    out[size - 1::size] = bytes([SYSEX_END]) * n
+    return out
+
+
+def encode_batch(presets, device=0, first_slot=0):
+    # presets: sequence of (keys_channel, knobs) with knobs as sequences of
+    # (channel, CC, min, max, pin); preset i goes to slot first_slot + i.
+    # Returns the concatenated messages. Messages are grouped by knob count,
+    # which is fine for the device as every message names its slot.
+    if not 0 <= device <= 0x7F:
+        raise SysExError(f'Device id {device} does not fit 7 bits.')
+    if first_slot < 0 or first_slot + len(presets) - 1 > MAX_SLOT:
+        raise SysExError(f'Slots must be between 0 and {MAX_SLOT}.')
+    groups = defaultdict(list)
+    for slot, preset in enumerate(presets, first_slot):
+        count = len(preset[1])
+        if not 1 <= count <= binary.MAX_KNOBS:
+            raise SysExError(f'A preset needs 1 to {binary.MAX_KNOBS} knobs, got {count}.')
+        groups[count].append((slot, preset))
+    stream = bytearray()
+    for members in groups.values():
+        slots, group = zip(*members)
+        stream += _encode_group(slots, group, device)
+    return bytes(stream)
+
+
+def encode_message(keys_channel, knobs, device=0, slot=0):
+    return encode_batch([(keys_channel, knobs)], device, slot)
+
+
+def encode_presets(presets, device=0, first_slot=0):
+    # Model-level entry point: loads every knob of the given presets in one
+    # query.
+    knobs = defaultdict(list)
+    rows = Knob.objects.filter(preset__in=presets).order_by('id').values_list('preset_id', *KNOB_FIELDS)
+    for preset_id, *values in rows:
+        knobs[preset_id].append(values)
+    return encode_batch([(preset.keys_channel, knobs[preset.id]) for preset in presets], device, first_slot)
+
+
+def decode_message(message):
+    # message: one complete message, F0 to F7, realtime bytes removed.
+    message = bytes(message)
+    if len(message) < HEADER_SIZE + 2 or message[0] != SYSEX_START or message[-1] != SYSEX_END:
+        raise SysExError('Not a complete SysEx message.')
+    if message[1] != MANUFACTURER_ID or message[3] != PRESET_DUMP:
+        raise SysExError('Not a SweetBox preset dump.')
+    body = message[4:-1]
+    if sum(body) & 0x7F:
+        raise SysExError('Checksum mismatch.')
+    raw = unpack7(body[2:-1])
+    if len(raw) < binary.HEADER.size:
+        raise SysExError('Preset payload is too short.')
+    try:
+        preset = binary.decode(raw[:binary.encoded_size(raw[5])])
+    except ValueError as e:
+        raise SysExError(str(e)) from None
+    return PresetDump(message[2], message[4] << 7 | message[5], preset['keys_channel'], preset['knobs'])
+
+
+class SysExDecoder:
+    # Incremental parser for a byte stream coming back from devices, e.g.
+    #   decoder = SysExDecoder()
+    #   for chunk in port:
+    #       for dump in decoder.feed(chunk):
+    #           ...
+    # Chunks may split messages anywhere. Realtime bytes inside a message are
+    # skipped, other MIDI traffic between messages is ignored, and a message
+    # cut short by another status byte or failing its checksum is dropped
+    # and counted, after which parsing resumes at the next F0.
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped = 0
+        self.ignored = 0
+
+    def feed(self, data):
+        self.buffer += data
+        dumps = []
+        position = 0
+        while True:
+            start = self.buffer.find(SYSEX_START, position)
+            if start < 0:
+                position = len(self.buffer)
+                break
+            status = STATUS.search(self.buffer, start + 1)
+            if status is None:
+                # Incomplete; keep it for the next chunk.
+                position = start
+                break
+            end = status.start()
+            position = end
+            if self.buffer[end] != SYSEX_END:
+                self.dropped += 1
+                continue
+            message = bytes(self.buffer[start:end + 1]).translate(None, REALTIME)
+            position = end + 1
+            if message[1:2] != bytes([MANUFACTURER_ID]) or message[3:4] != bytes([PRESET_DUMP]):
+                self.ignored += 1
+                continue
+            try:
+                dumps.append(decode_message(message))
+            except SysExError:
+                self.dropped += 1
+        del self.buffer[:position]
+        return dumps
@@ -0,0 +1,79 @@
+# Fragment caching for the dashboard cards and the portal's knob table.
+#
+# Fragments live in the TEMPLATES cache namespace. A preset's fragments are
+# keyed by its id and Preset.updated, which every write bumps (save_knobs,
+# the JSON API, and for knobs saved one at a time, as the admin does, the
+# Knob signals), so an edit renders afresh and is never served stale. Every
+# key also carries a digest of the partial's source and the Django version,
+# so a deploy that changes the markup (or the form widgets) misses as well.
+#
+# The dashboard looks all of its cards up with one get_many and renders only
+# the misses. The knob table is cached only for an unbound formset: after a
+# failed POST it has to show what was submitted.
+
+import hashlib
+from weakref import WeakKeyDictionary
+
+import django
+from django import template
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from ..cache import TEMPLATES
+
+register = template.Library()
+
+_digests = WeakKeyDictionary()
+
+
+def partial(name):
+    # The compiled template and a digest of its source, computed once per
+    # compiled template (the cached loader returns the same one every time).
+    compiled = get_template(name)
+    digest = _digests.get(compiled.template)
+    if digest is None:
+        source = f'{django.get_version()}\n{compiled.template.source}'
+        digest = _digests[compiled.template] = hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    return compiled, digest
+
+
+def updated_key(updated):
+    return int(updated.timestamp() * 1_000_000)
+
+
+def render_cached(name, contexts):
+    # contexts: {key: context dict}. Returns the fragments in that order.
+    compiled, digest = partial(name)
+    keys = {f'{name}:{digest}:{key}': key for key in contexts}
+    found = TEMPLATES.get_many(list(keys))
+    rendered = {}
+    for cache_key, key in keys.items():
+        if cache_key not in found:
+            rendered[cache_key] = found[cache_key] = compiled.render(contexts[key])
+    if rendered:
+        TEMPLATES.set_many(rendered, settings.FRAGMENT_CACHE_TIMEOUT)
+    return [found[cache_key] for cache_key in keys]
+
+
+@register.simple_tag
+def preset_cards(presets):
+    # presets: the dashboard summaries, see services.SUMMARY_FIELDS.
+    contexts = {f"{preset['id']}:{updated_key(preset['updated'])}": {'preset': preset} for preset in presets}
+    return mark_safe(''.join(render_cached('midi/partials/preset_card.html', contexts)))
+
+
+@register.simple_tag
+def knob_rows(knob_formset, preset):
+    name = 'midi/partials/knob_rows.html'
+    context = {'knob_formset': knob_formset}
+    if knob_formset.is_bound:
+        return mark_safe(get_template(name).render(context))
+    return mark_safe(render_cached(name, {f'{preset.id}:{updated_key(preset.updated)}': context})[0])
+
+
+@register.simple_tag
+def knob_empty_row(knob_formset):
+    # The row the "Add Knob" button clones: the same for every preset.
+    fragments = render_cached('midi/partials/knob_empty_row.html', {knob_formset.prefix: {'knob_formset': knob_formset}})
+    return mark_safe(fragments[0])
@@ -0,0 +1,26 @@
+# Test runner (settings.TEST_RUNNER) that keeps the suite's traffic out of
+# the project's metrics store: every test request passes MetricsMiddleware,
+# which would otherwise flush into BASE_DIR/metrics.sqlite3.
+
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+from .metrics import REGISTRY
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        # Assigned rather than overridden, so the flush at exit still sees it.
+        settings.METRICS_PATH = Path(self.metrics_dir.name) / 'metrics.sqlite3'
+
+    def teardown_test_environment(self, **kwargs):
+        # Nothing is left for the flush at exit.
+        REGISTRY.reset()
+        self.metrics_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
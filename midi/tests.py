@@ -1,3 +1,1163 @@
-from django.test import TestCase
+import html
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connections, transaction
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.utils import timezone
+
+from . import binary, generator, simulator, sysex
+from .cache import PRESETS, Namespace, cache_stats
+from .firmware_cache import TOUCH_INTERVAL, FirmwareCache, build_firmware, firmware_build, get_firmware_cache
+from .db import retry_on_lock
+from .export import firmware_jobs
+from SweetBoxSYNTHAGE import warmup
+from .jobs import enqueue_build, run_build
+from .metrics import REGISTRY
+from .profiling import SAMPLER, Capture
+from .management.commands.benchmark import compare
+from .models import KNOB_FIELDS, FirmwareBuild, Knob, Preset, RequestProfile
+from .routers import PIN_COOKIE
+from .services import PROVISIONED_SESSION_KEY, build_preset, clone_preset, refresh_dashboard
+
+
+# Counted on the primary; replica routing is covered by ReplicaRoutingTests.
+@override_settings(DATABASE_REPLICA_VIEWS=[])
+class PortalQueryTests(TestCase):
+    # Session and user lookups account for the first two queries; the portal
+    # itself must stay at one preset query and one knob query.
+
+    def setUp(self):
+        self.user = User.objects.create_user('player', password='x')
+        for i in range(3):
+            build_preset(owner=self.user, name=f'Preset {i}', number_of_knobs=16)
+        self.client.force_login(self.user)
+
+    def test_get_latest_preset(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('portal'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['knob_formset'].total_form_count(), 16)
+
+    def test_get_selected_preset(self):
+        preset = Preset.objects.filter(owner=self.user).order_by('updated').first()
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('portal'), {'preset': preset.id})
+        self.assertEqual(response.context['preset'], preset)
+
+    def test_unknown_preset_skips_knob_query(self):
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('portal'), {'preset': 0})
+        self.assertIsNone(response.context['preset'])
+
+
+class PortalSaveTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user('player', password='x')
+            self.preset = build_preset(owner=self.user, name='Lead', keys_channel=2, number_of_knobs=16)
+        self.client.force_login(self.user)
+
+    def post(self, rows):
+        data = {
+            'form-TOTAL_FORMS': len(rows),
+            'form-INITIAL_FORMS': sum(1 for row in rows if row.get('id')),
+            'form-MIN_NUM_FORMS': 1,
+            'form-MAX_NUM_FORMS': 16,
+            'midi_channel': self.preset.keys_channel,
+            'preset_name': self.preset.name,
+        }
+        for i, row in enumerate(rows):
+            for field, value in row.items():
+                data[f'form-{i}-{field}'] = value
+        return self.client.post(f"{reverse('portal')}?preset={self.preset.id}", data)
+
+    def stored_rows(self):
+        return list(self.preset.knob_set.order_by('id').values('id', 'channel', 'CC', 'min', 'max', 'pin'))
+
+    def test_unchanged_submission_writes_nothing(self):
+        rows = self.stored_rows()
+        with self.assertNumQueries(4):
+            response = self.post(rows)
+        self.assertEqual(response.status_code, 302)
+
+    def test_single_change_is_one_update(self):
+        rows = self.stored_rows()
+        rows[3]['max'] = 100
+        # session, user, presets, knobs + BEGIN/knob UPDATE/preset UPDATE/COMMIT
+        with self.assertNumQueries(8):
+            self.post(rows)
+        self.assertEqual(self.preset.knob_set.get(id=rows[3]['id']).max, 100)
+
+    def test_deleting_knobs_is_one_delete(self):
+        rows = self.stored_rows()
+        for row in rows[8:]:
+            row['DELETE'] = 'on'
+        # session, user, presets, knobs + BEGIN/knob DELETE/preset UPDATE/COMMIT
+        with self.assertNumQueries(8):
+            self.post(rows)
+        self.assertEqual(self.preset.knob_set.count(), 8)
+
+    def test_knob_signals_touch_the_preset_once(self):
+        # What the admin's "delete selected" does: the rows are collected,
+        # and the preset is touched for the first of them only.
+        with self.assertNumQueries(4):
+            Knob.objects.filter(preset=self.preset, pin__gte=8).delete()
+        updated = self.preset.updated
+        self.preset.refresh_from_db()
+        self.assertGreater(self.preset.updated, updated)
+
+    @override_settings(DATABASE_REPLICA_VIEWS=[])
+    def test_cached_fragments_follow_saves(self):
+        url = f"{reverse('portal')}?preset={self.preset.id}"
+        self.client.get(url)
+        self.client.get(reverse('dashboard'))
+        rows = self.stored_rows()
+        rows[3]['max'] = 100
+        # TestCase never commits; these run the on-commit refreshes.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post(rows)
+        self.assertContains(self.client.get(url), 'name="form-3-max" value="100"')
+        self.preset.refresh_from_db()
+        self.preset.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.preset.save()
+        self.assertContains(self.client.get(reverse('dashboard')), 'Renamed')
+
+    @override_settings(DATABASE_REPLICA_VIEWS=[])
+    def test_cached_fragments_follow_admin_edits(self):
+        url = f"{reverse('portal')}?preset={self.preset.id}"
+        self.client.get(url)
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        knob = self.preset.knob_set.order_by('id')[3]
+        data = {'preset': self.preset.id, 'channel': knob.channel, 'CC': knob.CC, 'min': 0, 'max': 100, 'pin': knob.pin}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:midi_knob_change', args=[knob.id]), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertContains(self.client.get(url), 'name="form-3-max" value="100"')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:midi_knob_delete', args=[knob.id]), {'post': 'yes'})
+        self.assertNotRegex(self.client.get(url).content.decode(), rf'name="form-\d+-id" value="{knob.id}"')
+
+    @override_settings(DATABASE_REPLICA_VIEWS=[])
+    def test_knob_edits_patch_with_the_page_etag(self):
+        url = f"{reverse('portal')}?preset={self.preset.id}"
+        response = self.client.get(url)
+        knobs_url = reverse('api_preset_knobs', args=[self.preset.id])
+        self.assertContains(response, f'data-knobs-url="{knobs_url}"')
+        etag = html.unescape(re.search(r'data-etag="([^"]+)"', response.content.decode()).group(1))
+        knob = self.preset.knob_set.order_by('id').first()
+        patch = json.dumps({'knobs': [{'id': knob.id, 'max': 90}]})
+        response = self.client.patch(knobs_url, patch, content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        # The next edit goes with the returned tag; the page's is now stale.
+        response = self.client.patch(knobs_url, patch, content_type='application/json', headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertContains(self.client.get(url), 'name="form-0-max" value="90"')
+
+    @override_settings(DATABASE_REPLICA_VIEWS=[])
+    def test_invalid_submission_shows_submitted_values(self):
+        self.client.get(f"{reverse('portal')}?preset={self.preset.id}")
+        rows = self.stored_rows()
+        rows[3]['max'] = 300
+        response = self.post(rows)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'name="form-3-max" value="300"')
+
+    def test_pins_the_firmware_cannot_read_are_rejected(self):
+        rows = self.stored_rows()
+        rows[3]['pin'] = 40
+        response = self.post(rows)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pin', response.context['knob_formset'].forms[3].errors)
+        self.assertEqual(self.preset.knob_set.get(id=rows[3]['id']).pin, 3)
+
+    def test_swapping_cc_and_pin_numbers(self):
+        rows = self.stored_rows()
+        rows[0]['CC'], rows[1]['CC'] = rows[1]['CC'], rows[0]['CC']
+        rows[0]['pin'], rows[2]['pin'] = rows[2]['pin'], rows[0]['pin']
+        response = self.post(rows)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.stored_rows()[:3], rows[:3])
+
+    def test_delete_and_add(self):
+        rows = self.stored_rows()
+        rows[0]['DELETE'] = 'on'
+        rows.append({'id': '', 'channel': 1, 'CC': 0, 'min': 0, 'max': 127, 'pin': 0})
+        self.post(rows)
+        self.preset.refresh_from_db()
+        self.assertEqual(self.preset.number_of_knobs, 16)
+        self.assertFalse(self.preset.knob_set.filter(id=rows[0]['id']).exists())
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    # The replica is a test mirror of default, so data is only shared once
+    # committed; hence TransactionTestCase.
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.user = User.objects.create_user('player', password='x')
+        self.preset = build_preset(owner=self.user, name='Lead')
+        self.client.force_login(self.user)
+
+    def replica_queries(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = getattr(self.client, method)(*args, **kwargs)
+        return response, len(queries)
+
+    def test_read_only_views_use_the_replica(self):
+        response, count = self.replica_queries('get', reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(count, 0)
+        response, count = self.replica_queries('get', reverse('portal'))
+        self.assertGreater(count, 0)
+
+    def test_writes_stay_on_the_primary_and_pin_the_client(self):
+        response, count = self.replica_queries('post', reverse('create_preset'), {'name': 'Pad'})
+        self.assertEqual(count, 0)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        response, count = self.replica_queries('get', reverse('dashboard'))
+        self.assertEqual(count, 0)
+        self.assertContains(response, 'Pad')
+
+
+@override_settings(DATABASE_REPLICA_VIEWS=[])
+class PresetApiTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('player', password='x')
+        self.client.force_login(self.user)
+
+    def payload(self, name='Lead', knobs=2):
+        return {
+            'name': name,
+            'keys_channel': 3,
+            'knobs': [{'channel': 1, 'CC': 20 + i, 'min': 0, 'max': 127, 'pin': i} for i in range(knobs)],
+        }
+
+    def send(self, method, url, data, **headers):
+        return getattr(self.client, method)(url, data, content_type='application/json', headers=headers)
+
+    def test_create_get_and_list(self):
+        response = self.send('post', reverse('api_presets'), self.payload())
+        self.assertEqual(response.status_code, 201)
+        preset = response.json()
+        self.assertEqual(preset['number_of_knobs'], 2)
+        self.assertEqual([knob['CC'] for knob in preset['knobs']], [20, 21])
+        url = reverse('api_preset', args=[preset['id']])
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': preset['etag']}).status_code, 304)
+        with self.assertNumQueries(4):
+            presets = self.client.get(reverse('api_presets')).json()['presets']
+        # The post_save signal also provisioned the Default preset.
+        self.assertEqual(len(presets), 2)
+
+    def test_put_replaces_knobs_and_checks_the_etag(self):
+        preset = self.send('post', reverse('api_presets'), self.payload(knobs=3)).json()
+        url = reverse('api_preset', args=[preset['id']])
+        data = dict(self.payload(name='Pad'), knobs=preset['knobs'][1:])
+        data['knobs'][0]['max'] = 90
+        data['knobs'].append({'channel': 2, 'CC': 70, 'min': 0, 'max': 127, 'pin': 9})
+        response = self.send('put', url, data, **{'If-Match': preset['etag']})
+        self.assertEqual(response.status_code, 200)
+        updated = response.json()
+        self.assertEqual(updated['name'], 'Pad')
+        self.assertEqual([knob['max'] for knob in updated['knobs']], [90, 127, 127])
+        self.assertFalse(Knob.objects.filter(id=preset['knobs'][0]['id']).exists())
+        # The old ETag is stale now.
+        response = self.send('put', url, data, **{'If-Match': preset['etag']})
+        self.assertEqual(response.status_code, 412)
+
+    def test_invalid_payload(self):
+        data = self.payload()
+        data['knobs'][1]['CC'] = 20
+        response = self.send('post', reverse('api_presets'), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('__all__', response.json()['errors'])
+
+    def test_bulk_create_update_delete(self):
+        url = reverse('api_presets_bulk')
+        response = self.send('post', url, {'presets': [self.payload(f'P{i}') for i in range(20)]})
+        self.assertEqual(response.status_code, 201)
+        presets = response.json()['presets']
+        self.assertEqual([p['name'] for p in presets], [f'P{i}' for i in range(20)])
+
+        changes = [dict(p, name=p['name'] + '!') for p in presets[:2]]
+        changes[1]['etag'] = '"0"'
+        response = self.send('put', url, {'presets': changes})
+        self.assertEqual(response.status_code, 412)
+        # All or nothing.
+        self.assertFalse(Preset.objects.filter(name__endswith='!').exists())
+        del changes[1]['etag']
+        response = self.send('put', url, {'presets': changes})
+        self.assertEqual([p['name'] for p in response.json()['presets']], ['P0!', 'P1!'])
+
+        response = self.send('delete', url, {'ids': [p['id'] for p in presets]})
+        self.assertEqual(response.json(), {'deleted': 20})
+
+    def test_pins_are_capped_at_the_sketch_inputs(self):
+        data = self.payload()
+        data['knobs'][1]['pin'] = 16
+        response = self.send('post', reverse('api_presets'), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()['errors']['knobs'][1]), ['pin'])
+        preset = self.send('post', reverse('api_presets'), self.payload()).json()
+        url = reverse('api_preset_knobs', args=[preset['id']])
+        response = self.send('patch', url, {'knobs': [{'id': preset['knobs'][0]['id'], 'pin': 40}]})
+        self.assertEqual(list(response.json()['errors']['knobs']['0']), ['pin'])
+
+    def test_bulk_ids_must_be_integers(self):
+        url = reverse('api_presets_bulk')
+        preset = self.send('post', reverse('api_presets'), self.payload()).json()
+        for ids in (['1'], [[1]], [None], [True], [{'id': 1}]):
+            with self.subTest(ids=ids):
+                response = self.send('delete', url, {'ids': ids})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('ids', response.json()['errors'])
+                response = self.send('put', url, {'presets': [dict(preset, id=ids[0])]})
+                self.assertEqual(response.status_code, 400)
+        # Unhashable knob ids are unknown ids, not a crash.
+        data = dict(preset, knobs=[dict(preset['knobs'][0], id=[1])])
+        response = self.send('put', reverse('api_preset', args=[preset['id']]), data)
+        self.assertEqual(response.status_code, 400)
+        response = self.send('patch', reverse('api_preset_knobs', args=[preset['id']]), {'knobs': [{'id': {}}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(Preset.objects.filter(pk=preset['id']).exists())
+
+    def test_patch_knobs(self):
+        preset = self.send('post', reverse('api_presets'), self.payload(knobs=3)).json()
+        url = reverse('api_preset_knobs', args=[preset['id']])
+        first, second, third = preset['knobs']
+        # session, user, preset, knobs + BEGIN/knob UPDATE/preset UPDATE/COMMIT
+        with self.assertNumQueries(8):
+            response = self.send('patch', url, {'knobs': [{'id': first['id'], 'CC': 90}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['knobs'], [dict(first, CC=90)])
+        self.assertNotEqual(response.json()['etag'], preset['etag'])
+        self.assertEqual(Knob.objects.get(id=first['id']).CC, 90)
+        self.assertEqual(Knob.objects.get(id=second['id']).CC, second['CC'])
+
+        # Swapping within one patch is fine; clashing with another knob is not.
+        swap = [{'id': second['id'], 'pin': third['pin']}, {'id': third['id'], 'pin': second['pin']}]
+        self.assertEqual(self.send('patch', url, {'knobs': swap}).status_code, 200)
+        response = self.send('patch', url, {'knobs': [{'id': second['id'], 'CC': 90}]})
+        self.assertEqual(response.status_code, 409)
+        response = self.send('patch', url, {'knobs': [{'id': second['id'], 'max': 300, 'colour': 1}]})
+        self.assertEqual(set(response.json()['errors']['knobs']['0']), {'colour'})
+        response = self.send('patch', url, {'knobs': [{'id': second['id'], 'max': 300}]})
+        self.assertEqual(list(response.json()['errors']['knobs']['0']), ['max'])
+        response = self.send('patch', url, {'knobs': [{'id': first['id'], 'CC': 1}]}, **{'If-Match': preset['etag']})
+        self.assertEqual(response.status_code, 412)
+
+
+class BinaryFormatTests(TestCase):
+
+    def test_round_trip(self):
+        knobs = [(1 + i % 16, i, 0, 127 - i, 99 - i) for i in range(16)]
+        data = binary.encode(10, knobs)
+        self.assertEqual(len(data), 86)
+        self.assertEqual(data[:6], b'SBX\x01\x0a\x10')
+        decoded = binary.decode(data)
+        self.assertEqual(decoded['keys_channel'], 10)
+        self.assertEqual([tuple(knob.values()) for knob in decoded['knobs']], knobs)
+
+    def test_decoded_knobs_build_a_preset(self):
+        user = User.objects.create_user('player', password='x')
+        preset = build_preset(owner=user, name='Lead', keys_channel=2, number_of_knobs=5)
+        decoded = binary.decode(binary.encode_preset(preset))
+        copy = build_preset(owner=user, name='Copy', keys_channel=decoded['keys_channel'], knobs=decoded['knobs'])
+        self.assertEqual(binary.encode_preset(copy), binary.encode_preset(preset))
+
+    def test_rejects_bad_input(self):
+        data = binary.encode(1, [(1, 2, 3, 4, 5)])
+        for bad in (b'', b'XYZ\x01\x01\x01' + data[6:], data[:3] + b'\x02' + data[4:], data[:-1], data + b'\x00'):
+            with self.assertRaises(ValueError):
+                binary.decode(bad)
+        with self.assertRaises(ValueError):
+            binary.encode(1, [(1, 300, 0, 127, 0)])
+        with self.assertRaises(ValueError):
+            binary.encode(1, [])
+
+    @override_settings(DATABASE_REPLICA_VIEWS=[])
+    def test_download(self):
+        user = User.objects.create_user('player', password='x')
+        preset = build_preset(owner=user, name='Lead', keys_channel=4, number_of_knobs=3)
+        self.client.force_login(user)
+        url = reverse('download_preset_binary', args=[preset.id])
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(binary.decode(response.content)['keys_channel'], 4)
+        response = self.client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+
+class SysExTests(TestCase):
+
+    def presets(self):
+        return [(1 + i % 16, [(i % 16 + 1, (i + k) % 128, 0, 255 - k, k) for k in range(1 + i % 16)]) for i in range(40)]
+
+    def test_batch_round_trip(self):
+        presets = self.presets()
+        stream = sysex.encode_batch(presets, device=5, first_slot=200)
+        self.assertTrue(all(b < 0x80 for b in stream.replace(b'\xf0', b'').replace(b'\xf7', b'')))
+        decoder = sysex.SysExDecoder()
+        dumps = []
+        # Odd chunk sizes split messages; a clock byte inside one is skipped.
+        for i in range(0, len(stream), 13):
+            dumps += decoder.feed(stream[i:i + 13] + b'\xf8')
+        self.assertEqual(len(dumps), len(presets))
+        for dump in dumps:
+            keys_channel, knobs = presets[dump.slot - 200]
+            self.assertEqual(dump.device, 5)
+            self.assertEqual(dump.keys_channel, keys_channel)
+            self.assertEqual([tuple(knob.values()) for knob in dump.knobs], knobs)
+
+    def test_message_layout(self):
+        knobs = [(1, 2, 0, 200, 9)]
+        message = sysex.encode_message(3, knobs, device=1, slot=130)
+        self.assertEqual(message[:6], b'\xf0\x7d\x01\x01\x01\x02')
+        self.assertEqual(len(message), sysex.message_size(binary.encoded_size(1)))
+        self.assertEqual(sum(message[4:-1]) & 0x7F, 0)
+        payload = binary.encode(3, knobs)
+        self.assertEqual(sysex.unpack7(message[6:-2])[:len(payload)], payload)
+        self.assertEqual(sysex.pack7(b'\xff' * 7), b'\x7f' * 8)
+
+    def test_decoder_drops_bad_messages(self):
+        good = sysex.encode_message(3, [(1, 2, 3, 4, 5)])
+        corrupt = bytearray(good)
+        corrupt[8] ^= 0x01
+        decoder = sysex.SysExDecoder()
+        # Note on, a corrupt dump, a dump cut short by a note off, another
+        # manufacturer's SysEx, then a good one.
+        stream = b'\x90\x3c\x40' + bytes(corrupt) + good[:10] + b'\x80\x3c\x00' + b'\xf0\x41\x10\xf7' + good
+        dumps = decoder.feed(stream)
+        self.assertEqual(len(dumps), 1)
+        self.assertEqual((decoder.dropped, decoder.ignored), (2, 1))
+        with self.assertRaises(sysex.SysExError):
+            sysex.decode_message(corrupt)
+
+    def test_encode_presets(self):
+        user = User.objects.create_user('player', password='x')
+        presets = [build_preset(owner=user, name=f'P{i}', keys_channel=i + 1, number_of_knobs=i + 2) for i in range(3)]
+        with self.assertNumQueries(1):
+            stream = sysex.encode_presets(presets)
+        dumps = sysex.SysExDecoder().feed(stream)
+        self.assertEqual(sorted(dump.slot for dump in dumps), [0, 1, 2])
+        for dump in dumps:
+            self.assertEqual(binary.encode(dump.keys_channel, [tuple(k.values()) for k in dump.knobs]), binary.encode_preset(presets[dump.slot]))
+
+    def test_rejects_bad_input(self):
+        with self.assertRaises(sysex.SysExError):
+            sysex.encode_batch([(1, [(1, 300, 0, 127, 0)])])
+        with self.assertRaises(sysex.SysExError):
+            sysex.encode_batch([(1, [])])
+        with self.assertRaises(sysex.SysExError):
+            sysex.encode_batch([(1, [(1, 2, 3, 4, 5)])], first_slot=sysex.MAX_SLOT + 1)
+
+
+@skipUnless(simulator.np is not None, 'NumPy is not installed')
+class SimulatorTests(TestCase):
+
+    def key_recording(self):
+        np = simulator.np
+        kps = np.zeros((10, 8, 8), dtype=bool)
+        kpe = np.zeros((10, 8, 8), dtype=bool)
+        # nums[2][3] = 43: KPS closes at 10 ms, KPE at 30 ms, both open at 60.
+        kps[1:6, 2, 3] = kpe[3:6, 2, 3] = True
+        # nums[0][0] = 24: both contacts at once, held until 80 ms.
+        kps[4:8, 0, 0] = kpe[4:8, 0, 0] = True
+        return simulator.Recording(np.arange(10) * 10, kps, kpe)
+
+    def test_keys(self):
+        events = simulator.Simulator(simulator.FirmwareConfig.for_board('ATMEGA32U4')).run(self.key_recording())
+        self.assertEqual(simulator.messages(events), [
+            # map(20, 50, 0, 10, 127) and map(0, ...).
+            (30, bytes([0x90, 43, 80])),
+            (40, bytes([0x90, 24, 127])),
+            # Note offs repeat the last note on's velocity, whichever key.
+            (60, bytes([0x80, 43, 127])),
+            (80, bytes([0x80, 24, 127])),
+        ])
+
+    def test_pots(self):
+        np = simulator.np
+        config = simulator.FirmwareConfig(pot_pins=[1], pot_ccs=[74], pot_threshold=15, pot_timeout=300)
+        analog = np.zeros((100, 16), dtype=int)
+        analog[10:, 1] = np.minimum(np.arange(90) * 50, 512)
+        # Jitter within potThreshold after POT_TIMEOUT is ignored, a real
+        # move is not.
+        analog[60:, 1] = 522
+        analog[80:, 1] = 1023
+        events = simulator.Simulator(config).run(simulator.Recording(np.arange(100) * 10, analog=analog))
+        self.assertTrue(all(event['status'] == 0xB0 and event['data1'] == 74 for event in events))
+        values = list(events['data2'])
+        self.assertEqual(values[-2:], [63, 127])
+        self.assertNotIn(64, values)
+        self.assertEqual(values, sorted(values))
+
+    def test_preset_and_batches(self):
+        user = User.objects.create_user('player', password='x')
+        preset = build_preset(owner=user, name='Lead', keys_channel=3, number_of_knobs=2)
+        config = simulator.FirmwareConfig.for_preset(preset, list(preset.knob_set.order_by('id')), 'RP2040')
+        self.assertEqual((config.pot_pins, config.pot_ccs, config.channel), ([0, 1], [0, 1], 2))
+        events = simulator.Simulator(config).run(self.key_recording())
+        # RP2040: transposed, vel_min 1, and inverted pots, which read 127
+        # at rest and are sent at power on.
+        self.assertEqual(simulator.messages(events[:2]), [(0, bytes([0xB2, 0, 127])), (0, bytes([0xB2, 1, 127]))])
+        self.assertEqual(simulator.messages(events[2:3]), [(30, bytes([0x92, 43 + 12, 81]))])
+
+        recordings = [simulator.synthetic_recording(20, seed=seed) for seed in range(3)]
+        sim = simulator.Simulator(config)
+        batched = sim.run_many(recordings)
+        for recording, events in zip(recordings, batched):
+            self.assertTrue(len(events))
+            self.assertTrue(simulator.np.array_equal(sim.run(recording), events))
+
+
+class BenchmarkCompareTests(TestCase):
+
+    def test_compare(self):
+        results = {'portal_get@1': {'median_ms': 13.0}, 'dashboard@1': {'median_ms': 5.0}, 'new@1': {'median_ms': 1.0}}
+        baseline = {'portal_get@1': {'median_ms': 10.0}, 'dashboard@1': {'median_ms': 10.0}}
+        rows = {row['key']: row for row in compare(results, baseline, tolerance=0.25)}
+        self.assertTrue(rows['portal_get@1']['regressed'])
+        self.assertAlmostEqual(rows['portal_get@1']['change'], 0.3)
+        self.assertFalse(rows['dashboard@1']['regressed'])
+        self.assertNotIn('regressed', rows['new@1'])
+
+
+@override_settings(DATABASE_REPLICA_VIEWS=[])
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(METRICS_PATH=Path(directory.name) / 'metrics.sqlite3', METRICS_TOKEN='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        REGISTRY.reset()
+        self.user = User.objects.create_user('owner', password='pw')
+        self.preset = build_preset(owner=self.user, name='Lead', keys_channel=1, number_of_knobs=2)
+        self.client.force_login(self.user)
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_request_metrics(self):
+        self.client.get(f"{reverse('portal')}?preset={self.preset.id}")
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('sweetbox_http_requests_total{method="GET",status="200",view="portal"} 1', body)
+        self.assertIn('sweetbox_http_request_duration_seconds_bucket{view="portal",le="+Inf"} 1', body)
+        # As counted by PortalQueryTests.
+        self.assertIn('sweetbox_db_queries_per_request_sum{view="portal"} 4', body)
+        self.assertIn('sweetbox_db_queries_per_request_bucket{view="portal",le="2.0"} 0', body)
+
+
+@override_settings(DATABASE_REPLICA_VIEWS=[])
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner', password='pw')
+        self.preset = build_preset(owner=self.user, name='Lead', keys_channel=1, number_of_knobs=2)
+        self.client.force_login(self.user)
+        self.url = f"{reverse('portal')}?preset={self.preset.id}"
+
+    def test_staff_only(self):
+        self.client.get(self.url, HTTP_X_PROFILE='1')
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(PROFILE_KEEP=2)
+    def test_profile_on_request(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get(self.url)
+        self.assertFalse(RequestProfile.objects.exists())
+        for _ in range(3):
+            self.client.get(self.url, HTTP_X_PROFILE='1')
+        self.client.get(f'{self.url}&_profile=1')
+        self.assertEqual(RequestProfile.objects.count(), 2)
+        profile = RequestProfile.objects.latest('id')
+        self.assertEqual((profile.view, profile.trigger, profile.status), ('portal', RequestProfile.MANUAL, 200))
+        self.assertIn('cumulative', profile.profile)
+        self.assertEqual(profile.query_count, 2)
+        self.assertIn('FROM "midi_knob"', profile.sql)
+        # Statements only: parameters such as session keys are never stored.
+        self.assertIn('"midi_knob"."preset_id" = %s', profile.sql)
+        self.assertNotIn(self.client.session.session_key, profile.sql)
+
+    def test_sampler(self):
+        capture = Capture(threading.get_ident(), time.monotonic())
+        SAMPLER.watch(capture)
+        try:
+            deadline = time.monotonic() + 5
+            while not capture.stacks and time.monotonic() < deadline:
+                sum(range(1000))
+        finally:
+            SAMPLER.unwatch(capture)
+        self.assertIn('ProfilingTests.test_sampler', next(iter(capture.stacks)))
+
+
+@override_settings(DATABASE_REPLICA_VIEWS=[], FIRMWARE_BUILD_BACKEND='immediate')
+class FirmwareTestCase(TestCase):
+    # Builds go to a temporary cache directory, inline unless a test says
+    # otherwise.
+
+    def setUp(self):
+        self.enterContext(override_settings(FIRMWARE_CACHE_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+        self.user = User.objects.create_user('owner', password='pw')
+        self.preset = build_preset(owner=self.user, name='Lead', keys_channel=1, number_of_knobs=2)
+        self.client.force_login(self.user)
+
+    def download(self, **headers):
+        return self.client.get(reverse('download_firmware', args=[self.preset.id]), headers=headers)
+
+
+class FirmwareBuildTests(FirmwareTestCase):
+
+    @override_settings(FIRMWARE_BUILD_BACKEND='worker')
+    def test_identical_requests_coalesce(self):
+        key, job = enqueue_build(self.preset)
+        self.assertEqual(job.status, FirmwareBuild.PENDING)
+        self.assertEqual(enqueue_build(self.preset), (key, job))
+        other = build_preset(owner=User.objects.create_user('other'), name='Lead', keys_channel=1, number_of_knobs=2)
+        self.assertEqual(enqueue_build(other)[1], job)
+        self.assertEqual(FirmwareBuild.objects.count(), 1)
+
+    @override_settings(FIRMWARE_BUILD_BACKEND='worker')
+    def test_a_job_is_claimed_once(self):
+        key, job = enqueue_build(self.preset)
+        run_build(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, FirmwareBuild.DONE)
+        FirmwareBuild.objects.filter(pk=job.pk).update(status=FirmwareBuild.RUNNING)
+        with self.assertNumQueries(1):
+            run_build(job.pk)
+        # Built: the next request needs no job at all.
+        self.assertEqual(enqueue_build(self.preset), (key, None))
+
+    def test_immediate_build_downloads(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'potCC', b''.join(response.streaming_content))
+        self.assertEqual(FirmwareBuild.objects.get().status, FirmwareBuild.DONE)
+
+    @override_settings(FIRMWARE_BUILD_BACKEND='worker', FIRMWARE_BUILD_WAIT=0)
+    def test_queued_build_answers_202_with_the_status_url(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 202)
+        job = FirmwareBuild.objects.get()
+        status_url = reverse('firmware_build_status', args=[job.id])
+        self.assertEqual(response['Location'], status_url)
+        self.assertEqual(response.json(), {'status': FirmwareBuild.PENDING, 'status_url': status_url})
+
+        status = self.client.get(status_url).json()
+        self.assertEqual((status['status'], status['download_url']), (FirmwareBuild.PENDING, None))
+        call_command('run_firmware_worker', once=True)
+        status = self.client.get(status_url).json()
+        self.assertEqual(status['status'], FirmwareBuild.DONE)
+        self.assertEqual(self.client.get(status['download_url']).status_code, 200)
+
+    def test_build_status_is_owner_only(self):
+        key, job = enqueue_build(self.preset)
+        self.client.force_login(User.objects.create_user('other'))
+        self.assertEqual(self.client.get(reverse('firmware_build_status', args=[job.id])).status_code, 404)
+
+    @override_settings(FIRMWARE_BUILD_BACKEND='worker', FIRMWARE_BUILD_WAIT=0)
+    def test_abandoned_jobs_expire(self):
+        key, job = enqueue_build(self.preset)
+        old = timezone.now() - timedelta(seconds=settings.FIRMWARE_BUILD_STALE_AFTER + 1)
+        FirmwareBuild.objects.filter(pk=job.pk).update(updated=old)
+        self.assertEqual(self.download().status_code, 202)
+        job.refresh_from_db()
+        self.assertEqual(job.status, FirmwareBuild.FAILED)
+        fresh = FirmwareBuild.objects.get(status=FirmwareBuild.PENDING)
+        self.assertNotEqual(fresh, job)
+
+        # A build whose worker died while running it: failed by the next poll.
+        FirmwareBuild.objects.filter(pk=fresh.pk).update(status=FirmwareBuild.RUNNING, updated=old)
+        call_command('run_firmware_worker', once=True)
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, FirmwareBuild.FAILED)
+
+
+class FirmwareDownloadTests(FirmwareTestCase):
+
+    def test_etag_is_the_content_key(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        key, _ = firmware_build(self.preset)
+        self.assertEqual(response['ETag'], f'"{key}"')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+        b''.join(response.streaming_content)
+
+    def test_revalidation(self):
+        response = self.download()
+        b''.join(response.streaming_content)
+        for headers in ({'If-None-Match': response['ETag']}, {'If-Modified-Since': response['Last-Modified']}):
+            revalidated = self.download(**headers)
+            self.assertEqual(revalidated.status_code, 304)
+            self.assertEqual(revalidated['ETag'], response['ETag'])
+            self.assertEqual(revalidated['Cache-Control'], 'private, no-cache')
+        # A knob edit changes the content and so the tag.
+        knob = self.preset.knob_set.first()
+        knob.CC = 99
+        with self.captureOnCommitCallbacks(execute=True):
+            knob.save()
+        changed = self.download(**{'If-None-Match': response['ETag']})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        b''.join(changed.streaming_content)
+
+    @override_settings(FIRMWARE_SENDFILE_HEADER='X-Accel-Redirect')
+    def test_x_accel_redirect(self):
+        response = self.download()
+        key, _ = firmware_build(self.preset)
+        self.assertEqual(response['X-Accel-Redirect'], f'{settings.FIRMWARE_SENDFILE_PREFIX}{key}.ino')
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+    @override_settings(FIRMWARE_SENDFILE_HEADER='X-Sendfile')
+    def test_x_sendfile(self):
+        response = self.download()
+        key, _ = firmware_build(self.preset)
+        self.assertEqual(response['X-Sendfile'], get_firmware_cache().path(key))
+        self.assertEqual(response.content, b'')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+
+
+class AsyncViewTests(FirmwareTestCase):
+    # Through AsyncClient the views get an ASGIRequest, as under uvicorn.
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user)
+        refresh_dashboard(self.user.pk)
+
+    async def test_download_is_streamed(self):
+        response = await self.async_client.get(reverse('download_firmware', args=[self.preset.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b'potCC', body)
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+    async def test_preset_list(self):
+        response = await self.async_client.get(reverse('preset_list'))
+        self.assertEqual(response.status_code, 200)
+        names = [preset['name'] for preset in response.json()['presets']]
+        # Newest first; the Default preset was provisioned with the account.
+        self.assertEqual(names, ['Lead', 'Default'])
+
+    async def test_preset_list_requires_login(self):
+        response = await AsyncClient().get(reverse('preset_list'))
+        self.assertEqual(response.status_code, 302)
+
+
+class FirmwareCacheTests(FirmwareTestCase):
+
+    def test_identical_presets_share_an_artifact(self):
+        other = build_preset(owner=User.objects.create_user('other'), name='Lead', keys_channel=1, number_of_knobs=2)
+        path = build_firmware(self.preset)
+        self.assertEqual(build_firmware(other), path)
+        self.assertEqual(len(os.listdir(settings.FIRMWARE_CACHE_DIR)), 1)
+        other.keys_channel = 2
+        self.assertNotEqual(build_firmware(other), path)
+
+    def test_eviction_keeps_the_newest_within_max_bytes(self):
+        cache = FirmwareCache(settings.FIRMWARE_CACHE_DIR, max_bytes=250)
+        now = time.time()
+        for key, age in [('a', 2000), ('b', 1000)]:
+            os.utime(cache.put(key, 'x' * 100), (now - age, now - age))
+        # 300 bytes: the least recently used one went.
+        cache.put('c', 'x' * 100)
+        self.assertEqual([key for key in 'abc' if cache.get(key)], ['b', 'c'])
+        # The artifact just written stays even when it alone is too big.
+        cache.put('d', 'x' * 300)
+        self.assertEqual([key for key in 'abcd' if cache.get(key)], ['d'])
+
+    def test_get_refreshes_the_mtime(self):
+        cache = get_firmware_cache()
+        path = cache.put('a', 'x')
+        old = time.time() - TOUCH_INTERVAL - 10
+        os.utime(path, (old, old))
+        self.assertEqual(cache.get('a'), path)
+        self.assertGreater(os.stat(path).st_mtime, old + TOUCH_INTERVAL)
+        self.assertIsNone(cache.get('missing'))
+
+
+class GeneratorTests(TestCase):
+
+    def setUp(self):
+        self.preset = SimpleNamespace(name='Lead\nPad', keys_channel=3)
+        self.knobs = [SimpleNamespace(pin=pin, CC=cc) for pin, cc in [(0, 20), (5, 74), (15, 7)]]
+
+    def test_every_board_renders_the_preset(self):
+        self.assertEqual(sorted(generator.BOARDS), ['ATMEGA32U4', 'ESP32_USB', 'RP2040'])
+        for board in generator.BOARDS:
+            with self.subTest(board=board):
+                sketch = generator.render_preset(self.preset, self.knobs, board)
+                self.assertIn('const int N_POTS = 3;', sketch)
+                self.assertIn('int potPin[N_POTS] = { 0, 5, 15 };', sketch)
+                self.assertIn('int potCC[N_POTS] = { 20, 74, 7 };', sketch)
+                self.assertIn('const int channel = 2;', sketch)
+                self.assertIn('// Preset: Lead Pad\r\n', sketch)
+                # The sketches are CRLF and stay so, header included.
+                self.assertEqual(sketch.count('\n'), sketch.count('\r\n'))
+
+    def test_pins_out_of_range(self):
+        for pin in (-1, 16):
+            knobs = self.knobs + [SimpleNamespace(pin=pin, CC=1)]
+            with self.subTest(pin=pin), self.assertRaisesMessage(ValueError, f'got {pin}.'):
+                generator.preset_values(self.preset, knobs)
+
+    def test_needs_a_knob(self):
+        with self.assertRaises(ValueError):
+            generator.render_preset(self.preset, [])
+
+
+class RetryOnLockTests(TransactionTestCase):
+    # Outside TestCase's wrapping transaction, where retrying is allowed.
+
+    def flaky(self, failures, message='database is locked'):
+        calls = []
+
+        @retry_on_lock(delay=0)
+        def write():
+            calls.append(None)
+            if len(calls) <= failures:
+                raise OperationalError(message)
+            return len(calls)
+
+        return write, calls
+
+    def test_retries_a_locked_transaction(self):
+        write, calls = self.flaky(failures=2)
+        self.assertEqual(write(), 3)
+
+    def test_gives_up_after_the_last_attempt(self):
+        write, calls = self.flaky(failures=5)
+        with self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(calls), 5)
+
+    def test_other_errors_are_not_retried(self):
+        write, calls = self.flaky(failures=1, message='no such table: midi_knob')
+        with self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(calls), 1)
+
+    def test_reraised_inside_an_outer_atomic(self):
+        write, calls = self.flaky(failures=1)
+        with self.assertRaises(OperationalError), transaction.atomic():
+            write()
+        self.assertEqual(len(calls), 1)
+
+
+class TieredCacheTests(TestCase):
+
+    def setUp(self):
+        # A fresh LOCATION per test: the local tier and counters are
+        # per-process state keyed by it.
+        location = uuid.uuid4().hex
+        self.enterContext(override_settings(CACHES={
+            'default': settings.CACHES['default'],
+            'tiered': {
+                'BACKEND': 'midi.cache.TieredCache',
+                'LOCATION': location,
+                'OPTIONS': {
+                    'SHARED': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': location},
+                    'LOCAL_MAX_ENTRIES': 2,
+                    'LOCAL_TIMEOUT': 0.2,
+                },
+            },
+        }))
+        self.cache = caches['tiered']
+
+    def stats(self):
+        stats = cache_stats()['tiered']
+        return {name: count for name, count in stats.items() if count}
+
+    def test_local_copies_expire(self):
+        self.cache.set('a', 1)
+        self.cache.shared.delete(self.cache.make_key('a'))
+        self.assertEqual(self.cache.get('a'), 1)
+        time.sleep(0.25)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.stats(), {'sets': 1, 'local_hits': 1, 'misses': 1})
+
+    def test_local_tier_is_an_lru(self):
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.cache.shared.clear()
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+        self.assertEqual(self.stats(), {'sets': 3, 'local_hits': 3, 'misses': 1, 'local_entries': 2})
+
+    def test_get_many_splits_the_tiers(self):
+        self.cache.set('a', 1)
+        self.cache.shared.set(self.cache.make_key('b'), 2)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        self.assertEqual(self.stats(), {'sets': 1, 'local_hits': 1, 'shared_hits': 1, 'misses': 1, 'local_entries': 2})
+        # The shared hit was copied into the local tier.
+        self.cache.shared.clear()
+        self.assertEqual(self.cache.get('b'), 2)
+
+    def test_invalidate_hides_local_copies(self):
+        namespace = Namespace('test', alias='tiered')
+        namespace.set_many({'a': 1}, scope=7)
+        namespace.set('b', 2, scope=8)
+        self.assertEqual(namespace.get_many(['a'], scope=7), {'a': 1})
+        namespace.invalidate(scope=7)
+        # Still in this process's local tier, but under the old version.
+        self.assertEqual(self.stats()['local_entries'], 2)
+        self.assertEqual(namespace.get_many(['a'], scope=7), {})
+        self.assertIsNone(namespace.get('a', scope=7))
+        self.assertEqual(namespace.get('b', scope=8), 2)
+        self.assertEqual(namespace.get_or_set('a', lambda: 3, scope=7), 3)
+        self.assertEqual(namespace.get('a', scope=7), 3)
+
+
+class FirmwareExportTests(FirmwareTestCase):
+
+    def test_zip_has_every_preset_and_board(self):
+        build_preset(owner=self.user, name='Pad', keys_channel=2, number_of_knobs=4)
+        empty = Preset.objects.create(owner=self.user, name='Empty', keys_channel=1, number_of_knobs=0)
+        # Saved before pins were limited to the sketches' inputs.
+        legacy = build_preset(owner=self.user, name='Legacy', number_of_knobs=2)
+        Knob.objects.filter(preset=legacy, pin=1).update(pin=40)
+        with self.assertNumQueries(2):
+            jobs = firmware_jobs(self.user)
+        presets = Preset.objects.filter(owner=self.user).exclude(pk__in=[empty.pk, legacy.pk])
+        self.assertEqual(len(presets), 3)
+
+        response = self.client.get(reverse('download_firmware_bundle'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        expected = {
+            f'firmware_preset_{preset.id}_{board}/firmware_preset_{preset.id}_{board}.ino'
+            for preset in presets
+            for board in generator.BOARDS
+        }
+        self.assertEqual(len(jobs), len(expected))
+        self.assertEqual(len(archive.namelist()), len(expected))
+        self.assertEqual(set(archive.namelist()), expected)
+        name = f'firmware_preset_{self.preset.id}_RP2040'
+        self.assertEqual(
+            archive.read(f'{name}/{name}.ino').decode('utf-8'),
+            generator.render_preset(self.preset, list(self.preset.knob_set.order_by('id')), 'RP2040'),
+        )
+
+
+@override_settings(DATABASE_REPLICA_VIEWS=[])
+class ProvisioningTests(TestCase):
+
+    def preset_queries(self, url):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries if '"midi_preset"' in query['sql']]
+
+    def test_signup_provisions_the_default_preset(self):
+        response = self.client.post(reverse('signup'), {'email': 'p@example.com', 'username': 'player', 'password': 'x'})
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        preset = Preset.objects.get(owner__username='player')
+        self.assertEqual((preset.name, preset.number_of_knobs), ('Default', 4))
+        self.assertEqual(preset.knob_set.count(), 4)
+
+    def test_home_skips_preset_queries_once_provisioned(self):
+        user = User.objects.create_user('player', password='x')
+        # Logging in provisions and flags the session.
+        self.client.force_login(user)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.preset_queries(reverse('home')), [])
+
+    def test_home_provisions_older_sessions_once(self):
+        user = User.objects.create_user('player', password='x')
+        self.client.force_login(user)
+        session = self.client.session
+        del session[PROVISIONED_SESSION_KEY]
+        session.save()
+        Preset.objects.filter(owner=user).delete()
+        self.assertEqual(len(self.preset_queries(reverse('home'))), 2)
+        self.assertEqual(Preset.objects.filter(owner=user).count(), 1)
+        self.assertEqual(self.preset_queries(reverse('home')), [])
+
+
+class BuildPresetTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('player', password='x')
+
+    def test_one_insert_for_all_knobs(self):
+        # SAVEPOINT, preset INSERT, knob INSERT, RELEASE (TestCase's own
+        # transaction turns the atomic block into a savepoint).
+        with self.assertNumQueries(4), CaptureQueriesContext(connections['default']) as queries:
+            preset = build_preset(owner=self.user, name='Lead', keys_channel=2, number_of_knobs=16)
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT INTO "midi_knob"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(preset.knob_set.count(), 16)
+        self.assertEqual(preset.number_of_knobs, 16)
+
+    def test_nothing_is_kept_when_a_knob_fails(self):
+        knobs = [{'channel': 1, 'CC': 20 + i, 'min': 0, 'max': 127, 'pin': 3} for i in range(2)]
+        with self.assertRaises(IntegrityError):
+            build_preset(owner=self.user, name='Clash', knobs=knobs)
+        self.assertFalse(Preset.objects.filter(name='Clash').exists())
+
+    def test_clone_copies_the_knobs(self):
+        preset = build_preset(owner=self.user, name='Lead', keys_channel=5, number_of_knobs=6)
+        Knob.objects.filter(preset=preset, pin=2).update(CC=99, max=90)
+        other = User.objects.create_user('other')
+        copy = clone_preset(preset, owner=other)
+        self.assertNotEqual(copy.pk, preset.pk)
+        self.assertEqual((copy.owner, copy.name, copy.keys_channel, copy.number_of_knobs), (other, 'Lead', 5, 6))
+        self.assertEqual(
+            list(copy.knob_set.order_by('id').values(*KNOB_FIELDS)),
+            list(preset.knob_set.order_by('id').values(*KNOB_FIELDS)),
+        )
+        self.assertEqual(clone_preset(preset, name='Lead 2').owner, self.user)
+
+
+@override_settings(DATABASE_REPLICA_VIEWS=[])
+class DashboardCacheTests(TestCase):
+    # Writes refresh the per-user summaries once their transaction commits;
+    # captureOnCommitCallbacks(execute=True) stands in for the commit.
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user('player', password='x')
+            self.lead = build_preset(owner=self.user, name='Lead', number_of_knobs=2)
+        self.client.force_login(self.user)
+
+    def dashboard(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        names = [preset['name'] for preset in response.context['presets']]
+        return names, [query['sql'] for query in queries if '"midi_preset"' in query['sql']]
+
+    def test_second_hit_is_served_from_the_cache(self):
+        PRESETS.invalidate(scope=self.user.pk)
+        names, queries = self.dashboard()
+        self.assertEqual(names, ['Lead', 'Default'])
+        self.assertEqual(len(queries), 1)
+        # Session and user only.
+        with self.assertNumQueries(2):
+            self.assertEqual(self.dashboard(), (names, []))
+
+    def test_writes_refresh_the_cache(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            pad = build_preset(owner=self.user, name='Pad', number_of_knobs=2)
+        self.assertEqual(self.dashboard(), (['Pad', 'Lead', 'Default'], []))
+        with self.captureOnCommitCallbacks(execute=True):
+            pad.name = 'Pad 2'
+            pad.save()
+        self.assertEqual(self.dashboard(), (['Pad 2', 'Lead', 'Default'], []))
+
+        # A knob change moves its preset's updated, and so to the top.
+        with self.captureOnCommitCallbacks(execute=True):
+            knob = self.lead.knob_set.first()
+            knob.max = 90
+            knob.save()
+        self.assertEqual(self.dashboard(), (['Lead', 'Pad 2', 'Default'], []))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pad.delete()
+        self.assertEqual(self.dashboard(), (['Lead', 'Default'], []))
+
+    def test_rolled_back_writes_refresh_nothing(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    self.lead.name = 'Gone'
+                    self.lead.save()
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.dashboard(), (['Lead', 'Default'], []))
+
+
+# Run in a fresh interpreter, as gunicorn's master would: release() closes
+# every connection and freezes the heap, neither of which the test process
+# can afford.
+WARMUP_SCRIPT = '''
+import os, sys
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SweetBoxSYNTHAGE.settings')
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from SweetBoxSYNTHAGE.warmup import warmup
+
+def get_application():
+    application = get_wsgi_application()
+    connections['default'].cursor().execute('SELECT 1')
+    return application
+
+warmup(get_application, stream=sys.stdout)
+print('open:', [c.alias for c in connections.all() if c.connection is not None])
+'''
+
+
+class WarmupTests(TestCase):
+
+    def test_warmup_runs_its_steps_and_closes_connections(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        env = dict(
+            os.environ,
+            WARMUP='1',
+            SQLITE_PATH=os.path.join(directory, 'db.sqlite3'),
+            METRICS_PATH=os.path.join(directory, 'metrics.sqlite3'),
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', WARMUP_SCRIPT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report, opened = result.stdout.splitlines()[-2:]
+        self.assertTrue(report.startswith('warmup: '), report)
+        for label, _ in warmup.STEPS:
+            self.assertIn(label, report)
+        self.assertIn(f'firmware boards: {len(generator.BOARDS)} in', report)
+        self.assertEqual(opened, 'open: []')
+
+    @override_settings(WARMUP=False)
+    def test_warmup_off_only_builds_the_application(self):
+        application, calls, stream = object(), [], io.StringIO()
+        steps = (('step', lambda: calls.append('step')),)
+        with mock.patch.object(warmup, 'STEPS', steps):
+            self.assertIs(warmup.warmup(lambda: application, stream=stream), application)
+        self.assertEqual(calls, [])
+        self.assertEqual(stream.getvalue(), '')
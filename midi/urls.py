@@ -1,14 +1,25 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.home, name="home"),
     path('dashboard/', views.dashboard, name="dashboard"),
+    path('presets/', views.preset_list, name='preset_list'),
     path('preset/', views.portal, name="portal"),
     path('sign-up/', views.signUp, name="signup"),
     path('create_preset/', views.create_preset, name='create_preset'),
     path('delete_preset/<str:pk>/', views.delete_preset, name='delete_preset'),
+    path('generate_firmware/<int:preset_id>/', views.generate_firmware, name='generate_firmware'),
     path('download_firmware/<int:preset_id>/', views.download_firmware, name='download_firmware'),
+    path('download_preset/<int:preset_id>/', views.download_preset_binary, name='download_preset_binary'),
+    path('firmware_builds/<int:build_id>/', views.firmware_build_status, name='firmware_build_status'),
+    path('download_firmware/all/', views.download_firmware_bundle, name='download_firmware_bundle'),
+    path('stats/cache/', views.cache_stats_view, name='cache_stats'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('api/presets/', api.presets, name='api_presets'),
+    path('api/presets/bulk/', api.presets_bulk, name='api_presets_bulk'),
+    path('api/presets/<int:preset_id>/', api.preset_detail, name='api_preset'),
+    path('api/presets/<int:preset_id>/knobs/', api.preset_knobs, name='api_preset_knobs'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
 ]
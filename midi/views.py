@@ -3,41 +3,43 @@
 # generate firmware of class "preset", flash firmware to either atmega 32u4, rp2040 or esp32 s3
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from .forms import UserForm
 from .forms import KnobFormSet
-from .models import Preset, Knob
-from django.contrib.auth.decorators import login_required
+from .models import FirmwareBuild, Preset, Knob
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth import authenticate, login, logout
 from django.views.decorators.csrf import csrf_exempt
+import asyncio
 import os
-from django.http import FileResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, StreamingHttpResponse
 from django.conf import settings
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib import messages
 from .forms import KeypressChannelForm
 from django.urls import reverse
+from django.db import IntegrityError
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import content_disposition_header, http_date
+from .api import preset_etag
+from .export import firmware_jobs, iter_firmware_zip
+from .binary import encode_preset
+from .cache import cache_stats
+from .metrics import REGISTRY, MetricsStore, render as render_metrics
+from .firmware_cache import build_firmware, cached_firmware_key, get_firmware_cache
+from .generator import BOARDS, DEFAULT_BOARD
+from .decorators import async_login_required
+from .jobs import await_build, enqueue_build
+from .services import adashboard_presets, build_preset, knob_values, provision_default_preset, save_knobs
 # Create your views here.
 
-def create_default_preset(user):
-    if (Preset.objects.filter(owner=user).count() < 1) or (Preset.objects.filter(name='Default').count() < 1):
-        preset = Preset.objects.create(
-            owner = user,
-            name = 'Default',
-            keys_channel = 1,
-            number_of_knobs = 4,
-        )
-        for i in range(preset.number_of_knobs):
-            knob = Knob.objects.create(
-                preset=preset,
-                CC=i,
-                pin=i,
-            )
-
 def home(request):
     user = request.user
     if user.is_authenticated:
-        create_default_preset(user)
+        provision_default_preset(user, request.session)
     context = {
         'hide_home_link': True,
     }   
@@ -47,82 +49,89 @@ def home(request):
 @login_required(login_url='login')
 def portal(request):
     user = request.user
-    presets = Preset.objects.filter(owner=user).order_by('-updated')
+    # One query for the preset list; the selected preset is picked out of it.
+    presets = list(Preset.objects.filter(owner=user).order_by('-updated'))
     preset_id = request.GET.get('preset')
     if preset_id:
-        preset = presets.filter(id=preset_id).first()
+        preset = next((p for p in presets if str(p.id) == preset_id), None)
     else:
-        preset = presets.first()
+        preset = presets[0] if presets else None
+
+    # One query for the knobs. The queryset is evaluated here and handed to the
+    # formset already ordered, so the formset and the template share its cache.
     if preset:
-        knobs = preset.knob_set.all()
+        knob_queryset = preset.knob_set.order_by('id')
     else:
-        knobs = Knob.objects.none()
-    firmware_path = None
-
-    knob_queryset = Knob.objects.filter(preset=preset)
+        knob_queryset = Knob.objects.none()
+    knobs = list(knob_queryset)
 
     if request.method == 'POST':
+        if preset is None:
+            return redirect(reverse('portal'))
+        # Validation writes the submitted values onto the knob instances, so
+        # the stored state is captured first for the diff.
+        stored = knob_values(knobs)
         knob_formset = KnobFormSet(request.POST, queryset=knob_queryset)
         midi_form = KeypressChannelForm(request.POST)
         preset_name_value = request.POST.get('preset_name', preset.name if preset else '')
 
         if knob_formset.is_valid() and midi_form.is_valid():
-            # Persist each knob form explicitly so that every new knob is saved.
-            knobs_saved = 0  # Counter for the number of active (non-deleted) knobs
-
-            for form in knob_formset:
-                # Skip forms that are marked for deletion
-                if form.cleaned_data.get('DELETE', False):
-                    # If an existing knob is marked for deletion, remove it from DB
-                    if form.instance.pk:
-                        form.instance.delete()
-                    continue
-
-                # Save new or updated knob instance
-                knob = form.save(commit=False)
-                # Ensure the knob is linked to the current preset before saving
-                knob.preset = preset
-                knob.save()
-                knobs_saved += 1
-
-            # After processing all forms, knobs_saved reflects the actual knob count
-            # (i.e., total forms minus deleted ones).
-            preset.number_of_knobs = knobs_saved
-            preset.keys_channel = midi_form.cleaned_data['midi_channel']
-            new_name = preset_name_value.strip()
-            if new_name and new_name != preset.name:
-                preset.name = new_name
-            preset.save()
-            messages.success(request, f'Preset "{preset.name}" saved successfully!')
-            return redirect(f"{reverse('portal')}?preset={preset.id}")
+            rows = [
+                dict(form.cleaned_data, id=form.instance.pk)
+                for form in knob_formset
+                if form.cleaned_data
+            ]
+            try:
+                save_knobs(
+                    preset,
+                    stored,
+                    rows,
+                    keys_channel=midi_form.cleaned_data['midi_channel'],
+                    name=preset_name_value.strip() or preset.name,
+                )
+            except IntegrityError:
+                # Only reachable when another request changed the same knobs
+                # concurrently; the formset has already checked uniqueness.
+                messages.error(request, 'This preset was changed while you were editing it. Please review and save again.')
+            else:
+                messages.success(request, f'Preset "{preset.name}" saved successfully!')
+                return redirect(f"{reverse('portal')}?preset={preset.id}")
         else:
             # On error, preserve entered values and show error messages
             messages.error(request, 'Please correct the errors below.')
-            context = {
-                'knob_formset': knob_formset,
-                'preset': preset,
-                'presets': presets,
-                'download_url': None,
-                'hide_portal_link': True,
-                'midi_form': midi_form,
-                'preset_name_value': preset_name_value,
-                'form_errors': knob_formset.non_form_errors() + (midi_form.errors.get('__all__', []) if midi_form.errors else [])
-            }
-            return render(request, 'midi/portal.html', context)
+        context = {
+            'knob_formset': knob_formset,
+            'knobs': knobs,
+            'preset': preset,
+            'presets': presets,
+            'download_url': None,
+            'hide_portal_link': True,
+            'midi_form': midi_form,
+            'preset_name_value': preset_name_value,
+            'form_errors': knob_formset.non_form_errors() + (midi_form.errors.get('__all__', []) if midi_form.errors else [])
+        }
+        return render(request, 'midi/portal.html', context)
     else:
         knob_formset = KnobFormSet(queryset=knob_queryset, initial=[{'channel': 1, 'CC': 0, 'min': 0, 'max': 127, 'pin': 0}])
         midi_form = KeypressChannelForm(initial={'midi_channel': preset.keys_channel if preset else 1})
         preset_name_value = preset.name if preset else ''
 
     download_url = None
-    if firmware_path:
-        download_url = f'/download_firmware/{preset.id}/'
+    knob_etag = None
+    if preset:
+        download_url = reverse('download_firmware', args=[preset.id])
+        # Edits to stored knobs are saved one by one through the knob API,
+        # conditional on this ETag.
+        knob_etag = preset_etag(preset.updated)
 
     context = {
         'knob_formset': knob_formset,
+        'knobs': knobs,
         'preset': preset,
         'presets': presets,
         'download_url': download_url,
+        'knob_etag': knob_etag,
+        'boards': BOARDS,
         'hide_portal_link': True,
         'midi_form': midi_form,
     }
@@ -130,45 +139,163 @@ def portal(request):
     return render(request, 'midi/portal.html', context)
 
 
-def generate_firmware(request):
-    preset = Preset.objects.get(id=1)
-    # Improved firmware generation logic
-    firmware_template = '''
-// SweetBox SYNTHAGE Firmware
-// Preset: {preset_name}
-const int NUM_KNOBS = {num_knobs};
-int knobChannels[NUM_KNOBS] = {{ {channels} }};
-int knobCCs[NUM_KNOBS] = {{ {ccs} }};
-int knobMins[NUM_KNOBS] = {{ {mins} }};
-int knobMaxs[NUM_KNOBS] = {{ {maxs} }};
-// ... rest of your firmware ...
-'''
-    knob_objs = Knob.objects.filter(preset=preset)
-    firmware_content = firmware_template.format(
-        preset_name=preset.name,
-        num_knobs=knob_objs.count(),
-        channels=', '.join(str(k.channel) for k in knob_objs),
-        ccs=', '.join(str(k.CC) for k in knob_objs),
-        mins=', '.join(str(k.min) for k in knob_objs),
-        maxs=', '.join(str(k.max) for k in knob_objs),
-    )
-    firmware_dir = os.path.join(settings.BASE_DIR, 'generated_firmware')
-    os.makedirs(firmware_dir, exist_ok=True)
-    firmware_path = os.path.join(firmware_dir, f'firmware_preset_{preset.id}.ino')
-    with open(firmware_path, 'w') as f:
-        f.write(firmware_content)
-    messages.success(request, 'Settings saved and firmware generated!')
+@login_required(login_url='login')
+def generate_firmware(request, preset_id):
+    preset = Preset.objects.filter(id=preset_id, owner=request.user).first()
+    if preset is None:
+        return redirect(reverse('portal'))
+    board = request.GET.get('board', DEFAULT_BOARD)
+    try:
+        key, job = enqueue_build(preset, board)
+    except ValueError as e:
+        messages.error(request, str(e))
+    else:
+        if job is None or job.status == FirmwareBuild.DONE:
+            messages.success(request, 'Settings saved and firmware generated!')
+        else:
+            messages.info(request, 'Settings saved, firmware build queued.')
     return redirect(f"{reverse('portal')}?preset={preset.id}")
-    pass
+
+
+@login_required(login_url='login')
+def firmware_build_status(request, build_id):
+    job = FirmwareBuild.objects.filter(id=build_id, preset__owner=request.user).first()
+    if job is None:
+        return JsonResponse({'error': 'Not found.'}, status=404)
+    data = {
+        'id': job.id,
+        'preset': job.preset_id,
+        'board': job.board,
+        'status': job.status,
+        'error': job.error,
+        'download_url': None,
+    }
+    if job.status == FirmwareBuild.DONE:
+        data['download_url'] = f"{reverse('download_firmware', args=[job.preset_id])}?board={job.board}"
+    return JsonResponse(data)
+
+
+async def firmware_response(request, path, filename):
+    # With FIRMWARE_SENDFILE_HEADER set, the front-end server streams the file
+    # and the worker only returns headers. Under ASGI the file is streamed in
+    # chunks read in a thread, so a slow device holds a coroutine, not a
+    # worker; FileResponse would be read whole into memory there.
+    header = settings.FIRMWARE_SENDFILE_HEADER
+    if header:
+        response = HttpResponse(content_type='application/octet-stream')
+        if header == 'X-Accel-Redirect':
+            response[header] = settings.FIRMWARE_SENDFILE_PREFIX + os.path.basename(path)
+        else:
+            response[header] = path
+    elif isinstance(request, ASGIRequest):
+        f = await asyncio.to_thread(open, path, 'rb')
+        response = StreamingHttpResponse(aiter_file(f), content_type='application/octet-stream')
+        response['Content-Length'] = os.fstat(f.fileno()).st_size
+    else:
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=filename)
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+async def aiter_file(f, chunk_size=FileResponse.block_size):
+    try:
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk
+    finally:
+        f.close()
+
+
+@async_login_required(login_url='/login/')
+async def download_firmware(request, preset_id):
+    preset = await Preset.objects.filter(id=preset_id, owner=request.user).afirst()
+    if preset is None:
+        return redirect(reverse('portal'))
+    board = request.GET.get('board', DEFAULT_BOARD)
+    try:
+        key = await sync_to_async(cached_firmware_key)(preset, board)
+    except ValueError as e:
+        messages.error(request, str(e))
+        return redirect(f"{reverse('portal')}?preset={preset.id}")
+
+    # The build key hashes everything the artifact is rendered from, so it is
+    # the content hash; polling devices get a 304 without touching the disk.
+    etag = f'"{key}"'
+    last_modified = int(preset.updated.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        firmware_path = get_firmware_cache().get(key)
+        if firmware_path is None:
+            # Not built yet: queue it and wait briefly, otherwise point the
+            # client at the job to poll.
+            key, job = await sync_to_async(enqueue_build)(preset, board)
+            if job is not None:
+                firmware_path = await await_build(key, job, settings.FIRMWARE_BUILD_WAIT)
+                if firmware_path is None and job.status == FirmwareBuild.FAILED:
+                    messages.error(request, job.error or 'Firmware build failed.')
+                    return redirect(f"{reverse('portal')}?preset={preset.id}")
+            else:
+                # Built by someone else since the first lookup.
+                firmware_path = await sync_to_async(build_firmware)(preset, board)
+        if firmware_path is None:
+            status_url = reverse('firmware_build_status', args=[job.id])
+            response = JsonResponse({'status': job.status, 'status_url': status_url}, status=202)
+            response['Location'] = status_url
+            response['Retry-After'] = '1'
+            return response
+        response = await firmware_response(request, firmware_path, f'firmware_preset_{preset_id}_{board}.ino')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required(login_url='/login/')
-def download_firmware(request, preset_id):
-    firmware_dir = os.path.join(settings.BASE_DIR, 'generated_firmware')
-    firmware_path = os.path.join(firmware_dir, f'firmware_preset_{preset_id}.ino')
-    if os.path.exists(firmware_path):
-        return FileResponse(open(firmware_path, 'rb'), as_attachment=True, filename=f'firmware_preset_{preset_id}.ino')
-    return redirect(reverse('portal'))
+def download_preset_binary(request, preset_id):
+    preset = Preset.objects.filter(id=preset_id, owner=request.user).first()
+    if preset is None:
+        return redirect(reverse('portal'))
+    # preset.updated moves with every knob save, so it identifies the blob.
+    etag = f'"{preset.id}-{int(preset.updated.timestamp() * 1_000_000)}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            data = encode_preset(preset)
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect(f"{reverse('portal')}?preset={preset.id}")
+        response = HttpResponse(data, content_type='application/octet-stream')
+        response['Content-Disposition'] = content_disposition_header(True, f'preset_{preset.id}.sbx')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@user_passes_test(lambda user: user.is_staff, login_url='login')
+def cache_stats_view(request):
+    # Per-process counters; each worker reports its own.
+    return JsonResponse({'pid': os.getpid(), 'caches': cache_stats()})
+
+
+def metrics_view(request):
+    # Prometheus scrape target. A bearer token when METRICS_TOKEN is set,
+    # otherwise staff sessions only.
+    if settings.METRICS_TOKEN:
+        allowed = constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}')
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    REGISTRY.flush()
+    rows = MetricsStore(settings.METRICS_PATH).rows()
+    return HttpResponse(render_metrics(rows), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@login_required(login_url='/login/')
+def download_firmware_bundle(request):
+    jobs = firmware_jobs(request.user)
+    response = StreamingHttpResponse(iter_firmware_zip(jobs), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, f'{request.user.username}_firmware.zip')
+    return response
 
 
 @csrf_exempt
@@ -180,22 +307,12 @@ def create_preset(request):
         number_of_knobs = int(request.POST.get('number_of_knobs', 4))
         user = request.user
 
-        preset = Preset.objects.create(
+        build_preset(
             owner=user,
             name=name,
             keys_channel=keys_channel,
             number_of_knobs=number_of_knobs,
         )
-        # Create the corresponding number of knob objects as stated in the preset
-        for i in range(preset.number_of_knobs):
-            knob = Knob.objects.create(
-                preset=preset,
-                channel=1,
-                CC=i,
-                min=0,
-                max=127,
-                pin=i
-            )
 
         messages.success(request, f'Preset "{name}" created successfully!')
         return redirect('dashboard')
@@ -226,10 +343,9 @@ def signUp(request):
     page = 'signup'
     if request.method == 'POST':
         form = UserForm(request.POST)
-        if form.is_valid:
+        if form.is_valid():
+            # The default preset is provisioned by the post_save signal.
             form.save()
-            # Create a default preset for new user
-            create_default_preset(request.user)
             return redirect('login')
 
 
@@ -271,16 +387,24 @@ def logout_view(request):
     return redirect('home')
 
 
-@login_required(login_url='login')
-def dashboard(request):
-    user = request.user
-    presets = Preset.objects.filter(owner=user)
-    preset_count = presets.count()
+@async_login_required(login_url='login')
+async def dashboard(request):
+    # Summaries come from the per-user cache; the count is taken from the
+    # same list rather than a second query.
+    presets = await adashboard_presets(request.user)
+    preset_count = len(presets)
 
     context = {
         'hide_dashboard_link':True,
         'presets':presets,
         'preset_count':preset_count,
     }   
-    return render(request, 'midi/dashboard.html', context)
+    # Rendering reads the session (messages, CSRF), which is sync-only.
+    return await sync_to_async(render)(request, 'midi/dashboard.html', context)
+
+
+@async_login_required(login_url='login')
+async def preset_list(request):
+    presets = await adashboard_presets(request.user)
+    return JsonResponse({'presets': presets})
 